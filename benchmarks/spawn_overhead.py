@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+""" Measures the overhead of spawning very short commands.
+
+Compares the latency of starting a command through a shell and without
+one, then the overhead per command of a worker executing many very short
+commands, with and without a shell (a trailing ";" forces the shell), and
+grouped in a single shell by 100.
+
+Usage: python2 benchmarks/spawn_overhead.py [nb_commands]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from os.path import join as pjoin
+
+import smartdispatch
+from smartdispatch.command_manager import CommandManager
+
+
+def time_spawn(nb_commands, **popen_kwargs):
+    start_time = time.time()
+    for _ in range(nb_commands):
+        subprocess.Popen(**popen_kwargs).wait()
+
+    return (time.time() - start_time) / nb_commands
+
+
+def time_worker(commands, worker_flags=[]):
+    testing_dir = tempfile.mkdtemp()
+    try:
+        command_manager = CommandManager(pjoin(testing_dir, "commands.txt"))
+        command_manager.set_commands_to_run(commands)
+
+        base_worker_script = pjoin(os.path.dirname(smartdispatch.__file__), 'workers', 'base_worker.py')
+        start_time = time.time()
+        subprocess.check_call(['python2', base_worker_script, '-s', '0'] + worker_flags + [command_manager._commands_filename, testing_dir])
+        return (time.time() - start_time) / len(commands)
+    finally:
+        shutil.rmtree(testing_dir)
+
+
+def main():
+    nb_commands = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    print "## Spawn latency of /bin/true ({0} times) ##".format(nb_commands)
+    with_shell = time_spawn(nb_commands, args="/bin/true", shell=True)
+    without_shell = time_spawn(nb_commands, args=["/bin/true"])
+    print "With a shell:    {0:.3f} ms".format(1000 * with_shell)
+    print "Without a shell: {0:.3f} ms".format(1000 * without_shell)
+
+    print "\n## Worker overhead per command ({0} commands) ##".format(nb_commands)
+    with_shell = time_worker(["/bin/true {0};".format(i) for i in range(nb_commands)])
+    without_shell = time_worker(["/bin/true {0}".format(i) for i in range(nb_commands)])
+    print "With a shell:    {0:.3f} ms".format(1000 * with_shell)
+    print "Without a shell: {0:.3f} ms".format(1000 * without_shell)
+    grouped = time_worker(["/bin/true {0}".format(i) for i in range(nb_commands)], ['--groupSize', '100'])
+    print "Groups of 100:   {0:.3f} ms".format(1000 * grouped)
+
+
+if __name__ == "__main__":
+    main()
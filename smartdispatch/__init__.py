@@ -1,2 +1,4 @@
 from __future__ import absolute_import
 from smartdispatch.smartdispatch import *
+from smartdispatch.batch import Batch
+from smartdispatch.tasks import map, TaskError
@@ -0,0 +1,669 @@
+from __future__ import absolute_import
+
+import os
+import re
+import glob
+import math
+import time
+import json
+from os.path import join as pjoin
+from contextlib import contextmanager
+
+import smartdispatch
+from smartdispatch import utils
+from smartdispatch.command_manager import CommandManager
+from smartdispatch.filelock import open_with_lock
+from smartdispatch.history import estimate_durations, suggest_pool_and_walltime, suggest_backfill_shape
+from smartdispatch.job_generator import job_generator_factory
+from smartdispatch.local_executor import regex_worker_line
+from smartdispatch.worker_options import WorkerOptions
+
+# Autoresume settings.
+TIMEOUT_EXIT_CODE = 124
+BAD_NODE_EXIT_CODE = 75  # EX_TEMPFAIL, a worker leaving a bad node: its work is left to jobs avoiding the node.
+AUTORESUME_TRIGGER_BEFORE = 60  # By default, workers are terminated 60s before the maximum walltime.
+AUTORESUME_REQUEUE_TIME = 30  # Seconds left to the workers to requeue their commands once these are checkpointed.
+AUTORESUME_WORKER_CALL_PREFIX = 'timeout -s TERM $(($PBS_WALLTIME - {trigger_before})) '
+AUTORESUME_WORKER_CALL_SUFFIX = ' WORKER_PIDS+=" $!"'
+AUTORESUME_ENDING_SOON = 600  # Jobs whose workers are terminated within 10 minutes do not count as live to cover the work left.
+AUTORESUME_STATE_FILENAME = "autoresume.json"
+AUTORESUME_DEADLINES_FILENAME = "autoresume_deadlines.txt"  # "{PBS file} {time} {deadline of its workers}", written when a job starts and ends.
+AUTORESUME_PROLOG = """\
+WORKER_PIDS=""
+echo "$PBS_FILENAME $(date +%s) $(($(date +%s) + $PBS_WALLTIME - {trigger_before}))" >> "{path_job}/{deadlines_filename}"
+"""
+AUTORESUME_WAIT_EPILOG = """\
+NEED_TO_RESUME={{chain}}  # A chained job always tells whether its continuation is still needed.
+for WORKER_PID in $WORKER_PIDS; do
+    wait "$WORKER_PID"
+    RETURN_CODE=$?
+    if [ $RETURN_CODE -eq {timeout_exit_code} ] || [ $RETURN_CODE -eq {bad_node_exit_code} ]; then
+        NEED_TO_RESUME=true
+    fi
+done
+echo "$PBS_FILENAME $(date +%s) $(date +%s)" >> "{{path_job}}/{deadlines_filename}"
+""".format(timeout_exit_code=TIMEOUT_EXIT_CODE, bad_node_exit_code=BAD_NODE_EXIT_CODE, deadlines_filename=AUTORESUME_DEADLINES_FILENAME)
+AUTORESUME_EPILOG = """\
+if [ "$NEED_TO_RESUME" = true ]; then
+    echo "Autoresuming the work left using: {launcher}"
+    sd-launch-pbs --launcher {launcher} --autoresume $PBS_FILENAME {path_job}
+fi
+"""
+
+WORKER_COMMAND = 'cd "{cwd}"; {worker_call_prefix}python2 {worker_script} {worker_script_flags} "{commands_file}" "{log_folder}" '\
+                 '1>> "{log_folder}/worker/$PBS_JOBID\"\"_worker_{{ID}}.o" '\
+                 '2>> "{log_folder}/worker/$PBS_JOBID\"\"_worker_{{ID}}.e" &'\
+                 '{worker_call_suffix}'
+
+# Backfill settings.
+BACKFILL_WALLTIMES = ["1:00:00", "2:00:00", "4:00:00", "8:00:00", "12:00:00", "1:00:00:00"]  # Candidates of an automatic backfill.
+BACKFILL_DEFAULT_WALLTIME = "2:00:00"  # Used by an automatic backfill without history.
+SIZING_LOG_FILENAME = "sizing.log"
+
+regex_job_file = re.compile(r"job_commands_(\d+)\.sh$")
+regex_nodes_resource = re.compile(r"^(#PBS -l nodes=\S*?ppn=)(\d+)(?::gpus=(\d+))?", re.MULTILINE)
+regex_excludenodes_resource = re.compile(r"^#PBS -l excludenodes=.*$\n?", re.MULTILINE)
+regex_pbs_directive = re.compile(r"^#PBS .*$\n?", re.MULTILINE)
+regex_group_size = re.compile(r" --groupSize (\d+) ")
+
+
+def get_nb_workers(pbs):
+    """ Counts the workers started by a PBS file. """
+    return len(regex_worker_line.findall(pbs))
+
+
+def get_group_size(pbs):
+    """ Gets the number of commands claimed and executed at once by the workers of a PBS file. """
+    match = regex_group_size.search(pbs)
+    return int(match.group(1)) if match is not None else 1
+
+
+def resize_pbs(pbs, nb_workers):
+    """ Keeps the first `nb_workers` workers of a PBS file, along with the cores and GPUs they need. """
+    nb_initial_workers = get_nb_workers(pbs)
+    worker_lines = regex_worker_line.findall(pbs)
+    for worker_line in worker_lines[nb_workers:]:
+        pbs = pbs.replace(worker_line, "", 1)
+
+    def resize_nodes(match):
+        resource = match.group(1) + str(int(match.group(2)) * nb_workers // nb_initial_workers)
+        if match.group(3) is not None:
+            resource += ":gpus={0}".format(int(match.group(3)) * nb_workers // nb_initial_workers)
+        return resource
+
+    return regex_nodes_resource.sub(resize_nodes, pbs)
+
+
+def exclude_nodes(pbs, nodes):
+    """ Keeps a PBS file off the given nodes, using the excludenodes resource of Moab. """
+    pbs = regex_excludenodes_resource.sub("", pbs)
+    directives = regex_pbs_directive.findall(pbs)
+    if len(nodes) == 0 or len(directives) == 0:
+        return pbs
+
+    end = pbs.index(directives[-1]) + len(directives[-1])
+    return pbs[:end] + "#PBS -l excludenodes={0}\n".format(":".join(nodes)) + pbs[end:]
+
+
+class Batch(object):
+
+    """ Commands executed by a pool of workers in PBS jobs, kept in a batch folder.
+
+    Use `Batch.create` to start a new batch and `Batch.load` to get back an
+    existing one (e.g. to resume it or poll its status).
+
+    Parameters
+    ----------
+    path_job : str
+        path to the batch folder (i.e. SMART_DISPATCH_LOGS/{batch_uid})
+    """
+
+    def __init__(self, path_job):
+        self.path_job, self.path_job_logs, self.path_job_commands = smartdispatch.get_job_folders(*os.path.split(os.path.abspath(path_job)))
+        self.batch_uid = os.path.basename(self.path_job)
+        self.command_manager = CommandManager(pjoin(self.path_job_commands, "commands.txt"))
+
+    @classmethod
+    def create(cls, commands, name, path_smartdispatch_logs, priorities=None, retry_policy=None, circuit_breaker=None):
+        ''' Creates a batch folder holding the commands to execute.
+
+        Parameters
+        ----------
+        commands : list of str
+            commands to execute
+        name : str
+            name of the batch folder, i.e. the batch UID
+        path_smartdispatch_logs : str
+            path to the SMART_DISPATCH_LOGS folder
+        priorities : list of tuple
+            priority of each command (see `CommandManager.set_commands_to_run`)
+        retry_policy : `RetryPolicy` instance
+            how failed commands are retried (Default: never)
+        circuit_breaker : `CircuitBreaker` instance
+            when the batch is paused because too many commands fail (Default: never)
+        '''
+        batch = cls(pjoin(path_smartdispatch_logs, name))
+        batch.command_manager.set_commands_to_run(commands, priorities)
+        if retry_policy is not None:
+            batch.command_manager.set_retry_policy(retry_policy)
+        if circuit_breaker is not None:
+            batch.command_manager.set_circuit_breaker(circuit_breaker)
+
+        return batch
+
+    @classmethod
+    def load(cls, batch_uid, path_smartdispatch_logs):
+        """ Gets back an existing batch from its UID or the path to its folder. """
+        path_job = batch_uid if os.path.isdir(batch_uid) else pjoin(path_smartdispatch_logs, batch_uid)
+        if not os.path.isdir(path_job):
+            raise LookupError("Batch UID ({0}) does not exist!".format(batch_uid))
+
+        return cls(path_job)
+
+    @property
+    def pbs_filenames(self):
+        """ PBS files of this batch, in order. """
+        pbs_filenames = glob.glob(pjoin(self.path_job_commands, "job_commands_*.sh"))
+        return sorted(pbs_filenames, key=lambda filename: int(regex_job_file.search(filename).group(1)))
+
+    @property
+    def jobs_id(self):
+        """ ID of every job submitted for this batch, including resubmissions. """
+        jobs_id_filename = pjoin(self.path_job, "jobs_id.txt")
+        if not os.path.isfile(jobs_id_filename):
+            return []
+
+        with open(jobs_id_filename) as jobs_id_file:
+            return [job_id for line in jobs_id_file if not line.startswith("##") for job_id in line.split()]
+
+    def get_worker_commands(self, pool, worker_script_flags=[], autoresume=False, cwd=None, trigger_before=AUTORESUME_TRIGGER_BEFORE):
+        """ Gets the commands starting `pool` workers in the background, from `cwd` (Default: current folder).
+
+        With `autoresume`, workers are terminated `trigger_before` seconds before the walltime.
+        """
+        worker_call_prefix = AUTORESUME_WORKER_CALL_PREFIX.format(trigger_before=trigger_before) if autoresume else ''
+        worker_call_suffix = AUTORESUME_WORKER_CALL_SUFFIX if autoresume else ''
+        if autoresume:
+            worker_script_flags = worker_script_flags + ['-r']
+
+        worker_command = WORKER_COMMAND.format(cwd=os.getcwd() if cwd is None else cwd, worker_call_prefix=worker_call_prefix,
+                                               worker_script=pjoin(os.path.dirname(smartdispatch.__file__), 'workers', 'base_worker.py'),
+                                               worker_script_flags=' '.join(worker_script_flags), commands_file=self.command_manager._commands_filename,
+                                               log_folder=self.path_job_logs, worker_call_suffix=worker_call_suffix)
+        return [worker_command.format(ID=i) for i in range(pool)]
+
+    def _log_sizing(self, explanation):
+        with open(pjoin(self.path_job, SIZING_LOG_FILENAME), 'a') as sizing_log:
+            sizing_log.write(time.strftime("## %Y-%m-%d %H:%M:%S ##\n"))
+            sizing_log.write("\n".join(explanation) + "\n\n")
+
+    def size_pool_and_walltime(self, target_makespan, max_walltime=None, pool=None, walltime=None):
+        ''' Sizes the pool and the walltime executing the pending commands within a target makespan.
+
+        Durations are estimated from similar commands executed in previous
+        batches. The explanation is also kept in the sizing log of the batch.
+
+        Parameters
+        ----------
+        target_makespan : str
+            wanted time ([[[DD:]HH:]MM:]SS) to execute every pending command
+        max_walltime : str
+            maximum walltime ([[[DD:]HH:]MM:]SS) allowed by the queue (Default: inf)
+        pool : int
+            pool to keep instead of the suggested one (Default: suggested)
+        walltime : str
+            walltime to keep instead of the suggested one (Default: suggested)
+
+        Returns
+        -------
+        pool : int
+            number of workers, `pool` if there is no history
+        walltime : str
+            walltime of the jobs, `walltime` if there is no history
+        explanation : list of str
+            how `pool` and `walltime` were derived
+        '''
+        path_smartdispatch_logs = os.path.dirname(self.path_job)
+        durations, explanation = estimate_durations(self.command_manager.get_pending_commands(), path_smartdispatch_logs)
+        if durations is None:
+            return pool, walltime, ["No history of similar commands found, the target makespan is ignored."]
+
+        max_walltime = utils.walltime_to_seconds(max_walltime) if max_walltime is not None else None
+        suggested_pool, suggested_walltime, sizing_explanation = suggest_pool_and_walltime(durations, utils.walltime_to_seconds(target_makespan), max_walltime)
+        explanation += sizing_explanation
+
+        if pool is None:
+            pool = suggested_pool
+            explanation.append("Using a pool of {0} worker(s).".format(pool))
+        else:
+            explanation.append("Keeping the provided pool of {0} worker(s) (suggested: {1}).".format(pool, suggested_pool))
+
+        if walltime is None:
+            walltime = suggested_walltime
+            explanation.append("Using a walltime of {0}.".format(walltime))
+        else:
+            explanation.append("Keeping the provided walltime of {0} (suggested: {1}).".format(walltime, suggested_walltime))
+
+        self._log_sizing(explanation)
+        return pool, walltime, explanation
+
+    def shape_for_backfill(self, walltime="auto", max_walltime=None, pool=None, nb_cores_per_node=None, nb_cores_per_command=1):
+        ''' Shapes the short jobs, easier to backfill, executing the pending commands.
+
+        The work left when a job reaches its walltime is moved to the next
+        ones by autoresume. The pool executes the work within about one
+        walltime according to the durations of similar commands executed in
+        previous batches. The explanation is also kept in the sizing log of
+        the batch.
+
+        Parameters
+        ----------
+        walltime : str
+            walltime ([[[DD:]HH:]MM:]SS) of the jobs, or "auto" to choose it among `BACKFILL_WALLTIMES` (up to
+            `max_walltime`) from the durations and the start time estimates of the scheduler, when available
+        max_walltime : str
+            maximum walltime ([[[DD:]HH:]MM:]SS) allowed by the queue (Default: inf)
+        pool : int
+            pool to keep instead of the suggested one (Default: suggested)
+        nb_cores_per_node : int
+            cores of a node, to estimate when a job using a whole node would start (Default: `nb_cores_per_command`)
+        nb_cores_per_command : int
+            cores needed by a command
+
+        Returns
+        -------
+        pool : int
+            number of workers, `pool` if there is no history
+        walltime : str
+            walltime (DD:HH:MM:SS) of the jobs
+        explanation : list of str
+            how `pool` and `walltime` were derived
+        '''
+        max_walltime = utils.walltime_to_seconds(max_walltime) if max_walltime is not None else None
+        if walltime == "auto":
+            walltimes = [candidate for candidate in map(utils.walltime_to_seconds, BACKFILL_WALLTIMES) if max_walltime is None or candidate < max_walltime]
+            walltimes += [max_walltime] if max_walltime is not None else []
+        else:
+            walltimes = [utils.walltime_to_seconds(walltime)]
+
+        path_smartdispatch_logs = os.path.dirname(self.path_job)
+        durations, explanation = estimate_durations(self.command_manager.get_pending_commands(), path_smartdispatch_logs)
+        if durations is None:
+            if walltime == "auto":
+                walltime = utils.seconds_to_walltime(min(utils.walltime_to_seconds(BACKFILL_DEFAULT_WALLTIME), max_walltime or float('inf')))
+            else:
+                walltime = utils.seconds_to_walltime(walltimes[0])
+
+            explanation = ["No history of similar commands found, using jobs of {0}.".format(walltime)]
+            self._log_sizing(explanation)
+            return pool, walltime, explanation
+
+        start_delays = None
+        if len(walltimes) > 1:
+            # Scheduler's estimate of when a job using a whole node would start.
+            nb_cores_per_job = max((nb_cores_per_node or nb_cores_per_command) // nb_cores_per_command, 1) * nb_cores_per_command
+            start_delays = [utils.get_start_delay(nb_cores_per_job, utils.seconds_to_walltime(candidate)) for candidate in walltimes]
+
+        has_start_delays = start_delays is not None and None not in start_delays
+        suggested_pool, walltime, shape_explanation = suggest_backfill_shape(durations, walltimes, start_delays if has_start_delays else None)
+        explanation += shape_explanation
+        if start_delays is not None and not has_start_delays:
+            explanation.append("Start time estimates (showstart) are not available, waits in the queue are not considered.")
+        explanation.append("Using jobs of {0}.".format(walltime))
+
+        if pool is None:
+            pool = suggested_pool
+            explanation.append("Using a pool of {0} worker(s).".format(pool))
+        else:
+            explanation.append("Keeping the provided pool of {0} worker(s) (suggested: {1}).".format(pool, suggested_pool))
+
+        self._log_sizing(explanation)
+        return pool, walltime, explanation
+
+    def generate_pbs_files(self, queue, pool=None, worker_options=None, autoresume=False, launcher="qsub", cluster_name=None,
+                           stage_in=[], pbs_flags=None, cwd=None, checkpoint_time=None, chain=False):
+        ''' Writes the PBS files executing the pending commands of this batch with a pool of workers.
+
+        Parameters
+        ----------
+        queue : `Queue` instance
+            queue on which commands will be executed
+        pool : int
+            number of workers (Default: one per pending command, or per group of commands)
+        worker_options : `WorkerOptions` instance
+            how workers execute the commands (Default: `WorkerOptions()`)
+        autoresume : bool
+            resubmit the jobs reaching their walltime, commands are assumed resumable
+        launcher : str
+            launcher used to resubmit the jobs
+        cluster_name : str
+            cluster on which commands will be executed
+        stage_in : list of str
+            files or folders copied to the node-local scratch (see `JobGenerator.add_staging`)
+        pbs_flags : list of str
+            additional PBS flags (e.g. ["-lfeature=k80"])
+        cwd : str
+            folder from which commands are executed (Default: current folder)
+        checkpoint_time : int
+            with `autoresume`, seconds before the walltime at which commands are signaled (Default: 60)
+        chain : bool
+            with `autoresume`, jobs are meant to be launched chained (see `launch`)
+
+        Returns
+        -------
+        pbs_filenames : list of str
+            PBS files written
+        '''
+        worker_options = WorkerOptions() if worker_options is None else worker_options
+        if worker_options.bad_node_failures is not None and not autoresume:
+            raise ValueError("Blocklisting bad nodes requires autoresume, which resubmits the commands they give back.")
+
+        cwd = os.getcwd() if cwd is None else cwd
+        if pool is None:
+            pool = int(math.ceil(self.command_manager.get_nb_commands_to_run() / float(worker_options.group_size)))
+
+        checkpoint_time = AUTORESUME_TRIGGER_BEFORE if checkpoint_time is None else checkpoint_time
+        checkpoint_grace = max(checkpoint_time - AUTORESUME_REQUEUE_TIME, 0) if autoresume else None
+        worker_script_flags = worker_options.get_flags(queue.nb_gpus_per_node, checkpoint_grace)
+
+        commands = self.get_worker_commands(pool, worker_script_flags, autoresume, cwd, checkpoint_time)
+        command_params = {'nb_cores_per_command': worker_options.cores_per_command,
+                          'nb_gpus_per_command': worker_options.gpus_per_command,
+                          'mem_per_command': None}
+
+        prolog = []
+        epilog = ['wait']
+        if autoresume:
+            prolog = [AUTORESUME_PROLOG.format(trigger_before=checkpoint_time, path_job=self.path_job, deadlines_filename=AUTORESUME_DEADLINES_FILENAME)]
+            epilog = [AUTORESUME_WAIT_EPILOG.format(path_job=self.path_job, chain=str(chain).lower())]
+
+        job_generator = job_generator_factory(queue, commands, prolog, epilog, command_params, cluster_name, self.path_job)
+
+        # generating default names per each jobs in each batch
+        for pbs_id, pbs in enumerate(job_generator.pbs_list):
+            pbs.add_options(N=utils.jobname_generator(self.batch_uid, pbs_id))
+
+        if len(stage_in) > 0 or len(worker_options.stage_out) > 0:
+            job_generator.add_staging(stage_in, worker_options.stage_out, cwd)
+
+        # Jobs are resubmitted once their outputs are synced back.
+        if autoresume:
+            for pbs in job_generator.pbs_list:
+                pbs.add_to_epilog(AUTORESUME_EPILOG.format(launcher=launcher, path_job=self.path_job))
+
+        if pbs_flags is not None:
+            job_generator.add_pbs_flags(pbs_flags)
+
+        return job_generator.write_pbs_files(self.path_job_commands)
+
+    def launch(self, launcher="qsub", cluster_name=None, pbs_filenames=None, chain=False):
+        ''' Submits the PBS files of this batch (Default: all of them) and returns their job ID.
+
+        Parameters
+        ----------
+        launcher : str
+            launcher used to submit the jobs
+        cluster_name : str
+            cluster on which the jobs are submitted
+        pbs_filenames : list of str
+            PBS files to submit (Default: all the ones of this batch)
+        chain : bool
+            also submit a continuation of each job, starting once the job is
+            over (-W depend=afterany), so it waits in the queue while the job
+            runs. When the job ends, its continuation is cancelled if the work
+            left is covered without it, otherwise the next link of the chain
+            is submitted. Not supported by the local launcher.
+
+        Returns
+        -------
+        jobs_id : list of str
+            ID of the submitted jobs, continuations excluded
+        '''
+        if chain and launcher == "local":
+            raise ValueError("Jobs launched locally cannot be chained.")
+
+        pbs_filenames = self.pbs_filenames if pbs_filenames is None else pbs_filenames
+        pbs_filenames = [os.path.abspath(pbs_filename) for pbs_filename in pbs_filenames]
+        self._exclude_bad_nodes(pbs_filenames)
+
+        # Jobs are known to be live before being submitted, since they might be done by then (e.g. with the local launcher).
+        with self._autoresume_state() as state:
+            for pbs_filename in pbs_filenames:
+                with open(pbs_filename) as pbs_file:
+                    nb_workers = get_nb_workers(pbs_file.read())
+                state['jobs'][pbs_filename] = {'nb_workers': nb_workers, 'job_id': None, 'submitted_at': time.time()}
+
+        try:
+            jobs_id = smartdispatch.launch_jobs(launcher, pbs_filenames, cluster_name, self.path_job)
+        except:
+            self._forget_unsubmitted_jobs(pbs_filenames)
+            raise
+
+        with self._autoresume_state() as state:
+            for pbs_filename, job_id in zip(pbs_filenames, jobs_id):
+                if pbs_filename in state['jobs']:
+                    state['jobs'][pbs_filename]['job_id'] = job_id
+
+        if chain:
+            self._launch_successors(launcher, cluster_name, pbs_filenames)
+
+        return jobs_id
+
+    def _exclude_bad_nodes(self, pbs_filenames):
+        """ Keeps the jobs off the nodes blocklisted by the workers of this batch. """
+        bad_nodes = self.command_manager.get_bad_nodes()
+        if len(bad_nodes) == 0:
+            return
+
+        for pbs_filename in pbs_filenames:
+            with open(pbs_filename) as pbs_file:
+                pbs = pbs_file.read()
+            with open(pbs_filename, 'w') as pbs_file:
+                pbs_file.write(exclude_nodes(pbs, bad_nodes))
+
+    def _launch_successors(self, launcher, cluster_name, pbs_filenames):
+        """ Submits a continuation of each job, starting once the job is over. """
+        successors = []
+        with self._autoresume_state() as state:
+            for pbs_filename in pbs_filenames:
+                job = state['jobs'].get(pbs_filename)
+                if job is None or job['job_id'] is None:
+                    continue  # Already over, or not submitted.
+
+                with open(pbs_filename) as pbs_file:
+                    successor_filename = self._write_continuation(state, pbs_file.read(), job['nb_workers'])
+                state['jobs'][successor_filename] = {'nb_workers': job['nb_workers'], 'job_id': None, 'submitted_at': time.time(), 'after': pbs_filename}
+                job['successor'] = successor_filename
+                successors.append((successor_filename, job['job_id']))
+
+        for successor_filename, job_id in successors:
+            try:
+                successor_id = smartdispatch.launch_jobs(launcher, [successor_filename], cluster_name, self.path_job, depend_on=job_id)[0]
+            except:
+                self._forget_unsubmitted_jobs([successor_filename])
+                raise
+
+            with self._autoresume_state() as state:
+                if successor_filename in state['jobs']:
+                    state['jobs'][successor_filename]['job_id'] = successor_id
+
+    def _forget_unsubmitted_jobs(self, pbs_filenames):
+        """ Removes the jobs whose submission failed from the live ones, so they are not counted as queued forever. """
+        with self._autoresume_state() as state:
+            for pbs_filename in pbs_filenames:
+                job = state['jobs'].get(pbs_filename)
+                if job is not None and job['job_id'] is None:
+                    del state['jobs'][pbs_filename]
+                    if job.get('after') in state['jobs']:
+                        state['jobs'][job['after']].pop('successor', None)
+
+    @contextmanager
+    def _autoresume_state(self):
+        """ Gives exclusive access to the jobs of this batch known to be live, keyed by their PBS file. """
+        state_filename = pjoin(self.path_job, AUTORESUME_STATE_FILENAME)
+        open(state_filename, 'a').close()  # Make sure the file exists.
+        with open_with_lock(state_filename, 'r+') as state_file:
+            content = state_file.read()
+            state = json.loads(content) if len(content) > 0 else {'jobs': {}, 'nb_continuations': 0}
+            yield state
+
+            state_file.seek(0, os.SEEK_SET)
+            json.dump(state, state_file)
+            state_file.truncate()
+
+    def _get_workers_deadlines(self):
+        """ Gets when each job last started (or ended) and when its workers are terminated, keyed by PBS file. """
+        deadlines = {}
+        deadlines_filename = pjoin(self.path_job, AUTORESUME_DEADLINES_FILENAME)
+        if os.path.isfile(deadlines_filename):
+            with open(deadlines_filename) as deadlines_file:
+                for line in deadlines_file:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        deadlines[fields[0]] = (float(fields[1]), float(fields[2]))  # Latest line prevails.
+
+        return deadlines
+
+    def _count_live_workers(self, state, launcher):
+        """ Counts the workers of the live jobs that are not about to reach their walltime. """
+        jobs = state['jobs']
+        if launcher != "local":
+            live_jobs_id = utils.get_live_jobs([job['job_id'] for job in jobs.values() if job['job_id'] is not None])
+            if live_jobs_id is not None:
+                for pbs_filename, job in jobs.items():
+                    if job['job_id'] is not None and job['job_id'] not in live_jobs_id:
+                        del jobs[pbs_filename]  # Ended without telling, e.g. deleted or killed.
+
+        is_live = {}
+        deadlines = self._get_workers_deadlines()
+        for pbs_filename, job in jobs.items():
+            start_time, deadline = deadlines.get(pbs_filename, (0, None))
+            is_queued = start_time < int(job['submitted_at'])  # Times of the PBS files are in whole seconds.
+            is_live[pbs_filename] = is_queued or deadline - time.time() > AUTORESUME_ENDING_SOON
+
+        # A continuation waiting for its job takes over once the job is about to reach its walltime.
+        for pbs_filename, job in jobs.items():
+            if job.get('after') in jobs:
+                is_live[pbs_filename] = not is_live[job['after']]
+
+        return sum(job['nb_workers'] for pbs_filename, job in jobs.items() if is_live[pbs_filename])
+
+    def _count_missing_workers(self, state, launcher, group_size=1):
+        """ Counts the workers, each one executing `group_size` commands at once, needed by the pending and running commands that the live jobs do not cover. """
+        nb_commands_left = self.command_manager.get_nb_commands_to_run() + len(self.command_manager.get_running_commands())
+        return int(math.ceil(nb_commands_left / float(group_size))) - self._count_live_workers(state, launcher)
+
+    def _write_continuation(self, state, pbs, nb_workers):
+        """ Writes a copy of a PBS file keeping its first `nb_workers` workers and returns its filename. """
+        continuation_filename = pjoin(self.path_job_commands, "continuation_{0}.sh".format(state['nb_continuations']))
+        with open(continuation_filename, 'w') as continuation_file:
+            continuation_file.write(resize_pbs(pbs, nb_workers))
+
+        state['nb_continuations'] += 1
+        return continuation_filename
+
+    def _write_continuations(self, state, pbs, nb_missing_workers):
+        """ Writes copies of a PBS file having `nb_missing_workers` workers in total, but never more jobs than the batch. """
+        nb_workers_per_job = get_nb_workers(pbs)
+        if nb_missing_workers <= 0 or nb_workers_per_job == 0:
+            return []
+
+        nb_jobs = min(int(math.ceil(nb_missing_workers / float(nb_workers_per_job))), max(len(self.pbs_filenames), 1))
+        return [self._write_continuation(state, pbs, min(nb_workers_per_job, nb_missing_workers - i * nb_workers_per_job))
+                for i in range(nb_jobs)]
+
+    def resume(self, pbs_filename, launcher="qsub", cluster_name=None):
+        ''' Submits the continuation of a job that is over, e.g. that reached its walltime, and returns its job ID.
+
+        The continuation gets the workers needed by the pending and running
+        commands that are not already covered by the other live jobs of this
+        batch, i.e. the queued ones and the running ones not about to reach
+        their walltime. It is made of copies of the job, the last one with
+        fewer workers, and is never larger than the batch. This is planned
+        under a lock, so jobs reaching their walltime together do not each
+        resubmit the work left. Nothing is resubmitted while the batch is paused.
+
+        A chained job (see `launch`) already has a continuation waiting for it
+        in the queue. It is cancelled if the work left is covered without it,
+        otherwise the next link of the chain is submitted and only the workers
+        it does not cover are resubmitted.
+
+        Parameters
+        ----------
+        pbs_filename : str
+            PBS file of the job that is over
+        launcher : str
+            launcher used to submit the jobs, qstat tells which are still live unless it is "local"
+        cluster_name : str
+            cluster on which the jobs are submitted
+
+        Returns
+        -------
+        jobs_id : list of str
+            ID of the submitted jobs, none if the work left is covered
+        '''
+        pbs_filename = os.path.abspath(pbs_filename)
+        with open(pbs_filename) as pbs_file:
+            pbs = pbs_file.read()
+
+        with self._autoresume_state() as state:
+            job = state['jobs'].pop(pbs_filename, {})  # This job is done.
+            successor_filename = job.get('successor')
+            successor = state['jobs'].pop(successor_filename, None)
+
+            # The work left of a paused batch waits for it to be resumed by hand.
+            nb_missing_workers = self._count_missing_workers(state, launcher, get_group_size(pbs)) if not self.is_paused() else 0
+            if successor is not None and nb_missing_workers > 0:
+                state['jobs'][successor_filename] = successor  # Still needed.
+                nb_missing_workers -= successor['nb_workers']
+
+            continuation_filenames = self._write_continuations(state, pbs, nb_missing_workers)
+
+        if self.is_paused():
+            print "The batch is paused ({0}), nothing to resubmit.".format(self.command_manager.get_pause_reason())
+
+        if successor is not None and successor_filename not in state['jobs']:
+            print "No work left for the continuation of this job, cancelling it."
+            smartdispatch.cancel_jobs([successor['job_id']] if successor['job_id'] is not None else [])
+        elif successor is not None:
+            self._launch_successors(launcher, cluster_name, [successor_filename])
+
+        if len(continuation_filenames) == 0:
+            if not self.is_paused():
+                print "The work left is covered by the live jobs of the batch, nothing to resubmit."
+            return []
+
+        return self.launch(launcher, cluster_name, continuation_filenames, chain=successor_filename is not None)
+
+    def has_live_jobs(self):
+        """ Tells if a job of this batch is still queued or running, None if it cannot be known (i.e. qstat is not available).
+
+        Jobs launched locally are over once `launch` returns.
+        """
+        live_jobs_id = utils.get_live_jobs([job_id for job_id in self.jobs_id if not job_id.endswith(".local")])
+        return None if live_jobs_id is None else len(live_jobs_id) > 0
+
+    def get_status(self):
+        """ Gets the number of pending, running, finished, failed and timed out commands. """
+        return {'pending': self.command_manager.get_nb_commands_to_run(),
+                'running': len(self.command_manager.get_running_commands()),
+                'finished': len(self.command_manager.get_finished_commands()),
+                'failed': len(self.command_manager.get_failed_commands()),
+                'timed_out': len(self.command_manager.get_timed_out_commands())}
+
+    def is_done(self):
+        status = self.get_status()
+        return status['pending'] == 0 and status['running'] == 0
+
+    def is_paused(self):
+        """ Tells if commands are no longer executed since too many failed (see `CircuitBreaker`). """
+        return self.command_manager.is_paused()
+
+    def wait(self, poll_interval=60., timeout=None):
+        """ Waits until every command is done, or the batch is paused with no command running (or `timeout` seconds), and returns the status of the batch. """
+        start_time = time.time()
+        while not self.is_done() and not (self.is_paused() and len(self.command_manager.get_running_commands()) == 0) \
+                and (timeout is None or time.time() - start_time < timeout):
+            time.sleep(poll_interval)
+
+        return self.get_status()
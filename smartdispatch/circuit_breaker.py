@@ -0,0 +1,46 @@
+class CircuitBreaker(object):
+
+    """ Decides when a batch whose commands keep failing should be paused.
+
+    Parameters
+    ----------
+    max_failure_rate : float
+        fraction of failed commands among the last completed ones at which the batch is paused
+    window : int
+        number of last completed commands considered
+    min_completions : int
+        number of commands to complete before the batch can be paused, i.e. the failure
+        rate is first checked over the first `min_completions` ones (Default: `window`)
+    cancel_jobs : bool
+        once the batch is paused, delete its jobs still queued
+    """
+
+    def __init__(self, max_failure_rate, window=100, min_completions=None, cancel_jobs=False):
+        if not 0 < max_failure_rate <= 1:
+            raise ValueError("The maximum failure rate must be in ]0, 1].")
+
+        if window < 1:
+            raise ValueError("The window must hold at least one command.")
+
+        self.max_failure_rate = max_failure_rate
+        self.window = window
+        self.min_completions = window if min_completions is None else min(min_completions, window)
+        self.cancel_jobs = cancel_jobs
+
+    def should_pause(self, outcomes):
+        """ Tells if the batch should be paused given whether each of its last completed commands failed, in order. """
+        outcomes = outcomes[-self.window:]
+        if len(outcomes) == 0 or len(outcomes) < self.min_completions:
+            return False
+
+        return sum(outcomes) >= self.max_failure_rate * len(outcomes)
+
+    def to_dict(self):
+        return {'max_failure_rate': self.max_failure_rate,
+                'window': self.window,
+                'min_completions': self.min_completions,
+                'cancel_jobs': self.cancel_jobs}
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        return cls(**dictionary)
@@ -1,5 +1,32 @@
 import os
+import json
+import time
+import bisect
+from contextlib import contextmanager
 from .filelock import open_with_lock
+from .utils import generate_uid_from_string
+from .retry_policy import RetryPolicy
+from .circuit_breaker import CircuitBreaker
+
+
+def _get_priority_key(line, priorities):
+    """ Gets the key ordering pending commands by decreasing priority, then by decreasing cost. """
+    return [-p for p in priorities.get(generate_uid_from_string(line[:-1]), [0, 0])]
+
+
+class _PriorityKeys(object):
+
+    """ Keys of pending lines, only computed for the lines looked at (e.g. by `bisect`). """
+
+    def __init__(self, lines, priorities):
+        self.lines = lines
+        self.priorities = priorities
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return _get_priority_key(self.lines[index], self.priorities)
 
 
 class CommandManager(object):
@@ -10,9 +37,20 @@ class CommandManager(object):
         self._running_commands_filename = os.path.join(base_path, "running_" + filename)
         self._finished_commands_filename = os.path.join(base_path, "finished_" + filename)
         self._failed_commands_filename = os.path.join(base_path, "failed_" + filename)
+        self._timed_out_commands_filename = os.path.join(base_path, "timedout_" + filename)
+        self._timings_filename = os.path.join(base_path, "timings_" + filename)
+        self._priorities_filename = os.path.join(base_path, "priorities_" + filename)
+        self._attempts_filename = os.path.join(base_path, "attempts_" + filename)
+        self._retry_policy_filename = os.path.join(base_path, "retry_policy_" + filename)
+        self._speculative_commands_filename = os.path.join(base_path, "speculative_" + filename)
+        self._bad_nodes_filename = os.path.join(base_path, "bad_nodes_" + filename)
+        self._circuit_breaker_filename = os.path.join(base_path, "circuit_breaker_" + filename)
+        self._outcomes_filename = os.path.join(base_path, "outcomes_" + filename)  # Whether each of the last completed commands failed.
+        self._paused_filename = os.path.join(base_path, "paused_" + filename)
+        self._not_before_filename = os.path.join(base_path, "not_before_" + filename)  # Time before which a pending command is not claimed, keyed by UID.
         self._commands_filename = commands_filename
 
-    def _move_line_between_files(self, file1, file2, line):
+    def _remove_line_from_file(self, file1, line):
         file1.seek(0, os.SEEK_SET)
         lines = file1.readlines()
         lines.remove(line)
@@ -21,26 +59,179 @@ class CommandManager(object):
         file1.writelines(lines)
         file1.truncate()
 
+    def _remove_lines_from_file(self, file1, lines_to_remove):
+        file1.seek(0, os.SEEK_SET)
+        lines = file1.readlines()
+        for line in lines_to_remove:
+            lines.remove(line)
+
+        file1.seek(0, os.SEEK_SET)
+        file1.writelines(lines)
+        file1.truncate()
+
+    def _move_line_between_files(self, file1, file2, line):
+        self._remove_line_from_file(file1, line)
         file2.write(line)
 
-    def set_commands_to_run(self, commands):
-        with open_with_lock(self._commands_filename, 'a') as commands_file:
+    def _get_priorities(self):
+        if not os.path.isfile(self._priorities_filename):
+            return None
+
+        with open(self._priorities_filename, 'r') as priorities_file:
+            return json.load(priorities_file)
+
+    def _sort_by_priority(self, lines, priorities):
+        """ Sorts commands by decreasing priority, ties are kept in their current order. """
+        return sorted(lines, key=lambda line: _get_priority_key(line, priorities))
+
+    def _add_lines_to_pending(self, commands_file, lines, before_ties=False):
+        """ Adds lines to the pending commands, keeping them ordered by priority if any.
+
+        Pending commands being already ordered, each line is inserted by bisection, i.e.
+        looking up the priority of only a few pending commands. Lines go after the pending
+        commands of the same priority, or before them if `before_ties`.
+        """
+        priorities = self._get_priorities()
+        if priorities is None:
+            if before_ties:
+                commands_file.seek(0, os.SEEK_SET)
+                lines = lines + commands_file.readlines()
+                commands_file.seek(0, os.SEEK_SET)
+            else:
+                commands_file.seek(0, os.SEEK_END)
+            commands_file.writelines(lines)
+            return
+
+        commands_file.seek(0, os.SEEK_SET)
+        pending_lines = commands_file.readlines()
+        lines = self._sort_by_priority(lines, priorities)
+        if before_ties:
+            # Inserted last first, so lines of a same priority keep their order.
+            for line in reversed(lines):
+                pending_lines.insert(bisect.bisect_left(_PriorityKeys(pending_lines, priorities), _get_priority_key(line, priorities)), line)
+        else:
+            for line in lines:
+                pending_lines.insert(bisect.bisect_right(_PriorityKeys(pending_lines, priorities), _get_priority_key(line, priorities)), line)
+
+        commands_file.seek(0, os.SEEK_SET)
+        commands_file.writelines(pending_lines)
+        commands_file.truncate()
+
+    def set_commands_to_run(self, commands, priorities=None):
+        """ Adds commands to the pending ones.
+
+        Parameters
+        ----------
+        commands : list of str
+            commands to add
+        priorities : list of (priority, estimated cost)
+            priority of each command (Default: FIFO). Pending commands are kept
+            sorted by decreasing priority, then by decreasing cost, so claiming
+            a command stays a matter of taking the first line.
+        """
+        open(self._commands_filename, 'a').close()  # Make sure the file exists.
+        with open_with_lock(self._commands_filename, 'r+') as commands_file:
+            if priorities is not None:
+                all_priorities = self._get_priorities() or {}
+                for command, priority in zip(commands, priorities):
+                    all_priorities[generate_uid_from_string(command)] = list(priority)
+
+                with open(self._priorities_filename, 'w') as priorities_file:
+                    json.dump(all_priorities, priorities_file)
+
             commands = [command + '\n' for command in commands]
-            commands_file.writelines(commands)
+            self._add_lines_to_pending(commands_file, commands)
+
+    def _get_not_before(self):
+        """ Gets the time before which each delayed command is not claimed, keyed by command. Must be called under the lock of the pending commands. """
+        if not os.path.isfile(self._not_before_filename):
+            return {}
+
+        with open(self._not_before_filename, 'r') as not_before_file:
+            return json.load(not_before_file)
+
+    def _set_not_before(self, not_before):
+        if len(not_before) == 0:
+            if os.path.isfile(self._not_before_filename):
+                os.remove(self._not_before_filename)
+            return
+
+        with open(self._not_before_filename, 'w') as not_before_file:
+            json.dump(not_before, not_before_file)
 
     def get_command_to_run(self):
+        commands = self.get_commands_to_run(1)
+        return commands[0] if len(commands) > 0 else None
+
+    def get_commands_to_run(self, nb_commands):
+        """ Claims up to `nb_commands` pending commands at once, i.e. under a single lock.
+
+        None are while the batch is paused, and delayed commands (see `set_running_commands_as_pending`) are skipped until their time.
+        """
+        if self.is_paused():
+            return []
+
         with open_with_lock(self._commands_filename, 'r+') as commands_file:
             with open_with_lock(self._running_commands_filename, 'a') as running_commands_file:
-                command = commands_file.readline()
-                if command == '':
-                    return None
-                self._move_line_between_files(commands_file, running_commands_file, command)
-        return command[:-1]
+                lines = commands_file.readlines()
+                not_before = self._get_not_before()
+                if len(not_before) == 0:
+                    commands, lines_left = lines[:nb_commands], lines[nb_commands:]
+                else:
+                    now = time.time()
+                    commands, lines_left = [], []
+                    for i, line in enumerate(lines):
+                        if len(commands) == nb_commands:
+                            lines_left += lines[i:]
+                            break
+
+                        if not_before.get(line[:-1], 0) <= now:
+                            commands.append(line)
+                            not_before.pop(line[:-1], None)
+                        else:
+                            lines_left.append(line)
+                    self._set_not_before(not_before)
+
+                if len(commands) == 0:
+                    return []
+
+                commands_file.seek(0, os.SEEK_SET)
+                commands_file.writelines(lines_left)
+                commands_file.truncate()
+                running_commands_file.writelines(commands)
+
+        return [command[:-1] for command in commands]
+
+    def get_next_start_time(self):
+        """ Gets the earliest time at which a delayed pending command can be claimed, None if no pending command is delayed. """
+        with open_with_lock(self._commands_filename, 'r+') as commands_file:
+            not_before = self._get_not_before()
+            if len(not_before) == 0:
+                return None
+
+            pending_commands = set(line[:-1] for line in commands_file)
+            times = [start_time for command, start_time in not_before.items() if command in pending_commands]
+
+        return min(times) if len(times) > 0 else None
 
     def get_nb_commands_to_run(self):
         with open(self._commands_filename, 'r') as commands_file:
             return len(commands_file.readlines())
 
+    def get_pending_commands(self):
+        commands = []
+        if os.path.isfile(self._commands_filename):
+            with open(self._commands_filename, 'r') as commands_file:
+                commands = [line[:-1] for line in commands_file]
+        return commands
+
+    def get_running_commands(self):
+        commands = []
+        if os.path.isfile(self._running_commands_filename):
+            with open(self._running_commands_filename, 'r') as commands_file:
+                commands = [line[:-1] for line in commands_file]
+        return commands
+
     def get_failed_commands(self):
         commands = []
         if os.path.isfile(self._failed_commands_filename):
@@ -48,6 +239,20 @@ class CommandManager(object):
                 commands = commands_file.readlines()
         return commands
 
+    def get_finished_commands(self):
+        commands = []
+        if os.path.isfile(self._finished_commands_filename):
+            with open(self._finished_commands_filename, 'r') as commands_file:
+                commands = [line[:-1] for line in commands_file]
+        return commands
+
+    def get_timed_out_commands(self):
+        commands = []
+        if os.path.isfile(self._timed_out_commands_filename):
+            with open(self._timed_out_commands_filename, 'r') as commands_file:
+                commands = [line[:-1] for line in commands_file]
+        return commands
+
     def set_running_command_as_finished(self, command, error_code=0):
         if error_code == 0:
             file_name = self._finished_commands_filename
@@ -58,10 +263,316 @@ class CommandManager(object):
             with open_with_lock(file_name, 'a') as finished_commands_file:
                 self._move_line_between_files(running_commands_file, finished_commands_file, command + '\n')
 
+        self._record_outcomes([error_code != 0])
+
+    def set_running_commands_as_finished(self, commands, error_codes):
+        """ Moves several running commands to the finished or failed ones, according to their exit code. """
+        if len(commands) == 0:
+            return
+
+        finished_lines = [command + '\n' for command, error_code in zip(commands, error_codes) if error_code == 0]
+        failed_lines = [command + '\n' for command, error_code in zip(commands, error_codes) if error_code != 0]
+        with open_with_lock(self._running_commands_filename, 'r+') as running_commands_file:
+            self._remove_lines_from_file(running_commands_file, finished_lines + failed_lines)
+            for file_name, lines in [(self._finished_commands_filename, finished_lines), (self._failed_commands_filename, failed_lines)]:
+                if len(lines) > 0:
+                    with open_with_lock(file_name, 'a') as commands_file:
+                        commands_file.writelines(lines)
+
+        self._record_outcomes([error_code != 0 for error_code in error_codes])
+
+    def set_running_commands_as_timed_out(self, commands):
+        """ Moves running commands killed for exceeding their time limit to the timed out ones. """
+        if len(commands) == 0:
+            return
+
+        lines = [command + '\n' for command in commands]
+        with open_with_lock(self._running_commands_filename, 'r+') as running_commands_file:
+            with open_with_lock(self._timed_out_commands_filename, 'a') as timed_out_commands_file:
+                self._remove_lines_from_file(running_commands_file, lines)
+                timed_out_commands_file.writelines(lines)
+
+        self._record_outcomes([True] * len(commands))
+
+    def discard_failed_attempts(self, commands):
+        """ Forgets the last execution of commands that failed through no fault of their own, e.g. on a bad node.
+
+        Failed commands go back to the pending ones, the others (e.g. already pending to be retried) are left
+        where they are. Neither their attempts nor the circuit breaker count this execution anymore.
+        """
+        if len(commands) == 0:
+            return
+
+        lines = []
+        if os.path.isfile(self._failed_commands_filename):
+            with open_with_lock(self._failed_commands_filename, 'r+') as failed_commands_file:
+                with open_with_lock(self._commands_filename, 'r+') as commands_file:
+                    failed_lines = failed_commands_file.readlines()
+                    lines = [command + '\n' for command in commands if command + '\n' in failed_lines]
+                    self._remove_lines_from_file(failed_commands_file, lines)
+                    self._add_lines_to_pending(commands_file, lines)
+
+        if os.path.isfile(self._attempts_filename):
+            with open_with_lock(self._attempts_filename, 'r+') as attempts_file:
+                content = attempts_file.read()
+                attempts = json.loads(content) if len(content) > 0 else {}
+                for uid in map(generate_uid_from_string, commands):
+                    if attempts.get(uid, 0) > 0:
+                        attempts[uid] -= 1
+
+                attempts_file.seek(0, os.SEEK_SET)
+                json.dump(attempts, attempts_file)
+                attempts_file.truncate()
+
+        self._discard_failed_outcomes(len(lines))
+
     def set_running_command_as_pending(self, command):
         with open_with_lock(self._running_commands_filename, 'r+') as running_commands_file:
-            with open_with_lock(self._commands_filename, 'a') as commands_file:
-                self._move_line_between_files(running_commands_file, commands_file, command + '\n')
+            with open_with_lock(self._commands_filename, 'r+') as commands_file:
+                self._remove_line_from_file(running_commands_file, command + '\n')
+                self._add_lines_to_pending(commands_file, [command + '\n'])
+
+    def set_running_commands_as_pending(self, commands, not_before=None):
+        """ Moves running commands back to the pending ones, not to be claimed before the time `not_before` if given (e.g. to retry them later). """
+        if len(commands) == 0:
+            return
+
+        lines = [command + '\n' for command in commands]
+        with open_with_lock(self._running_commands_filename, 'r+') as running_commands_file:
+            with open_with_lock(self._commands_filename, 'r+') as commands_file:
+                self._remove_lines_from_file(running_commands_file, lines)
+                self._add_lines_to_pending(commands_file, lines)
+                if not_before is not None:
+                    delays = self._get_not_before()
+                    delays.update((command, not_before) for command in commands)
+                    self._set_not_before(delays)
+
+    def add_command_timing(self, command, duration, error_code=0, **infos):
+        """ Records how long `command` took to execute along with extra `infos` (e.g. node name). """
+        timing = dict(infos, command=command, duration=duration, error_code=error_code)
+        with open_with_lock(self._timings_filename, 'a') as timings_file:
+            timings_file.write(json.dumps(timing) + '\n')
+
+    def add_commands_timings(self, commands, durations, error_codes, **infos):
+        """ Records the timing of several commands at once, sharing the same `infos`. """
+        timings = [dict(infos, command=command, duration=duration, error_code=error_code)
+                   for command, duration, error_code in zip(commands, durations, error_codes)]
+        with open_with_lock(self._timings_filename, 'a') as timings_file:
+            timings_file.writelines(json.dumps(timing) + '\n' for timing in timings)
+
+    def get_commands_timings(self):
+        timings = []
+        if os.path.isfile(self._timings_filename):
+            with open(self._timings_filename, 'r') as timings_file:
+                timings = [json.loads(line) for line in timings_file if len(line.strip()) > 0]
+        return timings
+
+    def set_retry_policy(self, retry_policy):
+        with open_with_lock(self._retry_policy_filename, 'w') as retry_policy_file:
+            json.dump(retry_policy.to_dict(), retry_policy_file)
+
+    def get_retry_policy(self):
+        if not os.path.isfile(self._retry_policy_filename):
+            return None
+
+        with open(self._retry_policy_filename, 'r') as retry_policy_file:
+            return RetryPolicy.from_dict(json.load(retry_policy_file))
+
+    def set_circuit_breaker(self, circuit_breaker):
+        with open_with_lock(self._circuit_breaker_filename, 'w') as circuit_breaker_file:
+            json.dump(circuit_breaker.to_dict(), circuit_breaker_file)
+
+    def get_circuit_breaker(self):
+        if not os.path.isfile(self._circuit_breaker_filename):
+            return None
+
+        with open(self._circuit_breaker_filename, 'r') as circuit_breaker_file:
+            return CircuitBreaker.from_dict(json.load(circuit_breaker_file))
+
+    def _record_outcomes(self, failed):
+        """ Keeps track of whether completed commands failed, pausing the batch if its circuit breaker says so. """
+        circuit_breaker = self.get_circuit_breaker()
+        if circuit_breaker is None or len(failed) == 0:
+            return
+
+        open(self._outcomes_filename, 'a').close()  # Make sure the file exists.
+        with open_with_lock(self._outcomes_filename, 'r+') as outcomes_file:
+            content = outcomes_file.read()
+            outcomes = (json.loads(content) if len(content) > 0 else []) + [int(f) for f in failed]
+            outcomes = outcomes[-circuit_breaker.window:]
+            outcomes_file.seek(0, os.SEEK_SET)
+            json.dump(outcomes, outcomes_file)
+            outcomes_file.truncate()
+
+        if circuit_breaker.should_pause(outcomes) and not self.is_paused():
+            self.pause("{0} of the last {1} completed commands failed".format(sum(outcomes), len(outcomes)))
+
+    def _discard_failed_outcomes(self, nb_failures):
+        """ Forgets the last `nb_failures` failures counted by the circuit breaker, lifting the pause they caused if any. """
+        circuit_breaker = self.get_circuit_breaker()
+        if circuit_breaker is None or nb_failures == 0 or not os.path.isfile(self._outcomes_filename):
+            return
+
+        with open_with_lock(self._outcomes_filename, 'r+') as outcomes_file:
+            content = outcomes_file.read()
+            outcomes = json.loads(content) if len(content) > 0 else []
+            for i in reversed(range(len(outcomes))):
+                if nb_failures > 0 and outcomes[i] == 1:
+                    del outcomes[i]
+                    nb_failures -= 1
+
+            outcomes_file.seek(0, os.SEEK_SET)
+            json.dump(outcomes, outcomes_file)
+            outcomes_file.truncate()
+
+        if self.is_paused() and not circuit_breaker.should_pause(outcomes):
+            os.remove(self._paused_filename)
+
+    def pause(self, reason):
+        """ Stops pending commands from being claimed until `resume` is called. """
+        with open_with_lock(self._paused_filename, 'w') as paused_file:
+            paused_file.write(reason + '\n')
+
+    def is_paused(self):
+        return os.path.isfile(self._paused_filename)
+
+    def get_pause_reason(self):
+        """ Gets why the batch was paused, None if it is not. """
+        if not self.is_paused():
+            return None
+
+        with open(self._paused_filename, 'r') as paused_file:
+            return paused_file.read().strip()
+
+    def resume(self):
+        """ Lets pending commands be claimed again, the failures that paused the batch being forgotten. """
+        for filename in [self._paused_filename, self._outcomes_filename]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def get_command_attempts(self, command):
+        """ Gets how many times `command` has been executed unsuccessfully. """
+        if not os.path.isfile(self._attempts_filename):
+            return 0
+
+        with open_with_lock(self._attempts_filename, 'r+') as attempts_file:
+            content = attempts_file.read()
+
+        attempts = json.loads(content) if len(content) > 0 else {}
+        return attempts.get(generate_uid_from_string(command), 0)
+
+    def increment_command_attempts(self, command):
+        open(self._attempts_filename, 'a').close()  # Make sure the file exists.
+        with open_with_lock(self._attempts_filename, 'r+') as attempts_file:
+            content = attempts_file.read()
+            attempts = json.loads(content) if len(content) > 0 else {}
+
+            uid = generate_uid_from_string(command)
+            attempts[uid] = attempts.get(uid, 0) + 1
+
+            attempts_file.seek(0, os.SEEK_SET)
+            json.dump(attempts, attempts_file)
+            attempts_file.truncate()
+
+        return attempts[uid]
+
+    def add_bad_node(self, node_name):
+        """ Adds a node where commands fail for reasons of its own (e.g. a broken GPU) to the ones the batch avoids. """
+        with open_with_lock(self._bad_nodes_filename, 'a') as bad_nodes_file:
+            bad_nodes_file.write(node_name + '\n')
+
+    def get_bad_nodes(self):
+        """ Gets the nodes the batch avoids, in the order they were added. """
+        nodes = []
+        if os.path.isfile(self._bad_nodes_filename):
+            with open(self._bad_nodes_filename, 'r') as bad_nodes_file:
+                for line in bad_nodes_file:
+                    if line[:-1] not in nodes:
+                        nodes.append(line[:-1])
+        return nodes
+
+    @contextmanager
+    def _speculative_commands(self):
+        """ Gives exclusive access to the running commands that can be executed speculatively, keyed by their UID. """
+        open(self._speculative_commands_filename, 'a').close()  # Make sure the file exists.
+        with open_with_lock(self._speculative_commands_filename, 'r+') as speculative_commands_file:
+            content = speculative_commands_file.read()
+            speculative_commands = json.loads(content) if len(content) > 0 else {}
+            yield speculative_commands
+
+            speculative_commands_file.seek(0, os.SEEK_SET)
+            json.dump(speculative_commands, speculative_commands_file)
+            speculative_commands_file.truncate()
+
+    def set_running_command_as_speculative(self, command, start_time):
+        """ Records when an idempotent command started running, so a copy of it can be executed if it lags behind (see `get_straggler_to_duplicate`). """
+        with self._speculative_commands() as speculative_commands:
+            speculative_commands[generate_uid_from_string(command)] = {'command': command, 'started_at': start_time, 'nb_copies': 1, 'done': False}
+
+    def get_straggler_to_duplicate(self, min_duration):
+        """ Claims a copy of the speculative command running for the longest time, if it runs for more than `min_duration` seconds.
+
+        Commands already having a copy running are left out. The first copy
+        done is kept (see `set_speculative_copy_as_done`).
+
+        Returns
+        -------
+        command : str
+            command to execute again, None if no command lags behind
+        wait_time : float
+            seconds before the next command lags behind, None if no command can
+        """
+        running_commands = set(self.get_running_commands())
+        with self._speculative_commands() as speculative_commands:
+            candidates = [candidate for candidate in speculative_commands.values()
+                          if not candidate['done'] and candidate['nb_copies'] == 1 and candidate['command'] in running_commands]
+            if len(candidates) == 0:
+                return None, None
+
+            straggler = min(candidates, key=lambda candidate: candidate['started_at'])
+            wait_time = straggler['started_at'] + min_duration - time.time()
+            if wait_time > 0:
+                return None, wait_time
+
+            straggler['nb_copies'] += 1
+            return straggler['command'], 0
+
+    def is_speculative_command_done(self, command):
+        """ Tells whether a copy of a speculative command is done, i.e. its other copies can be terminated. """
+        with self._speculative_commands() as speculative_commands:
+            return speculative_commands.get(generate_uid_from_string(command), {}).get('done', False)
+
+    def set_speculative_copy_as_done(self, command, error_code):
+        """ Tells whether the result of a copy of a command is kept, i.e. it is the first to succeed or the last to fail.
+
+        Commands that are not speculative have a single copy, always kept.
+        """
+        return self._release_speculative_copy(command, error_code)
+
+    def release_speculative_copy(self, command):
+        """ Tells whether a copy of a command being interrupted is the last one, i.e. the command must be handled (e.g. resumed). """
+        return self._release_speculative_copy(command, None)
+
+    def _release_speculative_copy(self, command, error_code):
+        uid = generate_uid_from_string(command)
+        with self._speculative_commands() as speculative_commands:
+            if uid not in speculative_commands:
+                return True
+
+            speculative_command = speculative_commands[uid]
+            speculative_command['nb_copies'] -= 1
+            is_last_copy = speculative_command['nb_copies'] <= 0
+            if is_last_copy:
+                del speculative_commands[uid]
+
+            if speculative_command['done']:
+                return False  # Another copy is kept.
+
+            if error_code == 0 or (error_code is not None and is_last_copy):
+                speculative_command['done'] = True
+                return True
+
+            return is_last_copy and error_code is None
 
     def reset_running_commands(self):
         if os.path.isfile(self._running_commands_filename):
@@ -72,6 +583,4 @@ class CommandManager(object):
                         running_commands_file.seek(0, os.SEEK_SET)
                         running_commands_file.truncate()
 
-                        commands += commands_file.readlines()
-                        commands_file.seek(0, os.SEEK_SET)
-                        commands_file.writelines(commands)
+                        self._add_lines_to_pending(commands_file, commands, before_ties=True)
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+
+import os
+import glob
+from os.path import join as pjoin
+
+from smartdispatch import utils
+from smartdispatch.command_manager import CommandManager
+from smartdispatch.filelock import open_with_lock
+
+COMPLETION_INDEX_FILENAME = "completed_commands.txt"
+
+
+class CompletionIndex(object):
+
+    """ UIDs of the commands that succeeded in any batch.
+
+    The index is kept in the SMART_DISPATCH_LOGS folder, one UID per line,
+    and is updated from the finished commands of every batch folder so
+    completions are remembered even if a batch folder gets deleted.
+
+    Parameters
+    ----------
+    path_smartdispatch_logs : str
+        path to the SMART_DISPATCH_LOGS folder
+    """
+
+    def __init__(self, path_smartdispatch_logs):
+        self.path_smartdispatch_logs = path_smartdispatch_logs
+        self.index_filename = pjoin(path_smartdispatch_logs, COMPLETION_INDEX_FILENAME)
+        self.uids = set()
+
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, 'r') as index_file:
+                self.uids = set(line.strip() for line in index_file)
+
+    def update(self):
+        """ Adds the commands that succeeded in the batch folders to the index. """
+        new_uids = set()
+        for finished_filename in glob.glob(pjoin(self.path_smartdispatch_logs, '*', 'commands', 'finished_commands.txt')):
+            command_manager = CommandManager(finished_filename.replace("finished_commands.txt", "commands.txt"))
+            new_uids.update(map(utils.generate_uid_from_string, command_manager.get_finished_commands()))
+
+        new_uids -= self.uids
+        if len(new_uids) == 0:
+            return
+
+        with open_with_lock(self.index_filename, 'a') as index_file:
+            index_file.writelines(uid + '\n' for uid in sorted(new_uids))
+
+        self.uids |= new_uids
+
+    def __contains__(self, command):
+        return utils.generate_uid_from_string(command) in self.uids
+
+    def __len__(self):
+        return len(self.uids)
+
+
+def are_outputs_up_to_date(command):
+    ''' Tells if the outputs declared by a command exist and are newer than its inputs.
+
+    Outputs and inputs are declared as comma separated paths in the
+    annotations of the command (e.g. "#sd: outputs=model.pkl inputs=data.csv").
+
+    Returns
+    -------
+    up_to_date : bool
+        False if the command declares no outputs
+    '''
+    annotations = utils.get_command_annotations(command)
+    if annotations.get('outputs', True) is True:
+        return False
+
+    outputs = annotations['outputs'].split(',')
+    inputs = annotations['inputs'].split(',') if annotations.get('inputs', True) is not True else []
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+
+    if not all(os.path.exists(input_) for input_ in inputs):
+        return False  # Inputs still to be produced.
+
+    oldest_output = min(os.path.getmtime(output) for output in outputs)
+    return all(os.path.getmtime(input_) <= oldest_output for input_ in inputs)
+
+
+def filter_completed_commands(commands, completion_index):
+    ''' Removes commands that already succeeded or are duplicates.
+
+    Parameters
+    ----------
+    commands : list of str
+        commands to launch
+    completion_index : `CompletionIndex` instance
+        commands that succeeded in previous batches
+
+    Returns
+    -------
+    commands : list of str
+        commands left to launch, in their original order
+    nb_completed : int
+        number of commands removed since already completed
+    nb_duplicates : int
+        number of commands removed since launched twice
+    '''
+    commands_to_launch = []
+    launched = set()
+    nb_completed = 0
+    nb_duplicates = 0
+    for command in commands:
+        if command in launched:
+            nb_duplicates += 1
+        elif command in completion_index or are_outputs_up_to_date(command):
+            nb_completed += 1
+        else:
+            commands_to_launch.append(command)
+            launched.add(command)
+
+    return commands_to_launch, nb_completed, nb_duplicates
@@ -0,0 +1,310 @@
+from __future__ import absolute_import
+
+import re
+import glob
+import heapq
+import math
+from os.path import join as pjoin
+from collections import defaultdict
+
+from smartdispatch import utils
+from smartdispatch.command_manager import CommandManager
+
+regex_uid = re.compile(r"\b[0-9a-f]{32,}\b")
+regex_number = re.compile(r"(?<![A-Za-z_])[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+
+
+def normalize_command(command):
+    ''' Normalizes a command into a template shared by similar commands.
+
+    Unique identifiers are replaced by "{UID}" and numbers by "{NUM}" so that
+    commands of a same sweep (e.g. only differing by their hyperparameters)
+    end up with the same template.
+
+    Parameters
+    ----------
+    command : str
+        command to normalize
+
+    Returns
+    -------
+    template : str
+        normalized command
+    '''
+    template = regex_uid.sub("{UID}", command)
+    template = regex_number.sub("{NUM}", template)
+    return " ".join(template.split())
+
+
+def get_batch_timings(path_job):
+    """ Gets the timings of every command executed in a batch folder. """
+    command_manager = CommandManager(pjoin(path_job, "commands", "commands.txt"))
+    return command_manager.get_commands_timings()
+
+
+class CommandHistory(object):
+
+    """ Durations of the commands executed in previous batches.
+
+    Durations are gathered from every batch folder found in the
+    SMART_DISPATCH_LOGS folder and are keyed by normalized command
+    (see `normalize_command`).
+
+    Parameters
+    ----------
+    path_smartdispatch_logs : str
+        path to the SMART_DISPATCH_LOGS folder
+    batch_uid : str
+        only use the durations of this batch (Default: every batch)
+    """
+
+    def __init__(self, path_smartdispatch_logs, batch_uid='*'):
+        self.path_smartdispatch_logs = path_smartdispatch_logs
+        self.durations = defaultdict(list)
+        self.exact_durations = defaultdict(list)
+
+        for timings_filename in sorted(glob.glob(pjoin(path_smartdispatch_logs, batch_uid, 'commands', 'timings_commands.txt'))):
+            command_manager = CommandManager(timings_filename.replace("timings_commands.txt", "commands.txt"))
+            self.add_timings(command_manager.get_commands_timings())
+
+    def add_timings(self, timings):
+        for timing in timings:
+            # Failed commands are not representative of the normal duration.
+            if timing['error_code'] == 0:
+                self.durations[normalize_command(timing['command'])].append(timing['duration'])
+                self.exact_durations[timing['command']].append(timing['duration'])
+
+    def estimate_duration(self, command, default=None):
+        """ Estimates the duration of `command` using the median duration of the same command, or else of similar commands. """
+        durations = sorted(self.exact_durations.get(command, []))
+        if len(durations) == 0:
+            durations = sorted(self.durations.get(normalize_command(command), []))
+
+        if len(durations) == 0:
+            return default
+
+        return durations[len(durations) // 2]
+
+    def __len__(self):
+        return sum(map(len, self.durations.values()))
+
+
+def compute_makespan(durations, pool):
+    """ Computes the makespan of `pool` workers consuming commands in order. """
+    workers = [0.] * min(pool, len(durations))
+    for duration in durations:
+        heapq.heapreplace(workers, workers[0] + duration)
+
+    return max(workers) if len(workers) > 0 else 0.
+
+
+def get_smallest_pool(durations, target_makespan):
+    """ Gets the smallest pool for which the makespan is within the target (at least the longest command). """
+    low = max(1, min(len(durations), int(math.ceil(float(sum(durations)) / target_makespan))))
+    high = len(durations)
+    while low < high:
+        pool = (low + high) // 2
+        if compute_makespan(durations, pool) <= target_makespan:
+            high = pool
+        else:
+            low = pool + 1
+
+    return low
+
+
+def suggest_pool_and_walltime(durations, target_makespan, max_walltime=None, margin=0.2):
+    ''' Suggests a pool size and a walltime achieving a target makespan.
+
+    Parameters
+    ----------
+    durations : list of float
+        estimated duration (in seconds) of every command, in execution order
+    target_makespan : float
+        wanted time (in seconds) to execute every command
+    max_walltime : float
+        maximum walltime (in seconds) allowed by the queue (Default: inf)
+    margin : float
+        safety margin added to the estimated makespan to get the walltime
+
+    Returns
+    -------
+    pool : int
+        number of workers needed
+    walltime : str
+        walltime to request (DD:HH:MM:SS)
+    explanation : list of str
+        how `pool` and `walltime` were derived
+    '''
+    nb_commands = len(durations)
+    total = sum(durations)
+    longest = max(durations)
+    explanation = ["{0} command(s) totaling {1} of estimated work, longest is {2}.".format(
+        nb_commands, utils.seconds_to_walltime(total), utils.seconds_to_walltime(longest))]
+
+    if longest > target_makespan:
+        explanation.append("Target makespan of {0} is shorter than the longest command, using {1} instead.".format(
+            utils.seconds_to_walltime(target_makespan), utils.seconds_to_walltime(longest)))
+        target_makespan = longest
+
+    pool = get_smallest_pool(durations, target_makespan)
+    makespan = compute_makespan(durations, pool)
+    explanation.append("A pool of {0} worker(s) executes everything in {1} (target: {2}).".format(
+        pool, utils.seconds_to_walltime(makespan), utils.seconds_to_walltime(target_makespan)))
+
+    walltime = makespan * (1 + margin)
+    walltime = 60 * math.ceil(walltime / 60.)  # Round up to the minute.
+    explanation.append("Walltime is the estimated makespan plus a {0:.0%} safety margin: {1}.".format(
+        margin, utils.seconds_to_walltime(walltime)))
+
+    if max_walltime is not None and walltime > max_walltime:
+        walltime = max_walltime
+        explanation.append("Walltime capped to the queue's maximum ({0}), consider using --autoresume.".format(
+            utils.seconds_to_walltime(max_walltime)))
+
+    return pool, utils.seconds_to_walltime(walltime), explanation
+
+
+def suggest_backfill_shape(durations, walltimes, start_delays=None, margin=0.2):
+    ''' Suggests the walltime and the pool of short jobs executing the commands.
+
+    Short jobs are more easily backfilled by the scheduler, the work left when
+    they reach their walltime being moved to the next ones by autoresume. For
+    each candidate walltime, the pool is the smallest one executing the
+    commands within a walltime (minus a safety margin), or within the longest
+    command if it is longer. Everything is then estimated to be done after
+    the makespan of this pool plus a wait in the queue per round of jobs. The
+    walltime with the shortest estimate is suggested, or the one needing the
+    fewest rounds, then the shortest one, in case of ties.
+
+    Parameters
+    ----------
+    durations : list of float
+        estimated duration (in seconds) of every command, in execution order
+    walltimes : list of float
+        candidate walltimes (in seconds) of the jobs
+    start_delays : list of float
+        estimated time (in seconds) before a job of each candidate walltime starts (Default: 0)
+    margin : float
+        part of the walltime kept as a safety margin
+
+    Returns
+    -------
+    pool : int
+        number of workers needed
+    walltime : str
+        walltime to request (DD:HH:MM:SS)
+    explanation : list of str
+        how `pool` and `walltime` were derived
+    '''
+    longest = max(durations)
+    explanation = ["{0} command(s) totaling {1} of estimated work, longest is {2}.".format(
+        len(durations), utils.seconds_to_walltime(sum(durations)), utils.seconds_to_walltime(longest))]
+
+    shapes = []
+    for i, walltime in enumerate(walltimes):
+        start_delay = 0. if start_delays is None else start_delays[i]
+        work_time = walltime / (1 + margin)
+        pool = get_smallest_pool(durations, max(work_time, longest))
+        makespan = compute_makespan(durations, pool)
+        nb_rounds = int(math.ceil(makespan / work_time))
+        estimate = makespan + nb_rounds * start_delay
+        shapes.append((estimate, nb_rounds, walltime, pool))
+
+        explanation.append("Jobs of {0}: {1} worker(s), {2} round(s) of jobs{3}, everything done in ~{4}.".format(
+            utils.seconds_to_walltime(walltime), pool, nb_rounds,
+            "" if start_delays is None else " starting ~{0} after submission".format(utils.seconds_to_walltime(start_delay)),
+            utils.seconds_to_walltime(estimate)))
+
+    _, _, walltime, pool = min(shapes)
+    return pool, utils.seconds_to_walltime(walltime), explanation
+
+
+def estimate_durations(commands, path_smartdispatch_logs, batch_uid='*'):
+    ''' Estimates the duration of commands from the ones executed in previous batches.
+
+    Commands without history are assumed to take the median duration of the
+    commands having some.
+
+    Parameters
+    ----------
+    commands : list of str
+        commands whose duration is estimated
+    path_smartdispatch_logs : str
+        path to the SMART_DISPATCH_LOGS folder
+    batch_uid : str
+        only use the durations of this batch (Default: every batch)
+
+    Returns
+    -------
+    durations : list of float
+        estimated duration (in seconds) of every command, None if no command has history
+    explanation : list of str
+        how commands without history were estimated
+    '''
+    history = CommandHistory(path_smartdispatch_logs, batch_uid=batch_uid)
+    durations = map(history.estimate_duration, commands)
+    known_durations = sorted(duration for duration in durations if duration is not None)
+    if len(known_durations) == 0:
+        return None, []
+
+    median_duration = known_durations[len(known_durations) // 2]
+    explanation = []
+    nb_unknown = len(durations) - len(known_durations)
+    if nb_unknown > 0:
+        explanation.append("{0} command(s) without history are assumed to take the median duration ({1}).".format(
+            nb_unknown, utils.seconds_to_walltime(median_duration)))
+
+    return [median_duration if duration is None else duration for duration in durations], explanation
+
+
+def get_commands_priorities(commands, path_smartdispatch_logs, order="fifo", costs_from=None):
+    ''' Gets the priority, i.e. (priority, estimated cost), of every command.
+
+    Priorities come from the "#sd: priority=N" annotations. With the "lpt"
+    order, costs come from the "#sd: cost=[[[DD:]HH:]MM:]SS" annotations or
+    else from the durations of previous batches.
+
+    Parameters
+    ----------
+    commands : list of str
+        commands to prioritize
+    path_smartdispatch_logs : str
+        path to the SMART_DISPATCH_LOGS folder
+    order : str
+        "fifo" to execute commands in order, "lpt" to execute the longest estimated first
+    costs_from : str
+        only estimate costs from the durations of this batch (Default: every batch)
+
+    Returns
+    -------
+    priorities : list of tuple
+        (priority, cost) of every command, None to keep them in order
+
+    Raises
+    ------
+    ValueError
+        if a priority or cost annotation has an invalid value
+    '''
+    annotations = map(utils.get_command_annotations, commands)
+    priorities = []
+    for command, annotation in zip(commands, annotations):
+        try:
+            priorities.append(float(str(annotation.get('priority', 0))))  # A bare flag (True) is not a priority.
+        except ValueError:
+            raise ValueError("Invalid priority annotation, expected priority=N: {0}".format(command))
+
+    if order != "lpt":
+        return None if all(priority == 0 for priority in priorities) else zip(priorities, [0.] * len(commands))
+
+    costs, _ = estimate_durations(commands, path_smartdispatch_logs, batch_uid='*' if costs_from is None else costs_from)
+    costs = [0.] * len(commands) if costs is None else costs
+
+    # Costs provided in the annotations have precedence over the history.
+    for i, (command, annotation) in enumerate(zip(commands, annotations)):
+        if 'cost' in annotation:
+            try:
+                costs[i] = utils.walltime_to_seconds(annotation['cost'])
+            except ValueError:
+                raise ValueError("Invalid cost annotation, expected cost=[[[DD:]HH:]MM:]SS: {0}".format(command))
+
+    return zip(priorities, costs)
@@ -4,6 +4,7 @@ import os
 import re
 from smartdispatch.pbs import PBS
 from smartdispatch import utils
+from smartdispatch import staging
 
 
 def job_generator_factory(queue, commands, prolog=[], epilog=[], command_params={}, cluster_name=None, base_path="./"):
@@ -42,6 +43,7 @@ class JobGenerator(object):
         self.commands = commands
         self.epilog = epilog
         self.queue = queue
+        self.base_path = base_path
         self.job_log_filename = '"{base_path}/logs/job/"$PBS_JOBID".{{ext}}"'.format(base_path=base_path)
 
         self.nb_cores_per_command = command_params.get('nb_cores_per_command', 1)
@@ -73,6 +75,30 @@ class JobGenerator(object):
             pbs.add_resources(**resources)
             pbs.add_options(**options)
 
+    def add_staging(self, stage_in=[], stage_out=[], destination="./"):
+        """ Copies inputs to the node-local scratch before the commands and syncs outputs back after them.
+
+        The scratch is shared by the jobs running on a node whose PBS files are in the same
+        `base_path`, i.e. of the same batch, and outputs synced back are listed in this folder.
+
+        Parameters
+        ----------
+        stage_in : list of str
+            files or folders copied once per node (see `staging.get_stage_in_prolog`)
+        stage_out : list of str
+            glob patterns of the outputs synced back, and copied back to the scratch of
+            resumed commands (see `staging.get_stage_out_epilog`)
+        destination : str
+            folder where outputs are synced back
+        """
+        name = os.path.basename(os.path.abspath(self.base_path))
+        manifest_filename = os.path.join(self.base_path, staging.STAGED_OUTPUTS_FILENAME)
+        for pbs in self.pbs_list:
+            pbs.add_to_prolog(*staging.get_stage_in_prolog(stage_in, name))
+            pbs.add_to_prolog(*staging.get_stage_out_prolog(stage_out, destination, manifest_filename))
+            pbs.add_to_epilog(*staging.get_stage_out_epilog(stage_out, destination))
+            pbs.add_to_epilog(*staging.get_scratch_epilog())
+
     def _generate_base_pbs(self):
         """ Generates PBS files allowing the execution of every commands on the given queue. """
         nb_commands_per_node = self.queue.nb_cores_per_node // self.nb_cores_per_command
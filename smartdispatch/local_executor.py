@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import signal
+import multiprocessing
+from subprocess import Popen
+
+from smartdispatch import utils
+
+regex_pbs_option = re.compile(r"^#PBS -(\w) (.*)$", re.MULTILINE)
+regex_pbs_resource = re.compile(r"^#PBS -l (\w+)=(.*)$", re.MULTILINE)
+regex_ppn = re.compile(r"ppn=(\d+)")
+regex_worker_line = re.compile(r"^.*base_worker\.py.*$\n?", re.MULTILINE)
+
+TIME_BETWEEN_POLLS = 0.1  # In seconds
+
+
+def get_pbs_infos(pbs_filename):
+    """ Gets the options and the resources of a PBS file. """
+    with open(pbs_filename, 'r') as pbs_file:
+        pbs = pbs_file.read()
+
+    return dict(regex_pbs_option.findall(pbs)), dict(regex_pbs_resource.findall(pbs))
+
+
+class LocalJob(object):
+
+    """ A PBS file executed on the current machine, possibly only some of its workers.
+
+    Parameters
+    ----------
+    pbs_filename : str
+        PBS file to execute
+    job_id : str
+        ID given to the job (i.e. $PBS_JOBID)
+    workers : list of int
+        index of the workers of the PBS file to start (Default: all of them)
+    """
+
+    def __init__(self, pbs_filename, job_id, workers=None):
+        self.pbs_filename = pbs_filename
+        self.job_id = job_id
+
+        with open(pbs_filename, 'r') as pbs_file:
+            self.pbs = pbs_file.read()
+
+        options, resources = get_pbs_infos(pbs_filename)
+        match = regex_ppn.search(resources.get('nodes', ''))
+        nb_cores = int(match.group(1)) if match is not None else 1
+        self.walltime = utils.walltime_to_seconds(resources['walltime']) if 'walltime' in resources else None
+
+        # The cores of a job are split evenly between its workers, if any.
+        nb_initial_workers = len(regex_worker_line.findall(self.pbs))
+        self.workers = range(nb_initial_workers) if workers is None else workers
+        self.nb_cores_per_worker = max(nb_cores // nb_initial_workers, 1) if nb_initial_workers > 0 else nb_cores
+        self.nb_cores = self.nb_cores_per_worker * len(self.workers) if nb_initial_workers > 0 else nb_cores
+
+        # Log files (e.g. "path/logs/job/"$PBS_JOBID".out") are shell expressions.
+        self.stdout_filename = self._expand(options.get('o', os.devnull))
+        self.stderr_filename = self._expand(options.get('e', os.devnull))
+
+        self.proc = None
+        self.start_time = None
+        self.script_filename = None
+
+    def _expand(self, filename):
+        return filename.replace('"', '').replace('$PBS_JOBID', self.job_id)
+
+    def split(self, nb_workers):
+        """ Splits this job into one starting its first `nb_workers` workers and one starting the others. """
+        stem = self.job_id[:-len(".local")]
+        return (LocalJob(self.pbs_filename, self.job_id, self.workers[:nb_workers]),
+                LocalJob(self.pbs_filename, "{0}_{1}.local".format(stem, nb_workers), self.workers[nb_workers:]))
+
+    def start(self):
+        env = dict(os.environ, PBS_JOBID=self.job_id, PBS_FILENAME=self.pbs_filename, PBS_O_WORKDIR=os.getcwd())
+        if self.walltime is not None:
+            env['PBS_WALLTIME'] = str(self.walltime)
+
+        # Workers not started by this job are left out of a copy of the PBS file.
+        script_filename = self.pbs_filename
+        worker_lines = regex_worker_line.findall(self.pbs)
+        if len(self.workers) < len(worker_lines):
+            pbs = self.pbs
+            for i, worker_line in enumerate(worker_lines):
+                if i not in self.workers:
+                    pbs = pbs.replace(worker_line, "", 1)
+
+            self.script_filename = script_filename = "{0}.{1}".format(self.pbs_filename, self.job_id)
+            with open(script_filename, 'w') as script_file:
+                script_file.write(pbs)
+
+        with open(self.stdout_filename, 'a') as stdout_file:
+            with open(self.stderr_filename, 'a') as stderr_file:
+                # Own process group so the whole job can be killed when reaching the walltime.
+                self.proc = Popen(['bash', script_filename], stdout=stdout_file, stderr=stderr_file, env=env, preexec_fn=os.setsid)
+
+        self.start_time = time.time()
+
+    def poll(self):
+        """ Checks if the job is done, killing it if it exceeded its walltime. """
+        if self.walltime is not None and time.time() - self.start_time > self.walltime:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass  # Already done.
+
+        returncode = self.proc.poll()
+        if returncode is not None and self.script_filename is not None and os.path.isfile(self.script_filename):
+            os.remove(self.script_filename)
+
+        return returncode
+
+
+def launch_jobs_locally(pbs_filenames, nb_cores=None):
+    ''' Executes PBS files on the current machine instead of submitting them.
+
+    Jobs are executed in order, as many workers at the same time as the local
+    cores allow given the cores of each worker (i.e. the ppn of its job split
+    between its workers), whatever their job. Workers of a job that do not fit
+    are started later, as another job. This call blocks until every job is done.
+
+    Parameters
+    ----------
+    pbs_filenames : list of str
+        PBS files to execute
+    nb_cores : int
+        number of local cores to use (Default: every core)
+
+    Returns
+    -------
+    jobs_id : list of str
+        ID given to each job, including the ones started for workers that did not fit
+    '''
+    if nb_cores is None:
+        nb_cores = multiprocessing.cpu_count()
+
+    timestamp = time.strftime("%Y%m%d%H%M%S")
+    pending_jobs = [LocalJob(pbs_filename, "{0}-{1}.local".format(timestamp, i)) for i, pbs_filename in enumerate(pbs_filenames)]
+
+    jobs = []
+    running_jobs = []
+    while len(pending_jobs) > 0 or len(running_jobs) > 0:
+        running_jobs = [job for job in running_jobs if job.poll() is None]
+        nb_free_cores = nb_cores - sum(min(job.nb_cores, nb_cores) for job in running_jobs)
+
+        while len(pending_jobs) > 0:
+            job = pending_jobs[0]
+            if len(job.workers) > 1 and job.nb_cores > nb_free_cores:
+                # Start the workers that fit, the others wait for free cores.
+                nb_workers = nb_free_cores // job.nb_cores_per_worker
+                if nb_workers == 0 and len(running_jobs) > 0:
+                    break
+
+                # A worker requesting more cores than available runs alone.
+                nb_workers = max(nb_workers, 1)
+
+                job, pending_jobs[0] = job.split(nb_workers)
+            elif min(job.nb_cores, nb_cores) > nb_free_cores:
+                break
+            else:
+                pending_jobs.pop(0)
+
+            job.start()
+            jobs.append(job)
+            running_jobs.append(job)
+            nb_free_cores -= min(job.nb_cores, nb_cores)
+
+        time.sleep(TIME_BETWEEN_POLLS)
+
+    return [job.job_id for job in jobs]
@@ -0,0 +1,149 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import errno
+import signal
+import runpy
+import logging
+import importlib
+import traceback
+from distutils.spawn import find_executable
+
+from smartdispatch import utils
+
+
+def preload_modules(modules):
+    """ Imports modules so they are already loaded in the processes forked afterward. """
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logging.warn("Cannot preload module {0}: {1}".format(module, e))
+
+
+def get_python_entry_point(command):
+    ''' Parses a command executing a Python script or module with this interpreter.
+
+    Only simple commands are recognized, i.e. "python script.py [args]" or
+    "python -m module [args]" without any shell construct, whose interpreter
+    is the one running this process.
+
+    Returns
+    -------
+    entry_point : tuple
+        ('script', path, argv) or ('module', name, argv); None if the command
+        must be executed by the shell
+    '''
+    argv = utils.get_command_argv(command)
+    if argv is None or len(argv) < 2 or not os.path.basename(argv[0]).startswith("python"):
+        return None
+
+    if os.path.realpath(find_executable(argv[0])) != os.path.realpath(sys.executable):
+        return None
+
+    if argv[1] == "-m" and len(argv) >= 3:
+        return 'module', argv[2], [argv[2]] + argv[3:]
+    elif not argv[1].startswith("-"):
+        return 'script', argv[1], argv[1:]
+
+    return None
+
+
+def _run_entry_point(entry_point):
+    kind, target, argv = entry_point
+    sys.argv = list(argv)
+    if kind == 'module':
+        sys.path[0] = os.getcwd()
+        runpy.run_module(target, run_name="__main__", alter_sys=True)
+    else:
+        sys.path[0] = os.path.dirname(os.path.abspath(target))
+        runpy.run_path(target, run_name="__main__")
+
+
+class ForkedProcess(object):
+
+    """ A Python command executed in a fork of the current process.
+
+    Behaves like a `subprocess.Popen` instance: `wait` and `poll` return the
+    exit code of the command, or -N if it was killed by signal N.
+
+    Parameters
+    ----------
+    entry_point : tuple
+        Python script or module to execute (see `get_python_entry_point`)
+    stdout : file
+        file where the output of the command is written
+    stderr : file
+        file where the errors of the command are written
+    env : dict
+        environment of the command (Default: the one of this process)
+    preexec_fn : callable
+        called in the forked process before executing the command
+    new_process_group : bool
+        execute the command in its own process group
+    """
+
+    def __init__(self, entry_point, stdout, stderr, env=None, preexec_fn=None, new_process_group=False):
+        self.returncode = None
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if new_process_group:
+                    os.setpgid(0, 0)
+                os.dup2(stdout.fileno(), 1)
+                os.dup2(stderr.fileno(), 2)
+                sys.stdout, sys.stderr = os.fdopen(1, 'w'), os.fdopen(2, 'w', 0)
+                if env is not None:
+                    os.environ.clear()
+                    os.environ.update(env)
+                if preexec_fn is not None:
+                    preexec_fn()
+
+                _run_entry_point(entry_point)
+                exit_code = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    exit_code = e.code or 0
+                else:
+                    sys.stderr.write(str(e.code) + "\n")
+            except:
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(exit_code)
+
+    def _set_returncode(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self._set_returncode(status)
+
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                _, status = os.waitpid(self.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:  # Interrupted by a signal, e.g. SIGTERM.
+                    continue
+                raise
+
+            self._set_returncode(status)
+
+        return self.returncode
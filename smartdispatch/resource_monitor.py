@@ -0,0 +1,142 @@
+import math
+import resource
+import threading
+
+import psutil
+
+
+class ResourceMonitor(threading.Thread):
+
+    """ Samples the resources used by a process and all its descendants.
+
+    CPU time is taken from the resource usage of the terminated children of
+    the current process when available (i.e. exact), otherwise from the samples.
+
+    Parameters
+    ----------
+    pid : int
+        process to monitor
+    interval : float
+        seconds between two samples
+    """
+
+    def __init__(self, pid, interval=30.):
+        super(ResourceMonitor, self).__init__()
+        self.daemon = True
+
+        self.pid = pid
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        self._cpu_times = {}
+        self._io_counters = {}
+        self.peak_rss = 0
+        self.max_threads = 0
+        self.nb_samples = 0
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def sample(self):
+        """ Samples the resources used by the process tree. """
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return  # Process is done.
+
+        rss = 0
+        threads = 0
+        for process in processes:
+            try:
+                cpu_times = process.cpu_times()
+                self._cpu_times[process.pid] = cpu_times.user + cpu_times.system
+                rss += process.memory_info().rss
+                threads += process.num_threads()
+                io_counters = process.io_counters()
+                self._io_counters[process.pid] = (io_counters.read_bytes, io_counters.write_bytes)
+            except (psutil.Error, AttributeError, NotImplementedError):
+                continue  # Process is done or information not available on this platform.
+
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_threads = max(self.max_threads, threads)
+        self.nb_samples += 1
+
+    def stop(self):
+        """ Stops sampling and returns the resources used (see `get_usage`). """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        return self.get_usage()
+
+    def get_usage(self):
+        """ Gets the CPU time (sec), peak RSS (bytes), max threads and I/O (bytes) used so far. """
+        end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = (end_rusage.ru_utime - self._start_rusage.ru_utime) + (end_rusage.ru_stime - self._start_rusage.ru_stime)
+
+        return {'cpu_time': max(cpu_time, sum(self._cpu_times.values())),
+                'peak_rss': self.peak_rss,
+                'max_threads': self.max_threads,
+                'read_bytes': sum(read_bytes for read_bytes, _ in self._io_counters.values()),
+                'write_bytes': sum(write_bytes for _, write_bytes in self._io_counters.values())}
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(percentile * len(values))) - 1)]
+
+
+def recommend_resources(timings, memory_margin=0.2):
+    ''' Recommends cores and memory per command from the resources used by executed commands.
+
+    Parameters
+    ----------
+    timings : list of dict
+        timing data of the executed commands (see `CommandManager.get_commands_timings`)
+    memory_margin : float
+        safety margin added to the memory used
+
+    Returns
+    -------
+    recommendations : dict
+        cores per command, memory per command (in Gb) and the statistics they are based on;
+        None if no resource usage was recorded
+    '''
+    usages = [timing for timing in timings if 'cpu_time' in timing and timing['duration'] > 0]
+    if len(usages) == 0:
+        return None
+
+    # Average number of cores busy during the execution of a command.
+    parallelisms = [usage['cpu_time'] / usage['duration'] for usage in usages]
+    peak_rss = [usage['peak_rss'] / 1024. ** 3 for usage in usages]
+
+    return {'nb_commands': len(usages),
+            'cores_per_command': max(1, int(math.ceil(_percentile(parallelisms, 0.9) - 0.1))),
+            'mem_per_command': math.ceil(10 * _percentile(peak_rss, 0.95) * (1 + memory_margin)) / 10.,
+            'median_parallelism': _percentile(parallelisms, 0.5),
+            'p90_parallelism': _percentile(parallelisms, 0.9),
+            'median_peak_rss': _percentile(peak_rss, 0.5),
+            'p95_peak_rss': _percentile(peak_rss, 0.95),
+            'max_threads': max(usage['max_threads'] for usage in usages),
+            'read_bytes': sum(usage['read_bytes'] for usage in usages),
+            'write_bytes': sum(usage['write_bytes'] for usage in usages)}
+
+
+def format_recommendations(recommendations):
+    """ Formats resource recommendations in a human readable way. """
+    lines = ["Resources used by {nb_commands} command(s):",
+             "  Cores busy per command: {median_parallelism:.2f} (median), {p90_parallelism:.2f} (90th percentile)",
+             "  Peak memory per command: {median_peak_rss:.2f}Gb (median), {p95_peak_rss:.2f}Gb (95th percentile)",
+             "  Most threads used by a command: {max_threads}",
+             "  Total read: {read_gb:.2f}Gb, total written: {write_gb:.2f}Gb",
+             "Recommendations for the next launch:",
+             "  --coresPerCommand {cores_per_command}",
+             "  Memory per command: {mem_per_command:.1f}Gb"]
+
+    return "\n".join(lines).format(read_gb=recommendations['read_bytes'] / 1024. ** 3,
+                                   write_gb=recommendations['write_bytes'] / 1024. ** 3,
+                                   **recommendations)
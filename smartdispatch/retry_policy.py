@@ -0,0 +1,52 @@
+class RetryPolicy(object):
+
+    """ Decides whether a failed command should be executed again.
+
+    Parameters
+    ----------
+    max_attempts : int
+        maximum number of times a command is executed (Default: no retry)
+    retry_on_exit_codes : list of int
+        only retry commands failing with one of these exit codes (Default: any)
+    never_retry_on_exit_codes : list of int
+        never retry commands failing with one of these exit codes
+    backoff : float
+        seconds to wait before the first retry
+    backoff_factor : float
+        multiplies the waiting time after each retry
+    """
+
+    def __init__(self, max_attempts=1, retry_on_exit_codes=None, never_retry_on_exit_codes=[], backoff=0., backoff_factor=2.):
+        if max_attempts < 1:
+            raise ValueError("A command must be attempted at least once.")
+
+        self.max_attempts = max_attempts
+        self.retry_on_exit_codes = retry_on_exit_codes
+        self.never_retry_on_exit_codes = never_retry_on_exit_codes
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+
+    def should_retry(self, error_code, attempt):
+        """ Tells if a command that failed with `error_code` on its `attempt`-th execution should be retried. """
+        if error_code == 0 or attempt >= self.max_attempts:
+            return False
+
+        if error_code in self.never_retry_on_exit_codes:
+            return False
+
+        return self.retry_on_exit_codes is None or error_code in self.retry_on_exit_codes
+
+    def get_backoff(self, attempt):
+        """ Gets the seconds to wait before retrying a command that failed on its `attempt`-th execution. """
+        return self.backoff * self.backoff_factor ** (attempt - 1)
+
+    def to_dict(self):
+        return {'max_attempts': self.max_attempts,
+                'retry_on_exit_codes': self.retry_on_exit_codes,
+                'never_retry_on_exit_codes': self.never_retry_on_exit_codes,
+                'backoff': self.backoff,
+                'backoff_factor': self.backoff_factor}
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        return cls(**dictionary)
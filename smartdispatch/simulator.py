@@ -0,0 +1,257 @@
+from __future__ import absolute_import
+
+import heapq
+import random
+from collections import deque
+
+from smartdispatch import utils
+from smartdispatch.history import CommandHistory
+from smartdispatch.job_generator import job_generator_factory
+
+
+class ConstantDurations(object):
+
+    """ Every command takes `duration` seconds. """
+
+    def __init__(self, duration):
+        self.duration = float(duration)
+
+    def sample(self, commands):
+        return [self.duration] * len(commands)
+
+
+class DistributionDurations(object):
+
+    """ Durations are drawn from a distribution of the `random` module.
+
+    Parameters
+    ----------
+    name : str
+        one of 'uniform' (low, high), 'lognormal' (mu, sigma), 'normal'
+        (mu, sigma; negative values are clipped to 0) or 'exponential' (mean)
+    params : list of float
+        parameters of the distribution
+    seed : int
+        seed of the random number generator
+    """
+
+    distributions = {'uniform': lambda rng, low, high: rng.uniform(low, high),
+                     'lognormal': lambda rng, mu, sigma: rng.lognormvariate(mu, sigma),
+                     'normal': lambda rng, mu, sigma: max(0., rng.normalvariate(mu, sigma)),
+                     'exponential': lambda rng, mean: rng.expovariate(1. / mean)}
+
+    def __init__(self, name, params, seed=1234):
+        if name not in self.distributions:
+            raise ValueError("Unknown distribution: {0}".format(name))
+
+        self.name = name
+        self.params = params
+        self.seed = seed
+
+    def sample(self, commands):
+        rng = random.Random(self.seed)
+        distribution = self.distributions[self.name]
+        return [distribution(rng, *self.params) for _ in xrange(len(commands))]
+
+
+class HistoryDurations(object):
+
+    """ Durations are estimated from the timing data of previous batches (see `CommandHistory`).
+
+    Commands without history are assumed to take the median estimated duration.
+    """
+
+    def __init__(self, command_history):
+        self.command_history = command_history
+
+    def sample(self, commands):
+        durations = map(self.command_history.estimate_duration, commands)
+        known_durations = sorted(duration for duration in durations if duration is not None)
+        if len(known_durations) == 0:
+            raise ValueError("No timing data found for these commands.")
+
+        median_duration = known_durations[len(known_durations) // 2]
+        return [median_duration if duration is None else duration for duration in durations]
+
+
+def get_duration_model(spec, path_smartdispatch_logs=None):
+    ''' Builds a duration model from its specification.
+
+    Specifications
+    --------------
+    *constant*: "SECONDS" or "[[DD:]HH:]MM:SS"
+    *distribution*: "name:param1,param2" (e.g. "lognormal:5,1", see `DistributionDurations`)
+    *timing data*: "batch:{batch_uid}" or "batch:*" for every previous batch
+    '''
+    name, _, params = spec.partition(':')
+    if name == "batch":
+        return HistoryDurations(CommandHistory(path_smartdispatch_logs, batch_uid=params))
+    elif name in DistributionDurations.distributions:
+        return DistributionDurations(name, map(float, params.split(',')))
+
+    return ConstantDurations(utils.walltime_to_seconds(spec))
+
+
+def simulate(pbs_list, durations, walltime=None, max_nb_jobs=None, autoresume=False, queue_wait=0.):
+    ''' Simulates workers of the given PBS files claiming and executing commands.
+
+    Each PBS job occupies a node and runs one worker per command it contains.
+    Workers claim pending commands in order until none is left or the job
+    reaches its walltime, in which case the running commands are killed (and
+    their remaining work put back in the pending commands if `autoresume`, the
+    job being resubmitted).
+
+    Parameters
+    ----------
+    pbs_list : list of `PBS` instances
+        jobs of the batch (e.g. `JobGenerator.pbs_list`)
+    durations : list of float
+        duration (in seconds) of every command, in order
+    walltime : str
+        walltime of the jobs (Default: the one of the PBS files)
+    max_nb_jobs : int
+        maximum number of jobs running at the same time, e.g. nodes of the queue (Default: inf)
+    autoresume : bool
+        resubmit jobs that reached their walltime
+    queue_wait : float
+        seconds a (re)submitted job waits in the queue before starting
+
+    Returns
+    -------
+    report : dict
+        makespan, node and slot occupancy of the simulated batch (in seconds)
+    '''
+    nb_slots = [len(pbs.commands) for pbs in pbs_list]
+    walltimes = [utils.walltime_to_seconds(walltime if walltime is not None else pbs.resources['walltime']) for pbs in pbs_list]
+    if max_nb_jobs is None:
+        max_nb_jobs = len(pbs_list)
+
+    pending = deque(durations)
+    report = {'nb_commands': len(pending), 'nb_jobs': 0, 'nb_killed_commands': 0,
+              'makespan': 0., 'node_time': 0., 'slot_time': 0., 'busy_time': 0., 'tail_idle_time': 0.}
+
+    jobs_to_start = deque(range(len(pbs_list)))  # Jobs waiting to be started.
+    running_jobs = {}  # Job ID => [start time, deadline, nb_running slots, slot end times, need_to_resume]
+    events = []  # Heap of (time, job ID) for each slot ready to claim a command.
+
+    def start_jobs(time):
+        while len(jobs_to_start) > 0 and len(running_jobs) < max_nb_jobs:
+            job_id = jobs_to_start.popleft()
+            start_time = time + queue_wait
+            running_jobs[job_id] = [start_time, start_time + walltimes[job_id], nb_slots[job_id], [], False]
+            report['nb_jobs'] += 1
+            for _ in xrange(nb_slots[job_id]):
+                heapq.heappush(events, (start_time, job_id))
+
+    def end_slot(job_id, time):
+        job = running_jobs[job_id]
+        job[2] -= 1
+        job[3].append(time)
+        if job[2] > 0:
+            return
+
+        # Every worker of this job is done, the job ends.
+        start_time, _, _, slot_end_times, need_to_resume = running_jobs.pop(job_id)
+        end_time = max(slot_end_times)
+        report['makespan'] = max(report['makespan'], end_time)
+        report['node_time'] += end_time - start_time
+        report['slot_time'] += (end_time - start_time) * nb_slots[job_id]
+        report['tail_idle_time'] += sum(end_time - slot_end_time for slot_end_time in slot_end_times)
+
+        if need_to_resume and len(pending) > 0:
+            jobs_to_start.append(job_id)
+
+        start_jobs(end_time)
+
+    start_jobs(0.)
+    while len(events) > 0:
+        time, job_id = heapq.heappop(events)
+        deadline = running_jobs[job_id][1]
+
+        if len(pending) == 0 or time >= deadline:
+            end_slot(job_id, time)
+            continue
+
+        duration = pending.popleft()
+        if time + duration > deadline:
+            # Killed when reaching the walltime.
+            report['nb_killed_commands'] += 1
+            report['busy_time'] += deadline - time
+            if autoresume:
+                # Commands are assumed resumable, only the remaining work is put back.
+                pending.append(duration - (deadline - time))
+                running_jobs[job_id][4] = True
+
+            end_slot(job_id, deadline)
+            continue
+
+        report['busy_time'] += duration
+        heapq.heappush(events, (time + duration, job_id))
+
+    report['nb_unfinished_commands'] = len(pending)
+    if not autoresume:
+        report['nb_unfinished_commands'] += report['nb_killed_commands']
+
+    report['utilization'] = report['busy_time'] / report['slot_time'] if report['slot_time'] > 0 else 0.
+    report['wasted_node_time'] = report['node_time'] * (1 - report['utilization'])
+    return report
+
+
+def simulate_commands(commands, queue, durations, pool=None, priorities=None, command_params={}, cluster_name=None,
+                      max_nb_jobs=None, autoresume=False, queue_wait=0.):
+    ''' Simulates the execution of commands as they would be launched.
+
+    Parameters
+    ----------
+    commands : list of str
+        commands to execute
+    queue : `Queue` instance
+        queue on which commands would be executed
+    durations : duration model (e.g. `get_duration_model`)
+        model giving the duration of the commands
+    pool : int
+        number of workers (Default: one per command)
+    priorities : list of tuple
+        priority of each command (see `smartdispatch.history.get_commands_priorities`), None to keep them in order
+    command_params : dict
+        resources needed by a command (e.g. 'nb_cores_per_command', 'nb_gpus_per_command')
+    cluster_name : str
+        cluster on which commands would be executed
+    max_nb_jobs : int
+        maximum number of jobs running at the same time, e.g. nodes of the queue (Default: inf)
+    autoresume : bool
+        resubmit jobs that reached their walltime
+    queue_wait : float
+        seconds a (re)submitted job waits in the queue before starting
+
+    Returns
+    -------
+    pbs_list : list of `PBS` instances
+        jobs that would be submitted
+    report : dict
+        makespan, node and slot occupancy of the simulated batch (see `simulate`)
+    '''
+    if priorities is not None:
+        # Highest priority first, then longest estimated first (see `CommandManager.set_commands_to_run`).
+        commands = [command for _, command in sorted(zip(priorities, commands), key=lambda x: [-p for p in x[0]])]
+
+    pool = len(commands) if pool is None else pool
+    job_generator = job_generator_factory(queue, ["worker"] * pool, command_params=command_params, cluster_name=cluster_name)
+    report = simulate(job_generator.pbs_list, durations.sample(commands), max_nb_jobs=max_nb_jobs, autoresume=autoresume, queue_wait=queue_wait)
+    return job_generator.pbs_list, report
+
+
+def format_report(report):
+    """ Formats a simulation report in a human readable way. """
+    lines = ["Makespan: {0}".format(utils.seconds_to_walltime(report['makespan'])),
+             "Jobs (including resubmissions): {0}".format(report['nb_jobs']),
+             "Node-hours allocated: {0:.2f}".format(report['node_time'] / 3600.),
+             "Node-hours wasted: {0:.2f}".format(report['wasted_node_time'] / 3600.),
+             "Slot utilization: {0:.1%}".format(report['utilization']),
+             "Tail idle slot-hours: {0:.2f}".format(report['tail_idle_time'] / 3600.),
+             "Commands killed by the walltime: {0}".format(report['nb_killed_commands'])]
+
+    if report['nb_unfinished_commands'] > 0:
+        lines.append("Commands left unfinished: {0} of {1}".format(report['nb_unfinished_commands'], report['nb_commands']))
+
+    return "\n".join(lines)
@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+
+import os
+import re
+import glob
+import json
+import getpass
+import pipes
+
+import psutil
+
+from smartdispatch import utils
+from smartdispatch.filelock import open_with_flock
+
+
+def get_state_filename(kind, node_name=None, user=None):
+    """ Gets the node-local file where the workers of every job of a user on a node share their `kind` resources.
+
+    The state is kept in /tmp rather than in $TMPDIR, which the scheduler often sets per job.
+    """
+    node_name = os.environ.get('HOSTNAME', 'undefined') if node_name is None else node_name
+    user = getpass.getuser() if user is None else user
+    uid = utils.generate_uid_from_string("{0}_{1}".format(node_name, user))
+    return os.path.join("/tmp", "smartdispatch_{0}_{1}.json".format(kind, uid[:16]))
+
+
+class SlotAllocator(object):
+
+    """ Shares the resources of a node between the workers running on it.
+
+    Resources are split into disjoint slots. A worker acquires a slot before
+    executing a command and releases it once done. The owner of each resource,
+    rather than of each slot, is kept so workers splitting resources differently
+    (e.g. jobs of a same node with different `--coresPerCommand`) never share
+    one. Resources held by processes that no longer exist are considered free.
+
+    Parameters
+    ----------
+    state_filename : str
+        node-local file where the resources owner is kept
+    slots : list of list
+        resources (e.g. CPU or GPU IDs) of each slot
+    """
+
+    def __init__(self, state_filename, slots):
+        self.state_filename = state_filename
+        self.slots = slots
+
+    def _update(self, func):
+        open(self.state_filename, 'a').close()  # Make sure the file exists.
+        with open_with_flock(self.state_filename, 'r+') as state_file:
+            content = state_file.read()
+            owners = json.loads(content) if len(content) > 0 else {}
+            result = func(owners)
+
+            state_file.seek(0, os.SEEK_SET)
+            json.dump(owners, state_file)
+            state_file.truncate()
+
+        return result
+
+    def acquire(self, owner=None):
+        """ Acquires a free slot, returns its index and its resources or (None, None) if none is free. """
+        owner = os.getpid() if owner is None else owner
+
+        def is_free(resource, owners):
+            resource_owner = owners.get(str(resource))
+            return resource_owner is None or not psutil.pid_exists(resource_owner)
+
+        def acquire_slot(owners):
+            for index, slot in enumerate(self.slots):
+                if all(is_free(resource, owners) for resource in slot):
+                    owners.update((str(resource), owner) for resource in slot)
+                    return index, slot
+
+            return None, None
+
+        return self._update(acquire_slot)
+
+    def release(self, index):
+        def release_slot(owners):
+            for resource in self.slots[index]:
+                owners.pop(str(resource), None)
+
+        self._update(release_slot)
+
+
+def parse_cpu_list(cpu_list):
+    """ Parses a CPU list as found in /sys (e.g. "0-3,8,10-11"). """
+    cpus = []
+    for cpu_range in cpu_list.strip().split(','):
+        if len(cpu_range) == 0:
+            continue
+
+        start, _, end = cpu_range.partition('-')
+        cpus += range(int(start), int(end if len(end) > 0 else start) + 1)
+
+    return cpus
+
+
+def get_numa_nodes(sys_path="/sys/devices/system/node"):
+    """ Gets the CPUs of each NUMA node of this machine (empty if unknown). """
+    numa_nodes = []
+    for cpu_list_filename in sorted(glob.glob(os.path.join(sys_path, "node*", "cpulist"))):
+        with open(cpu_list_filename) as cpu_list_file:
+            numa_nodes.append(parse_cpu_list(cpu_list_file.read()))
+
+    return numa_nodes
+
+
+def get_allowed_cpus():
+    """ Gets the CPUs this process is allowed to run on. """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except AttributeError:
+        return range(psutil.cpu_count())
+
+
+def get_cpu_slots(nb_cpus_per_slot, cpus, numa_nodes=[]):
+    ''' Splits CPUs into disjoint slots, aligned to NUMA nodes when possible.
+
+    Slots are first made out of the CPUs of a same NUMA node, the remaining
+    CPUs of every NUMA node are then put together.
+
+    Parameters
+    ----------
+    nb_cpus_per_slot : int
+        number of CPUs in a slot
+    cpus : list of int
+        CPUs to split
+    numa_nodes : list of list of int
+        CPUs of each NUMA node
+
+    Returns
+    -------
+    slots : list of list of int
+        CPUs of each slot
+    '''
+    slots = []
+    leftovers = []
+    for numa_node_cpus in numa_nodes:
+        numa_node_cpus = [cpu for cpu in cpus if cpu in numa_node_cpus]
+        nb_slots = len(numa_node_cpus) // nb_cpus_per_slot
+        slots += list(utils.chunks(numa_node_cpus[:nb_slots * nb_cpus_per_slot], nb_cpus_per_slot))
+        leftovers += numa_node_cpus[nb_slots * nb_cpus_per_slot:]
+
+    # CPUs not part of any known NUMA node are treated as leftovers.
+    leftovers += [cpu for cpu in cpus if all(cpu not in numa_node_cpus for numa_node_cpus in numa_nodes)]
+    nb_slots = len(leftovers) // nb_cpus_per_slot
+    slots += list(utils.chunks(sorted(leftovers)[:nb_slots * nb_cpus_per_slot], nb_cpus_per_slot))
+    return slots
+
+
+def can_set_cpu_affinity():
+    return hasattr(os, 'sched_setaffinity') or hasattr(psutil.Process, 'cpu_affinity')
+
+
+def set_cpu_affinity(cpus):
+    """ Restricts the current process, and its future children, to the given CPUs. """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        psutil.Process().cpu_affinity(cpus)
+
+
+def wrap_with_taskset(command, cpus):
+    """ Restricts a shell command to the given CPUs using taskset. """
+    return "taskset -c {0} sh -c {1}".format(",".join(map(str, cpus)), pipes.quote(command))
+
+
+def get_gpu_devices(gpu_filename=None, node_name=None, dev_path="/dev"):
+    ''' Gets the GPUs this job can use on this node.
+
+    GPUs are taken, in order of preference, from the GPU file of the job
+    (i.e. $PBS_GPUFILE, one "{node}-gpu{index}" per line), from
+    $CUDA_VISIBLE_DEVICES if already restricted by the scheduler, or from the
+    NVIDIA devices of the node.
+
+    Returns
+    -------
+    devices : list of str
+        index of each GPU as understood by CUDA_VISIBLE_DEVICES
+    '''
+    gpu_filename = os.environ.get('PBS_GPUFILE') if gpu_filename is None else gpu_filename
+    node_name = os.environ.get('HOSTNAME', '') if node_name is None else node_name
+
+    if gpu_filename is not None and os.path.isfile(gpu_filename):
+        with open(gpu_filename) as gpu_file:
+            gpus = [line.strip().rpartition('-gpu') for line in gpu_file if '-gpu' in line]
+
+        # The GPU file lists the GPUs of every node of the job.
+        devices = [index for node, _, index in gpus if node.split('.')[0] == node_name.split('.')[0]]
+        return devices if len(devices) > 0 else [index for _, _, index in gpus]
+
+    if len(os.environ.get('CUDA_VISIBLE_DEVICES', '')) > 0:
+        return os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+
+    regex_nvidia_device = re.compile(r"nvidia(\d+)$")
+    indices = [regex_nvidia_device.search(device) for device in glob.glob(os.path.join(dev_path, "nvidia*"))]
+    return [str(index) for index in sorted(int(match.group(1)) for match in indices if match is not None)]
+
+
+def get_gpu_slots(nb_gpus_per_slot, devices):
+    """ Splits GPUs into disjoint slots of `nb_gpus_per_slot` GPUs. """
+    nb_slots = len(devices) // nb_gpus_per_slot
+    return list(utils.chunks(list(devices[:nb_slots * nb_gpus_per_slot]), nb_gpus_per_slot))
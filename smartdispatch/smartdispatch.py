@@ -5,12 +5,13 @@ import re
 import itertools
 import time as t
 from os.path import join as pjoin
-from subprocess import check_output
+from subprocess import call, check_output
 
 import smartdispatch
 from smartdispatch import utils
 from smartdispatch.filelock import open_with_lock
 from smartdispatch.argument_template import argument_templates
+from smartdispatch.local_executor import launch_jobs_locally
 
 UID_TAG = "{UID}"
 
@@ -167,24 +168,20 @@ def log_command_line(path_job, command_line):
         command_line_log.write(command_line + "\n\n")
 
 
-def launch_jobs(launcher, pbs_filenames, cluster_name, path_job):  # pragma: no cover
-    ''' Invokes launcher on a set of PBS files.
+def submit_jobs(launcher, pbs_filenames, cluster_name, depend_on=None):  # pragma: no cover
+    ''' Submits a set of PBS files using the launcher and returns their job ID.
 
-    Parameters
-    ----------
-    launcher : str
-        launcher name
-    pbs_filenames : list of str
-        a list of PBS files to launch
-    cluster_name : str
-        cluster name
-    path_job : str
-        path to the job folder
+    Jobs start only once the job `depend_on` is over (afterany), if provided.
     '''
+    launcher_flags = ""
+    if depend_on is not None:
+        launcher_flags = "-l depend=afterany:{0} " if launcher == "msub" else "-W depend=afterany:{0} "
+        launcher_flags = launcher_flags.format(depend_on)
+
     jobs_id = []
     for pbs_filename in pbs_filenames:
-        launcher_output = check_output('PBS_FILENAME={pbs_filename} {launcher} {pbs_filename}'.format(
-            launcher=launcher, pbs_filename=pbs_filename), shell=True)
+        launcher_output = check_output('PBS_FILENAME={pbs_filename} {launcher} {launcher_flags}{pbs_filename}'.format(
+            launcher=launcher, launcher_flags=launcher_flags, pbs_filename=pbs_filename), shell=True)
         jobs_id += [launcher_output.strip()]
 
         # On some clusters, SRMJID and PBS_JOBID don't match
@@ -195,7 +192,94 @@ def launch_jobs(launcher, pbs_filenames, cluster_name, path_job):  # pragma: no
                     pbs_job_id = re.match(r"[0-9a-zA-Z.-]*", job).group()
                     jobs_id[-1] = '{pbs}'.format(pbs=pbs_job_id)
 
+    return jobs_id
+
+
+def cancel_jobs(jobs_id):  # pragma: no cover
+    ''' Deletes queued or running jobs using qdel, jobs already over are ignored. '''
+    if len(jobs_id) > 0:
+        call(["qdel"] + list(jobs_id))
+
+
+def cancel_queued_jobs(path_job):  # pragma: no cover
+    ''' Deletes the jobs of a batch that are queued but not started, meant to be called once no command is left to execute.
+
+    Such jobs would only start to find nothing to do. Jobs held (e.g. waiting
+    for another job) and jobs launched locally are left alone. Jobs deleted or
+    over are remembered, so only the jobs that may still be queued later (e.g.
+    held or running ones, which can be requeued) are looked up again.
+
+    Parameters
+    ----------
+    path_job : str
+        path to the job folder
+
+    Returns
+    -------
+    jobs_id : list of str
+        ID of the deleted jobs
+    '''
+    jobs_id_filename = pjoin(path_job, "jobs_id.txt")
+    if not os.path.isfile(jobs_id_filename):
+        return []
+
+    done_filename = pjoin(path_job, "queued_jobs_done.txt")
+    open(done_filename, 'a').close()  # Make sure the file exists.
+    with open_with_lock(done_filename, 'r+') as done_file:
+        done_jobs_id = set(line.strip() for line in done_file)
+
+        # Job IDs are only ever appended, no need to lock them.
+        with open(jobs_id_filename, 'r') as jobs_id_file:
+            jobs_id = [line.strip() for line in jobs_id_file if line.strip() != "" and not line.startswith("#")]
+
+        jobs_id = [job_id for job_id in jobs_id if job_id not in done_jobs_id and job_id != os.environ.get('PBS_JOBID')]
+        local_jobs_id = [job_id for job_id in jobs_id if job_id.endswith(".local")]
+        jobs_id = [job_id for job_id in jobs_id if not job_id.endswith(".local")]
+        states = utils.get_jobs_state(jobs_id)
+        if states is None:
+            return []
+
+        queued_jobs_id = [job_id for job_id in jobs_id if states.get(job_id) == 'Q']
+        cancel_jobs(queued_jobs_id)
+
+        # Jobs no longer known to qstat are over.
+        over_jobs_id = [job_id for job_id in jobs_id if states.get(job_id, 'C') == 'C']
+        done_file.seek(0, os.SEEK_END)
+        done_file.writelines(job_id + "\n" for job_id in local_jobs_id + queued_jobs_id + over_jobs_id)
+
+    return queued_jobs_id
+
+
+def launch_jobs(launcher, pbs_filenames, cluster_name, path_job, depend_on=None):  # pragma: no cover
+    ''' Invokes launcher on a set of PBS files.
+
+    Parameters
+    ----------
+    launcher : str
+        launcher name, "local" executes the PBS files on the current machine
+    pbs_filenames : list of str
+        a list of PBS files to launch
+    cluster_name : str
+        cluster name
+    path_job : str
+        path to the job folder
+    depend_on : str
+        ID of a job that must be over before the launched jobs start (not supported by the local launcher)
+
+    Returns
+    -------
+    jobs_id : list of str
+        ID of the launched jobs
+    '''
+    if launcher == "local":
+        if depend_on is not None:
+            raise ValueError("Jobs launched locally cannot depend on other jobs.")
+        jobs_id = launch_jobs_locally(pbs_filenames)
+    else:
+        jobs_id = submit_jobs(launcher, pbs_filenames, cluster_name, depend_on)
+
     with open_with_lock(pjoin(path_job, "jobs_id.txt"), 'a') as jobs_id_file:
         jobs_id_file.writelines(t.strftime("## %Y-%m-%d %H:%M:%S ##\n"))
         jobs_id_file.writelines("\n".join(jobs_id) + "\n")
     print "\nJobs id:\n{jobs_id}".format(jobs_id=" ".join(jobs_id))
+    return jobs_id
@@ -0,0 +1,193 @@
+import os
+import glob
+import shutil
+import pipes
+
+# Node-local folder of a batch, shared by the commands of every job of the batch running on the node.
+SCRATCH_DIR = '"${{SD_SCRATCH:-${{TMPDIR:-/dev/shm}}}}/smartdispatch_"{name}"_$(hostname)"'
+
+# Outputs synced back by the jobs of a batch, relative to the folder they are synced back to.
+STAGED_OUTPUTS_FILENAME = "staged_outputs.txt"
+
+
+def get_stage_in_prolog(paths, name):
+    ''' Generates the PBS prolog copying input files or folders to the node-local scratch.
+
+    Inputs are copied once per node, by the first job of the batch starting on
+    it, and shared by every command of the batch running on the node. Commands
+    find the staged copy of the i-th input in $SD_STAGE_IN_i (all of them in
+    $SD_STAGE_IN, separated by ':'), the original path being kept if the copy
+    failed (e.g. scratch is full). Outputs written by the commands to their
+    job's $SD_STAGE_OUT_DIR can be synced back (see `get_stage_out_epilog`).
+    The scratch is released by `get_scratch_epilog`.
+
+    Parameters
+    ----------
+    paths : list of str
+        files or folders to copy, their basename must be unique
+    name : str
+        name of the batch, its jobs running on the same node share their scratch
+
+    Returns
+    -------
+    prolog : list of str
+        code to execute before the commands
+    '''
+    staged_paths = []
+    copies = []
+    exports = []
+    for i, path in enumerate(paths):
+        path = os.path.abspath(path)
+        staged_path = '"$SD_SCRATCH_DIR/in/"{0}'.format(pipes.quote(os.path.basename(path.rstrip('/'))))
+        # Partial copies are removed, so inputs that could not be copied are read from their original path.
+        copies.append('cp -r {path} "$SD_SCRATCH_DIR/in/" || rm -rf {staged_path}; '.format(path=pipes.quote(path), staged_path=staged_path))
+        exports += ['export SD_STAGE_IN_{i}={staged_path}'.format(i=i, staged_path=staged_path),
+                    '[ -e "$SD_STAGE_IN_{i}" ] || SD_STAGE_IN_{i}={path}'.format(i=i, path=pipes.quote(path))]
+        staged_paths.append('$SD_STAGE_IN_{0}'.format(i))
+
+    # Jobs register in the scratch, and the first one copies the inputs, under a lock released even if the job is killed.
+    prolog = ['export SD_SCRATCH_DIR={0}'.format(SCRATCH_DIR.format(name=pipes.quote(name))),
+              'export SD_STAGE_OUT_DIR="$SD_SCRATCH_DIR/out_$PBS_JOBID"',
+              'mkdir -p "$SD_SCRATCH_DIR"',
+              '(flock 9; mkdir -p "$SD_SCRATCH_DIR/in" "$SD_SCRATCH_DIR/jobs" "$SD_STAGE_OUT_DIR"; touch "$SD_SCRATCH_DIR/jobs/$PBS_JOBID"; '
+              'if [ ! -e "$SD_SCRATCH_DIR/in/.staged" ]; then {copies}touch "$SD_SCRATCH_DIR/in/.staged"; fi) 9> "$SD_SCRATCH_DIR/lock"'
+              .format(copies=''.join(copies))]
+    prolog += exports
+
+    if len(staged_paths) > 0:
+        prolog += ['export SD_STAGE_IN="{0}"'.format(':'.join(staged_paths))]
+
+    return prolog
+
+
+def get_scratch_epilog():
+    ''' Generates the PBS epilog releasing the node-local scratch, deleted along with the inputs once no job uses it.
+
+    Returns
+    -------
+    epilog : list of str
+        code to execute after the commands
+    '''
+    # The lock file is kept, so jobs waiting for it keep locking the same file.
+    return ['rm -rf "$SD_STAGE_OUT_DIR"',
+            '(flock 9; rm -f "$SD_SCRATCH_DIR/jobs/$PBS_JOBID"; '
+            'if rmdir "$SD_SCRATCH_DIR/jobs" 2> /dev/null; then rm -rf "$SD_SCRATCH_DIR/in"; fi) 9> "$SD_SCRATCH_DIR/lock"']
+
+
+def get_stage_out_prolog(patterns, destination, manifest_filename):
+    ''' Generates the PBS prolog copying outputs previously synced back into the node-local scratch.
+
+    Commands resumed by another job, possibly on another node (e.g. with
+    `--autoresume`), thus find in $SD_STAGE_OUT_DIR the outputs, such as
+    checkpoints, they wrote before. Only outputs synced back from
+    $SD_STAGE_OUT_DIR, as listed in `manifest_filename`, are copied. Must
+    follow the prolog of `get_stage_in_prolog`.
+
+    Parameters
+    ----------
+    patterns : list of str
+        glob patterns, relative to $SD_STAGE_OUT_DIR, of the outputs to sync back
+    destination : str
+        folder where outputs are synced back, keeping their relative path
+    manifest_filename : str
+        file listing the outputs synced back (see `get_stage_out_epilog`)
+
+    Returns
+    -------
+    prolog : list of str
+        code to execute before the commands
+    '''
+    if len(patterns) == 0:
+        return []
+
+    manifest_filename = pipes.quote(os.path.abspath(manifest_filename))
+    return ['export SD_STAGE_OUT_MANIFEST={0}'.format(manifest_filename),
+            '[ ! -f "$SD_STAGE_OUT_MANIFEST" ] || (cd {destination} && sort -u "$SD_STAGE_OUT_MANIFEST" | while IFS= read -r OUTPUT; do '
+            'if [ -f "$OUTPUT" ]; then cp -p --parents "$OUTPUT" "$SD_STAGE_OUT_DIR"; fi; done)'
+            .format(destination=pipes.quote(os.path.abspath(destination)))]
+
+
+def get_stage_out_epilog(patterns, destination):
+    ''' Generates the PBS epilog syncing outputs back from the node-local scratch.
+
+    Files synced back are listed in $SD_STAGE_OUT_MANIFEST (see `get_stage_out_prolog`).
+
+    Parameters
+    ----------
+    patterns : list of str
+        glob patterns, relative to $SD_STAGE_OUT_DIR, of the outputs to sync back
+    destination : str
+        folder where outputs are synced back, keeping their relative path
+
+    Returns
+    -------
+    epilog : list of str
+        code to execute after the commands
+    '''
+    if len(patterns) == 0:
+        return []
+
+    # Patterns are quoted so the PBS file keeps them as is, and only expanded, without word
+    # splitting, inside $SD_STAGE_OUT_DIR. Those matching nothing are skipped by the existence check.
+    destination = pipes.quote(os.path.abspath(destination))
+    return ['mkdir -p {destination}'.format(destination=destination),
+            '(cd "$SD_STAGE_OUT_DIR" && IFS= && for PATTERN in {patterns}; do for OUTPUT in $PATTERN; do '
+            'if [ -e "$OUTPUT" ]; then find "$OUTPUT" -type f; fi; done; done | sort -u | while read -r OUTPUT; do '
+            'cp -pu --parents "$OUTPUT" {destination} && echo "$OUTPUT" >> "$SD_STAGE_OUT_MANIFEST"; done)'
+            .format(patterns=' '.join(pipes.quote(pattern) for pattern in patterns), destination=destination)]
+
+
+def _copy_if_newer(source, destination):
+    # Modification times copied by `shutil.copy2` may lose sub-microsecond precision.
+    if os.path.isfile(destination) and os.path.getmtime(destination) + 1e-3 >= os.path.getmtime(source):
+        return False
+
+    if not os.path.isdir(os.path.dirname(destination)):
+        try:
+            os.makedirs(os.path.dirname(destination))
+        except OSError:
+            pass  # Created by another worker in the meantime.
+
+    # Copy then rename, so readers never see a partially written output.
+    tmp_destination = "{0}.sd_{1}.tmp".format(destination, os.getpid())
+    shutil.copy2(source, tmp_destination)
+    os.rename(tmp_destination, destination)
+    return True
+
+
+def stage_out(source_dir, patterns, destination_dir, manifest_filename=None):
+    ''' Syncs back outputs matching glob patterns that are newer than their copy.
+
+    Parameters
+    ----------
+    source_dir : str
+        node-local folder where commands write their outputs (i.e. $SD_STAGE_OUT_DIR)
+    patterns : list of str
+        glob patterns, relative to `source_dir`, of the outputs to sync back
+    destination_dir : str
+        folder where outputs are synced back, keeping their relative path
+    manifest_filename : str
+        file to which the relative path of each file copied is appended (i.e. $SD_STAGE_OUT_MANIFEST)
+
+    Returns
+    -------
+    nb_files : int
+        number of files copied
+    '''
+    copied_filenames = []
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(source_dir, pattern)):
+            filenames = [path]
+            if os.path.isdir(path):
+                filenames = [os.path.join(root, filename) for root, _, files in os.walk(path) for filename in files]
+
+            for filename in filenames:
+                relative_filename = os.path.relpath(filename, source_dir)
+                if _copy_if_newer(filename, os.path.join(destination_dir, relative_filename)):
+                    copied_filenames.append(relative_filename)
+
+    if manifest_filename is not None and len(copied_filenames) > 0:
+        with open(manifest_filename, 'a') as manifest_file:
+            manifest_file.writelines(filename + "\n" for filename in copied_filenames)
+
+    return len(copied_filenames)
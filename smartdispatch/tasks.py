@@ -0,0 +1,223 @@
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import copy
+import glob
+import time
+import pipes
+import pickle
+import traceback
+from os.path import join as pjoin
+
+from smartdispatch import utils
+from smartdispatch.batch import Batch
+from smartdispatch.worker_options import WorkerOptions
+from smartdispatch.smartdispatch import generate_logfolder_name
+
+TASK_COMMAND = "python2 -m smartdispatch.tasks {task_filename}"
+regex_task_command = re.compile(r"^python2 -m smartdispatch\.tasks (\S+)$")
+regex_task_filename = re.compile(r"task_(\d+)\.pkl$")
+
+
+class TaskError(Exception):
+    pass
+
+
+def get_result_filename(task_filename):
+    return re.sub(r"task_(\d+)\.pkl$", r"result_\1.pkl", task_filename)
+
+
+def save_tasks(func, iterable, path_tasks):
+    ''' Pickles a callable with each of its arguments, and returns the commands executing them.
+
+    Parameters
+    ----------
+    func : callable
+        picklable callable, e.g. a function defined at the top level of a module
+    iterable : iterable
+        argument of each call
+    path_tasks : str
+        folder where to save the tasks and their results
+
+    Returns
+    -------
+    commands : list of str
+        one command per task, executable by any worker
+    '''
+    if not os.path.isdir(path_tasks):
+        os.makedirs(path_tasks)
+
+    commands = []
+    for i, argument in enumerate(iterable):
+        task_filename = pjoin(os.path.abspath(path_tasks), "task_{0}.pkl".format(i))
+        with open(task_filename, 'wb') as task_file:
+            pickle.dump((func, argument), task_file, pickle.HIGHEST_PROTOCOL)
+
+        commands.append(TASK_COMMAND.format(task_filename=pipes.quote(task_filename)))
+
+    return commands
+
+
+def get_task_filename(command):
+    """ Gets the task executed by a command, None if it is not a task. """
+    match = regex_task_command.match(command)
+    return match.group(1) if match is not None else None
+
+
+def run_task(task_filename):
+    """ Executes a task and saves its result next to it. """
+    with open(task_filename, 'rb') as task_file:
+        func, argument = pickle.load(task_file)
+
+    result = func(argument)
+
+    # Write then rename, so a partially written result is never read.
+    result_filename = get_result_filename(task_filename)
+    with open(result_filename + ".tmp", 'wb') as result_file:
+        pickle.dump(result, result_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(result_filename + ".tmp", result_filename)
+
+
+def run_task_in_process(task_filename, stdout_file, stderr_file):
+    ''' Executes a task in the current process, reusing the modules already imported.
+
+    The output of the task, including the one of C extensions, is redirected
+    to the given files.
+
+    Returns
+    -------
+    error_code : int
+        0 if the task succeeded, 1 if it raised an exception or its exit status if it exited
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    os.dup2(stdout_file.fileno(), 1)
+    os.dup2(stderr_file.fileno(), 2)
+    try:
+        run_task(task_filename)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for saved_fd in saved_fds:
+            os.close(saved_fd)
+
+
+def iter_results(batch, poll_interval=10., timeout=None):
+    ''' Yields the result of every task of a batch, in order, as soon as it is available.
+
+    Parameters
+    ----------
+    batch : `Batch` instance
+        batch whose commands execute tasks (see `map`)
+    poll_interval : float
+        seconds between two checks for new results
+    timeout : float
+        seconds to wait for all the results (Default: no limit)
+
+    Raises
+    ------
+    TaskError
+        when reaching a task that failed, or that no job of the batch is left to execute (e.g. paused), or after `timeout` seconds
+    '''
+    task_filenames = glob.glob(pjoin(batch.path_job, "tasks", "task_*.pkl"))
+    task_filenames = sorted(task_filenames, key=lambda filename: int(regex_task_filename.search(filename).group(1)))
+
+    # The state of the batch is polled at most once per `poll_interval`, whatever the number of tasks.
+    start_time = time.time()
+    poll_time = None
+    for task_filename in task_filenames:
+        result_filename = get_result_filename(task_filename)
+        command = TASK_COMMAND.format(task_filename=pipes.quote(task_filename))
+        uid = utils.generate_uid_from_string(command)
+        while not os.path.isfile(result_filename):
+            if poll_time is None or time.time() - poll_time >= poll_interval:
+                poll_time = time.time()
+                failed_commands = set(batch.command_manager.get_failed_commands())
+                running_commands = set(batch.command_manager.get_running_commands())
+                is_paused = batch.is_paused()
+                has_live_jobs = batch.has_live_jobs()
+
+            if command + '\n' in failed_commands:
+                raise TaskError("Task {0} failed, see {1}.".format(task_filename, pjoin(batch.path_job_logs, uid + ".err")))
+
+            if is_paused and command not in running_commands and not os.path.isfile(result_filename):
+                raise TaskError("Task {0} is not done and the batch is paused ({1}), see {2}.".format(
+                    task_filename, batch.command_manager.get_pause_reason(), batch.path_job_logs))
+
+            # Workers might have died without a word, e.g. killed or unable to start.
+            if has_live_jobs is False and not os.path.isfile(result_filename):
+                raise TaskError("Task {0} is not done and no job of the batch is left to execute it, see {1}.".format(task_filename, batch.path_job_logs))
+
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TaskError("Timed out waiting for the result of task {0}.".format(task_filename))
+
+            time.sleep(poll_interval)
+
+        with open(result_filename, 'rb') as result_file:
+            yield pickle.load(result_file)
+
+
+def map(func, iterable, queue, name=None, path_smartdispatch_logs="SMART_DISPATCH_LOGS", launcher="qsub", cluster_name=None,
+        poll_interval=10., timeout=None, worker_options=None, **options):
+    ''' Applies a callable to every item of an iterable, in jobs executed on a cluster.
+
+    Each call is a task pickled in the batch folder and executed by a command
+    of the batch, so tasks share the logs, retries and resume of any other
+    command. Workers execute tasks within their own process, importing the
+    modules they need only once.
+
+    Parameters
+    ----------
+    func : callable
+        picklable callable, e.g. a function defined at the top level of a module
+    iterable : iterable
+        argument of each call
+    queue : `Queue` instance
+        queue on which tasks will be executed
+    name : str
+        name of the batch (Default: name of the callable)
+    path_smartdispatch_logs : str
+        path to the SMART_DISPATCH_LOGS folder
+    launcher : str
+        launcher used to submit the jobs, "local" executes them on this machine
+    cluster_name : str
+        cluster on which tasks will be executed
+    poll_interval : float
+        seconds between two checks for new results
+    timeout : float
+        seconds to wait for all the results (Default: no limit)
+    worker_options : `WorkerOptions` instance
+        how workers execute the tasks, always within their own process (Default: `WorkerOptions()`)
+    **options
+        options given to `Batch.generate_pbs_files` (e.g. pool, autoresume)
+
+    Returns
+    -------
+    results : iterator
+        result of every call, in order (see `iter_results`)
+    '''
+    name = generate_logfolder_name(utils.slugify(name if name is not None else func.__name__), max_length=235)
+    batch = Batch(pjoin(path_smartdispatch_logs, name))
+    commands = save_tasks(func, iterable, pjoin(batch.path_job, "tasks"))
+    batch.command_manager.set_commands_to_run(commands)
+
+    worker_options = copy.copy(worker_options) if worker_options is not None else WorkerOptions()
+    worker_options.in_process = True
+    batch.generate_pbs_files(queue, worker_options=worker_options, launcher=launcher, cluster_name=cluster_name, **options)
+    batch.launch(launcher, cluster_name)
+    return iter_results(batch, poll_interval, timeout)
+
+
+if __name__ == "__main__":
+    run_task(sys.argv[1])
@@ -0,0 +1,254 @@
+import os
+import time
+import json
+import unittest
+import tempfile
+import shutil
+from os.path import join as pjoin
+from subprocess import CalledProcessError
+
+from nose.tools import assert_true, assert_equal, assert_raises
+
+from smartdispatch import Batch
+from smartdispatch import batch as batch_module
+from smartdispatch.queue import Queue
+from smartdispatch.retry_policy import RetryPolicy
+from smartdispatch.worker_options import WorkerOptions
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.logs_dir = pjoin(self.testing_dir, "SMART_DISPATCH_LOGS")
+        self.commands = ["echo 1", "echo 2", "echo 3"]
+        self.queue = Queue("test", None, "5:00", 2, 0, 32)
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def test_create(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir, retry_policy=RetryPolicy(2))
+        assert_equal(batch.batch_uid, "batch")
+        assert_equal(batch.path_job, pjoin(self.logs_dir, "batch"))
+        assert_true(os.path.isdir(pjoin(batch.path_job_logs, "worker")))
+        assert_equal(batch.command_manager.get_pending_commands(), self.commands)
+        assert_equal(batch.command_manager.get_retry_policy().max_attempts, 2)
+        assert_equal(batch.get_status(), {'pending': 3, 'running': 0, 'finished': 0, 'failed': 0, 'timed_out': 0})
+
+    def test_load(self):
+        Batch.create(self.commands, "batch", self.logs_dir)
+        assert_equal(Batch.load("batch", self.logs_dir).command_manager.get_pending_commands(), self.commands)
+        assert_equal(Batch.load(pjoin(self.logs_dir, "batch"), self.logs_dir).batch_uid, "batch")
+        assert_raises(LookupError, Batch.load, "unknown", self.logs_dir)
+
+    def test_size_pool_and_walltime(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        assert_equal(batch.size_pool_and_walltime("2:00:00")[:2], (None, None))  # No history
+
+        previous_batch = Batch.create(self.commands, "previous_batch", self.logs_dir)
+        for command in self.commands:
+            previous_batch.command_manager.add_command_timing(command, 3600)
+
+        pool, walltime, explanation = batch.size_pool_and_walltime("2:00:00")
+        assert_equal((pool, walltime), (2, "0:02:24:00"))
+        assert_equal(explanation[-1], "Using a walltime of 0:02:24:00.")
+        assert_true(os.path.isfile(pjoin(batch.path_job, "sizing.log")))
+
+        pool, walltime, _ = batch.size_pool_and_walltime("2:00:00", max_walltime="2:00:00", pool=1)
+        assert_equal((pool, walltime), (1, "0:02:00:00"))
+
+    def test_shape_for_backfill(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        assert_equal(batch.shape_for_backfill("auto")[:2], (None, "0:02:00:00"))  # No history
+        assert_equal(batch.shape_for_backfill("auto", max_walltime="1:30:00")[:2], (None, "0:01:30:00"))
+        assert_equal(batch.shape_for_backfill("30:00", pool=4)[:2], (4, "0:00:30:00"))
+
+        previous_batch = Batch.create(self.commands, "previous_batch", self.logs_dir)
+        for command in self.commands:
+            previous_batch.command_manager.add_command_timing(command, 3600)
+
+        # Commands longer than the jobs, one worker each.
+        pool, walltime, explanation = batch.shape_for_backfill("1:00:00")
+        assert_equal((pool, walltime), (3, "0:01:00:00"))
+        assert_equal(explanation[-1], "Using a pool of 3 worker(s).")
+
+    def test_generate_pbs_files(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, autoresume=True, cwd=self.testing_dir)
+
+        # One worker per command, two per node.
+        assert_equal(pbs_filenames, batch.pbs_filenames)
+        assert_equal(len(pbs_filenames), 2)
+
+        pbs = open(pbs_filenames[0]).read()
+        assert_true('cd "{0}"; timeout -s TERM'.format(self.testing_dir) in pbs)
+        assert_true("base_worker.py -c 1 -r " in pbs)
+        assert_true("sd-launch-pbs --launcher qsub --autoresume $PBS_FILENAME {0}".format(batch.path_job) in pbs)
+
+    def test_generate_pbs_files_with_checkpoint_signal(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, worker_options=WorkerOptions(checkpoint_signal=10), autoresume=True, checkpoint_time=600)
+
+        # Workers are terminated 10 minutes before the walltime, commands get 9m30s to checkpoint.
+        pbs = open(pbs_filenames[0]).read()
+        assert_true("timeout -s TERM $(($PBS_WALLTIME - 600)) " in pbs)
+        assert_true("--checkpointSignal 10 --checkpointGrace 570 -r " in pbs)
+
+    def test_generate_pbs_files_with_staging(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, worker_options=WorkerOptions(stage_out=["*.pkl"]), autoresume=True,
+                                                 stage_in=[self.testing_dir])
+
+        # Outputs are synced back before the work left is resubmitted.
+        pbs = open(pbs_filenames[0]).read()
+        assert_true(pbs.index('wait "$WORKER_PID"') < pbs.index('>> "$SD_STAGE_OUT_MANIFEST"') < pbs.index("sd-launch-pbs"))
+        assert_true('export SD_STAGE_OUT_MANIFEST={0}\n'.format(pjoin(batch.path_job, "staged_outputs.txt")) in pbs)
+
+    def test_generate_pbs_files_with_groups(self):
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, worker_options=WorkerOptions(group_size=2))
+
+        # One worker per group of commands.
+        assert_equal(len(pbs_filenames), 1)
+        pbs = open(pbs_filenames[0]).read()
+        assert_equal(pbs.count("base_worker.py -c 1 --groupSize 2 "), 2)
+
+    def _fake_launchers(self):
+        """ Puts qsub, qdel and qstat on the PATH, logging their arguments and considering every job as queued. """
+        path_bin = pjoin(self.testing_dir, "bin")
+        os.mkdir(path_bin)
+        scripts = {'qsub': 'echo "$@" >> "{0}/qsub.log"; echo "$(($(wc -l < "{0}/qsub.log"))).server"',
+                   'qdel': 'echo "$@" >> "{0}/qdel.log"',
+                   'qstat': 'for JOB_ID in "$@"; do echo "$JOB_ID name user 0 Q queue"; done'}
+        for name, script in scripts.items():
+            with open(pjoin(path_bin, name), 'w') as script_file:
+                script_file.write("#!/bin/sh\n" + script.format(path_bin) + "\n")
+            os.chmod(pjoin(path_bin, name), 0755)
+
+        self.addCleanup(os.environ.__setitem__, 'PATH', os.environ['PATH'])
+        os.environ['PATH'] = path_bin + os.pathsep + os.environ['PATH']
+        return path_bin
+
+    def test_resume(self):
+        path_bin = self._fake_launchers()
+        batch = Batch.create(["echo {0}".format(i) for i in range(7)], "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, autoresume=True)
+        assert_equal([batch_module.get_nb_workers(open(pbs_filename).read()) for pbs_filename in pbs_filenames], [2, 2, 2, 1])
+
+        # Three commands left and no other live job: two jobs, the last one with a single worker.
+        batch.command_manager.get_commands_to_run(4)
+        batch.command_manager.set_running_commands_as_finished(["echo {0}".format(i) for i in range(4)], [0] * 4)
+        assert_equal(batch.resume(pbs_filenames[0]), ["1.server", "2.server"])
+        continuation_filenames = [pjoin(batch.path_job_commands, "continuation_{0}.sh".format(i)) for i in range(2)]
+        continuation = open(continuation_filenames[1]).read()
+        assert_equal(batch_module.get_nb_workers(continuation), 1)
+        assert_true("#PBS -l nodes=1:ppn=1\n" in continuation)
+
+        # The queued continuation covers the work left.
+        assert_equal(batch.resume(pbs_filenames[1]), [])
+
+        # Unless it is about to reach its walltime.
+        with open(os.path.join(batch.path_job, batch_module.AUTORESUME_DEADLINES_FILENAME), 'a') as deadlines_file:
+            deadlines_file.write("{0} {1} {2}\n".format(continuation_filenames[0], time.time() + 1, time.time() + 60))
+        assert_equal(batch.resume(pbs_filenames[2]), ["3.server"])
+
+        # Nothing is resubmitted while the batch is paused.
+        batch.command_manager.pause("too many failures")
+        with open(os.path.join(batch.path_job, batch_module.AUTORESUME_DEADLINES_FILENAME), 'a') as deadlines_file:
+            deadlines_file.write("{0} {1} {2}\n".format(continuation_filenames[1], time.time() + 1, time.time() + 60))
+        assert_equal(batch.resume(pbs_filenames[3]), [])
+        assert_equal(len(open(pjoin(path_bin, "qsub.log")).readlines()), 3)
+
+    def test_resume_with_groups(self):
+        self._fake_launchers()
+        batch = Batch.create(["echo {0}".format(i) for i in range(7)], "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, worker_options=WorkerOptions(group_size=2), autoresume=True)
+        assert_equal(batch_module.get_group_size(open(pbs_filenames[0]).read()), 2)
+
+        # Five commands left: three workers executing two commands at once.
+        batch.command_manager.get_commands_to_run(2)
+        batch.command_manager.set_running_commands_as_finished(["echo 0", "echo 1"], [0] * 2)
+        assert_equal(batch.resume(pbs_filenames[0]), ["1.server", "2.server"])
+        continuation = open(pjoin(batch.path_job_commands, "continuation_1.sh")).read()
+        assert_equal(batch_module.get_nb_workers(continuation), 1)
+
+    def test_launch_chained(self):
+        path_bin = self._fake_launchers()
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, autoresume=True, chain=True)
+        assert_true("NEED_TO_RESUME=true" in open(pbs_filenames[0]).read())
+        assert_raises(ValueError, batch.launch, "local", chain=True)
+
+        # Each job gets a continuation held until it is over.
+        assert_equal(batch.launch("qsub", chain=True), ["1.server", "2.server"])
+        qsub_log = open(pjoin(path_bin, "qsub.log")).read().split("\n")
+        assert_equal(qsub_log[2:4], ["-W depend=afterany:1.server " + pjoin(batch.path_job_commands, "continuation_0.sh"),
+                                     "-W depend=afterany:2.server " + pjoin(batch.path_job_commands, "continuation_1.sh")])
+
+        # With work left, the continuation of the first job covers it and the next link is submitted.
+        assert_equal(batch.resume(pbs_filenames[0]), [])
+        qsub_log = open(pjoin(path_bin, "qsub.log")).read().split("\n")
+        assert_equal(qsub_log[4], "-W depend=afterany:3.server " + pjoin(batch.path_job_commands, "continuation_2.sh"))
+        assert_true(not os.path.isfile(pjoin(path_bin, "qdel.log")))
+
+        # With no work left, the continuation of the second job is cancelled.
+        batch.command_manager.get_commands_to_run(3)
+        batch.command_manager.set_running_commands_as_finished(self.commands, [0] * 3)
+        assert_equal(batch.resume(pbs_filenames[1]), [])
+        assert_equal(open(pjoin(path_bin, "qdel.log")).read(), "4.server\n")
+        assert_equal(len(open(pjoin(path_bin, "qsub.log")).readlines()), 5)
+
+    def test_launch_failing(self):
+        path_bin = self._fake_launchers()
+        os.rename(pjoin(path_bin, "qsub"), pjoin(path_bin, "working_qsub"))
+        with open(pjoin(path_bin, "qsub"), 'w') as qsub_file:
+            qsub_file.write("#!/bin/sh\nexit 1\n")
+        os.chmod(pjoin(path_bin, "qsub"), 0755)
+
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        pbs_filenames = batch.generate_pbs_files(self.queue, autoresume=True, chain=True)
+
+        # Jobs that failed to be submitted are not counted as queued.
+        assert_raises(CalledProcessError, batch.launch, "qsub", chain=True)
+        assert_equal(json.load(open(pjoin(batch.path_job, batch_module.AUTORESUME_STATE_FILENAME)))['jobs'], {})
+
+        # Neither are continuations that failed to be submitted.
+        os.rename(pjoin(path_bin, "qsub"), pjoin(path_bin, "failing_qsub"))
+        os.rename(pjoin(path_bin, "working_qsub"), pjoin(path_bin, "qsub"))
+        batch.launch("qsub", pbs_filenames=pbs_filenames[:1])
+        os.rename(pjoin(path_bin, "failing_qsub"), pjoin(path_bin, "qsub"))
+        assert_raises(CalledProcessError, batch._launch_successors, "qsub", None, pbs_filenames[:1])
+        jobs = json.load(open(pjoin(batch.path_job, batch_module.AUTORESUME_STATE_FILENAME)))['jobs']
+        assert_equal(jobs.keys(), [pbs_filenames[0]])
+        assert_true('successor' not in jobs[pbs_filenames[0]])
+
+    def test_launch_excluding_bad_nodes(self):
+        self._fake_launchers()
+        batch = Batch.create(self.commands, "batch", self.logs_dir)
+        assert_raises(ValueError, batch.generate_pbs_files, self.queue, worker_options=WorkerOptions(bad_node_failures=3))
+        pbs_filenames = batch.generate_pbs_files(self.queue, worker_options=WorkerOptions(bad_node_failures=3), autoresume=True)
+        assert_true("--badNodeFailures 3 " in open(pbs_filenames[0]).read())
+
+        # Jobs submitted once nodes are blocklisted avoid them.
+        batch.launch("qsub", pbs_filenames=pbs_filenames[:1])
+        assert_true("excludenodes" not in open(pbs_filenames[0]).read())
+        batch.command_manager.add_bad_node("node1")
+        batch.command_manager.add_bad_node("node2")
+        batch.launch("qsub", pbs_filenames=pbs_filenames)
+        pbs = open(pbs_filenames[0]).read()
+        assert_equal(pbs.count("#PBS -l excludenodes=node1:node2\n"), 1)
+        assert_true(pbs.index("excludenodes") < pbs.index("# Modules #"))
+
+        # Directives are updated rather than repeated.
+        assert_equal(batch_module.exclude_nodes(pbs, ["node3"]).count("excludenodes"), 1)
+        assert_true("#PBS -l excludenodes=node3\n" in batch_module.exclude_nodes(pbs, ["node3"]))
+
+    def test_launch_locally(self):
+        batch = Batch.create(self.commands + ["false"], "batch", self.logs_dir)
+        batch.generate_pbs_files(self.queue, pool=2)
+
+        jobs_id = batch.launch("local")
+        assert_equal(batch.jobs_id, jobs_id)
+        assert_equal(batch.wait(poll_interval=0.1, timeout=10), {'pending': 0, 'running': 0, 'finished': 3, 'failed': 1, 'timed_out': 0})
+        assert_true(batch.is_done())
@@ -0,0 +1,28 @@
+from nose.tools import assert_true, assert_false, assert_equal, assert_raises
+
+from smartdispatch.circuit_breaker import CircuitBreaker
+
+
+def test_should_pause():
+    circuit_breaker = CircuitBreaker(0.5, window=4)
+    assert_false(circuit_breaker.should_pause([]))
+    assert_false(circuit_breaker.should_pause([1, 1, 1]))
+    assert_true(circuit_breaker.should_pause([1, 1, 0, 0]))
+    assert_false(circuit_breaker.should_pause([1, 1, 0, 0, 0]))
+
+    assert_raises(ValueError, CircuitBreaker, 0)
+    assert_raises(ValueError, CircuitBreaker, 0.5, 0)
+
+
+def test_should_pause_first_completions():
+    # Checked over the first two completions, then over the last four.
+    circuit_breaker = CircuitBreaker(1, window=4, min_completions=2)
+    assert_false(circuit_breaker.should_pause([1]))
+    assert_true(circuit_breaker.should_pause([1, 1]))
+    assert_false(circuit_breaker.should_pause([0, 1, 1]))
+    assert_true(circuit_breaker.should_pause([0, 1, 1, 1, 1]))
+
+
+def test_to_dict():
+    circuit_breaker = CircuitBreaker.from_dict(CircuitBreaker(0.9, 50, 10, cancel_jobs=True).to_dict())
+    assert_equal((circuit_breaker.max_failure_rate, circuit_breaker.window, circuit_breaker.min_completions, circuit_breaker.cancel_jobs), (0.9, 50, 10, True))
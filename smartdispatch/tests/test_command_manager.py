@@ -1,9 +1,14 @@
 import os
+import time
 import unittest
 import tempfile as tmp
 import shutil
 
+from smartdispatch import command_manager as command_manager_module
 from smartdispatch.command_manager import CommandManager
+from smartdispatch.filelock import open_with_flock
+from smartdispatch.retry_policy import RetryPolicy
+from smartdispatch.circuit_breaker import CircuitBreaker
 from nose.tools import assert_equal, assert_true
 
 
@@ -75,6 +80,150 @@ class CommandFilesTests(unittest.TestCase):
 
         assert_true(not os.path.isfile(self.command_manager._finished_commands_filename))
 
+    def test_get_commands_to_run(self):
+        # The function to test
+        commands = self.command_manager.get_commands_to_run(2)
+
+        # Test validation
+        assert_equal(commands, [self.command1.strip(), self.command2.strip()])
+
+        with open(self.command_manager._commands_filename, "r") as commands_file:
+            assert_equal(commands_file.read(), self.command3)
+
+        with open(self.command_manager._running_commands_filename, "r") as running_commands_file:
+            assert_equal(running_commands_file.read(), self.command1 + self.command2)
+
+        assert_equal(self.command_manager.get_commands_to_run(2), [self.command3.strip()])
+        assert_equal(self.command_manager.get_commands_to_run(2), [])
+
+    def test_set_running_commands_as_finished(self):
+        # SetUp
+        commands = self.command_manager.get_commands_to_run(3)
+
+        # The function to test
+        self.command_manager.set_running_commands_as_finished(commands[:2], [0, 2])
+        self.command_manager.set_running_commands_as_pending(commands[2:])
+
+        # Test validation
+        with open(self.command_manager._running_commands_filename, "r") as running_commands_file:
+            assert_equal(running_commands_file.read(), "")
+
+        with open(self.command_manager._finished_commands_filename, "r") as finished_commands_file:
+            assert_equal(finished_commands_file.read(), self.command1)
+
+        assert_equal(self.command_manager.get_failed_commands(), [self.command2])
+        assert_equal(self.command_manager.get_pending_commands(), [self.command3.strip()])
+
+    def test_set_running_commands_as_timed_out(self):
+        # SetUp
+        commands = self.command_manager.get_commands_to_run(2)
+        assert_equal(self.command_manager.get_timed_out_commands(), [])
+
+        # The function to test
+        self.command_manager.set_running_commands_as_timed_out(commands[1:])
+
+        # Test validation
+        assert_equal(self.command_manager.get_running_commands(), [self.command1.strip()])
+        assert_equal(self.command_manager.get_timed_out_commands(), [self.command2.strip()])
+        assert_equal(self.command_manager.get_failed_commands(), [])
+
+    def test_speculative_copies(self):
+        # SetUp
+        command1, command2 = self.command_manager.get_commands_to_run(2)
+        self.command_manager.set_running_command_as_speculative(command1, time.time() - 60)
+        self.command_manager.set_running_command_as_speculative(command2, time.time())
+
+        # The command running for the longest time lags behind, once.
+        assert_equal(self.command_manager.get_straggler_to_duplicate(30), (command1, 0))
+        straggler, wait_time = self.command_manager.get_straggler_to_duplicate(30)
+        assert_equal(straggler, None)
+        assert_true(25 < wait_time <= 30)
+
+        # The first copy to succeed is kept, the other one is terminated.
+        assert_true(not self.command_manager.is_speculative_command_done(command1))
+        assert_true(self.command_manager.set_speculative_copy_as_done(command1, 0))
+        assert_true(self.command_manager.is_speculative_command_done(command1))
+        assert_true(not self.command_manager.set_speculative_copy_as_done(command1, -15))
+
+        # A failing copy is kept only if it is the last one.
+        self.command_manager.set_running_command_as_speculative(command1, time.time() - 60)
+        self.command_manager.get_straggler_to_duplicate(30)
+        assert_true(not self.command_manager.set_speculative_copy_as_done(command1, 1))
+        assert_true(self.command_manager.set_speculative_copy_as_done(command1, 1))
+
+        # An interrupted copy is resumed only if it is the last one.
+        self.command_manager.get_straggler_to_duplicate(0)
+        assert_true(not self.command_manager.release_speculative_copy(command2))
+        assert_true(self.command_manager.release_speculative_copy(command2))
+        assert_equal(self.command_manager.get_straggler_to_duplicate(0), (None, None))
+
+        # Commands that are not speculative are always kept.
+        assert_true(self.command_manager.set_speculative_copy_as_done(self.command3.strip(), 1))
+
+    def test_bad_nodes(self):
+        # SetUp
+        self.command_manager.set_circuit_breaker(CircuitBreaker(1, window=2))
+        command1, command2 = self.command_manager.get_commands_to_run(2)
+        self.command_manager.increment_command_attempts(command2)
+        self.command_manager.set_running_commands_as_finished([command1, command2], [1, 1])
+        assert_true(self.command_manager.is_paused())
+
+        assert_equal(self.command_manager.get_bad_nodes(), [])
+        self.command_manager.add_bad_node("node1")
+        self.command_manager.add_bad_node("node1")
+        assert_equal(self.command_manager.get_bad_nodes(), ["node1"])
+
+        # Only commands that failed go back to the pending ones, their failure is no longer counted.
+        self.command_manager.discard_failed_attempts([command2, "unknown"])
+        assert_equal(self.command_manager.get_failed_commands(), [command1 + "\n"])
+        assert_equal(self.command_manager.get_pending_commands(), [self.command3.strip(), command2])
+        assert_equal(self.command_manager.get_command_attempts(command2), 0)
+        assert_true(not self.command_manager.is_paused())
+
+    def test_circuit_breaker(self):
+        # SetUp
+        self.command_manager.set_circuit_breaker(CircuitBreaker(0.5, window=2))
+        command1, command2 = self.command_manager.get_commands_to_run(2)
+
+        # One failure out of two completed commands pauses the batch.
+        self.command_manager.set_running_command_as_finished(command1, 0)
+        assert_true(not self.command_manager.is_paused())
+        self.command_manager.set_running_commands_as_timed_out([command2])
+        assert_true(self.command_manager.is_paused())
+        assert_equal(self.command_manager.get_pause_reason(), "1 of the last 2 completed commands failed")
+        assert_equal(self.command_manager.get_commands_to_run(1), [])
+        assert_equal(self.command_manager.get_command_to_run(), None)
+
+        # Once resumed, failures that paused the batch are forgotten.
+        self.command_manager.resume()
+        assert_equal(self.command_manager.get_pause_reason(), None)
+        command3 = self.command_manager.get_command_to_run()
+        self.command_manager.set_running_commands_as_finished([command3], [1])
+        assert_true(not self.command_manager.is_paused())
+
+    def test_set_running_commands_as_pending_not_before(self):
+        # SetUp
+        command1 = self.command_manager.get_command_to_run()
+        self.command_manager.set_running_commands_as_pending([command1], not_before=time.time() + 60)
+
+        # The delayed command is skipped until its time.
+        assert_true(self.command_manager.get_next_start_time() > time.time() + 50)
+        assert_equal(self.command_manager.get_commands_to_run(3), [self.command2.strip(), self.command3.strip()])
+        self.command_manager.set_running_commands_as_pending([self.command2.strip()], not_before=time.time() - 1)
+        assert_equal(self.command_manager.get_commands_to_run(3), [self.command2.strip()])
+        assert_equal(self.command_manager.get_pending_commands(), [command1])
+
+    def test_get_next_start_time_with_flock(self):
+        # Locks taken on clusters supporting flock need files opened for writing.
+        self.addCleanup(setattr, command_manager_module, 'open_with_lock', command_manager_module.open_with_lock)
+        command_manager_module.open_with_lock = open_with_flock
+
+        assert_equal(self.command_manager.get_next_start_time(), None)
+        command1 = self.command_manager.get_command_to_run()
+        not_before = time.time() + 60
+        self.command_manager.set_running_commands_as_pending([command1], not_before=not_before)
+        assert_equal(self.command_manager.get_next_start_time(), not_before)
+
     def test_get_nb_commands_to_run(self):
         assert_equal(self.command_manager.get_nb_commands_to_run(), self.nb_commands)
 
@@ -149,3 +298,118 @@ class CommandFilesTests(unittest.TestCase):
             assert_equal(running_commands_file.read(), "")
 
         assert_true(not os.path.isfile(self.command_manager._finished_commands_filename))
+
+    def test_add_command_timing(self):
+        # SetUp
+        command = self.command_manager.get_command_to_run()
+
+        # The function to test
+        self.command_manager.add_command_timing(command, 4.2, 1, node_name="node1")
+
+        # Test validation
+        timings = self.command_manager.get_commands_timings()
+        assert_equal(len(timings), 1)
+        assert_equal(timings[0]['command'], command)
+        assert_equal(timings[0]['duration'], 4.2)
+        assert_equal(timings[0]['error_code'], 1)
+        assert_equal(timings[0]['node_name'], "node1")
+
+    def test_add_commands_timings(self):
+        # The function to test
+        self.command_manager.add_commands_timings(["1", "2"], [0.5, 1.5], [0, 1], node_name="node1")
+
+        # Test validation
+        timings = self.command_manager.get_commands_timings()
+        assert_equal([timing['command'] for timing in timings], ["1", "2"])
+        assert_equal([timing['duration'] for timing in timings], [0.5, 1.5])
+        assert_equal([timing['error_code'] for timing in timings], [0, 1])
+        assert_equal([timing['node_name'] for timing in timings], ["node1", "node1"])
+
+    def test_get_commands_timings_empty(self):
+        assert_equal(self.command_manager.get_commands_timings(), [])
+
+    def test_get_pending_commands(self):
+        assert_equal(self.command_manager.get_pending_commands(), [self.command1.strip(), self.command2.strip(), self.command3.strip()])
+
+    def test_set_commands_to_run_with_priorities(self):
+        # The function to test
+        self.command_manager.set_commands_to_run(["4", "5", "6"], priorities=[(0, 1), (1, 0), (0, 2)])
+
+        # Test validation: commands without priority (i.e. 0) keep their order.
+        with open(self.command_manager._commands_filename, "r") as commands_file:
+            assert_equal(commands_file.read(), "5\n6\n4\n" + self.command1 + self.command2 + self.command3)
+
+        assert_equal(self.command_manager.get_command_to_run(), "5")
+        assert_equal(self.command_manager.get_command_to_run(), "6")
+
+    def test_set_running_command_as_pending_with_priorities(self):
+        # SetUp
+        self.command_manager.set_commands_to_run(["4", "5"], priorities=[(0, 2), (0, 1)])
+        command = self.command_manager.get_command_to_run()
+        assert_equal(command, "4")
+
+        # The function to test
+        self.command_manager.set_running_command_as_pending(command)
+
+        # Test validation: goes back in front of lower priority commands.
+        with open(self.command_manager._commands_filename, "r") as commands_file:
+            assert_equal(commands_file.read(), "4\n5\n" + self.command1 + self.command2 + self.command3)
+
+        with open(self.command_manager._running_commands_filename, "r") as running_commands_file:
+            assert_equal(running_commands_file.read(), "")
+
+    def test_set_running_commands_as_pending_with_priorities_bisects(self):
+        # SetUp
+        commands = ["echo {0}".format(i) for i in range(1000)]
+        self.command_manager.set_commands_to_run(commands, priorities=[(1, -i) for i in range(1000)])
+        claimed_commands = self.command_manager.get_commands_to_run(2)
+        self.command_manager.set_running_commands_as_pending(claimed_commands[:1], not_before=time.time() + 60)
+
+        # The function to test: only the priority of a few pending commands is looked up.
+        uids = []
+        generate_uid_from_string = command_manager_module.generate_uid_from_string
+        self.addCleanup(setattr, command_manager_module, 'generate_uid_from_string', generate_uid_from_string)
+        command_manager_module.generate_uid_from_string = lambda command: uids.append(command) or generate_uid_from_string(command)
+        self.command_manager.set_running_commands_as_pending(claimed_commands[1:])
+        self.command_manager.get_commands_to_run(2)
+        assert_true(len(uids) < 20)
+
+        # Test validation: the delayed command is skipped, the other one claimed again first.
+        assert_equal(self.command_manager.get_pending_commands()[:3], ["echo 0", "echo 3", "echo 4"])
+
+    def test_reset_running_commands_with_priorities(self):
+        # SetUp
+        self.command_manager.set_commands_to_run(["4", "5"], priorities=[(0, 2), (0, 1)])
+        self.command_manager.get_command_to_run()
+        self.command_manager.get_command_to_run()
+
+        # The function to test
+        self.command_manager.reset_running_commands()
+
+        # Test validation
+        with open(self.command_manager._commands_filename, "r") as commands_file:
+            assert_equal(commands_file.read(), "4\n5\n" + self.command1 + self.command2 + self.command3)
+
+    def test_get_retry_policy(self):
+        assert_equal(self.command_manager.get_retry_policy(), None)
+
+        # The function to test
+        self.command_manager.set_retry_policy(RetryPolicy(3, backoff=10))
+
+        # Test validation
+        retry_policy = self.command_manager.get_retry_policy()
+        assert_equal(retry_policy.max_attempts, 3)
+        assert_equal(retry_policy.backoff, 10)
+
+    def test_increment_command_attempts(self):
+        assert_equal(self.command_manager.get_command_attempts("1"), 0)
+
+        # The function to test
+        assert_equal(self.command_manager.increment_command_attempts("1"), 1)
+        assert_equal(self.command_manager.increment_command_attempts("1"), 2)
+        assert_equal(self.command_manager.increment_command_attempts("2"), 1)
+
+        # Test validation
+        assert_equal(self.command_manager.get_command_attempts("1"), 2)
+        assert_equal(self.command_manager.get_command_attempts("2"), 1)
+        assert_equal(self.command_manager.get_command_attempts("3"), 0)
@@ -0,0 +1,74 @@
+import os
+import time
+import unittest
+import tempfile
+import shutil
+from os.path import join as pjoin
+
+from nose.tools import assert_equal, assert_true, assert_false
+
+from smartdispatch.command_manager import CommandManager
+from smartdispatch.completion import CompletionIndex, are_outputs_up_to_date, filter_completed_commands
+
+
+class TestCompletionIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.logs_dir = tempfile.mkdtemp()
+        self.commands = ["echo 1", "echo 2", "echo 3"]
+
+        os.makedirs(pjoin(self.logs_dir, "batch", "commands"))
+        command_manager = CommandManager(pjoin(self.logs_dir, "batch", "commands", "commands.txt"))
+        command_manager.set_commands_to_run(self.commands)
+        command_manager.set_running_command_as_finished(command_manager.get_command_to_run(), 0)
+        command_manager.set_running_command_as_finished(command_manager.get_command_to_run(), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.logs_dir)
+
+    def test_update(self):
+        completion_index = CompletionIndex(self.logs_dir)
+        assert_equal(len(completion_index), 0)
+
+        completion_index.update()
+        assert_true("echo 1" in completion_index)
+        assert_false("echo 2" in completion_index)
+        assert_false("echo 3" in completion_index)
+
+        # Completions are remembered once the batch folder is deleted.
+        shutil.rmtree(pjoin(self.logs_dir, "batch"))
+        completion_index = CompletionIndex(self.logs_dir)
+        completion_index.update()
+        assert_equal(len(completion_index), 1)
+        assert_true("echo 1" in completion_index)
+
+    def test_filter_completed_commands(self):
+        completion_index = CompletionIndex(self.logs_dir)
+        completion_index.update()
+
+        commands, nb_completed, nb_duplicates = filter_completed_commands(["echo 3", "echo 1", "echo 2", "echo 3"], completion_index)
+        assert_equal(commands, ["echo 3", "echo 2"])
+        assert_equal(nb_completed, 1)
+        assert_equal(nb_duplicates, 1)
+
+
+def test_are_outputs_up_to_date():
+    testing_dir = tempfile.mkdtemp()
+    try:
+        data_filename = pjoin(testing_dir, "data.csv")
+        model_filename = pjoin(testing_dir, "model.pkl")
+        command = "python train.py #sd: outputs={0} inputs={1}".format(model_filename, data_filename)
+
+        assert_false(are_outputs_up_to_date("python train.py"))
+        open(data_filename, 'w').close()
+        assert_false(are_outputs_up_to_date(command))
+
+        open(model_filename, 'w').close()
+        assert_true(are_outputs_up_to_date(command))
+        assert_true(are_outputs_up_to_date("python train.py #sd: outputs={0}".format(model_filename)))
+
+        # Inputs modified after the outputs were produced.
+        os.utime(data_filename, (time.time() + 10, time.time() + 10))
+        assert_false(are_outputs_up_to_date(command))
+    finally:
+        shutil.rmtree(testing_dir)
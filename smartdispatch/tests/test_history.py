@@ -0,0 +1,112 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+from smartdispatch import history
+from smartdispatch.command_manager import CommandManager
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+def test_normalize_command():
+    assert_equal(history.normalize_command("python train.py --lr 0.1 --seed 42"), "python train.py --lr {NUM} --seed {NUM}")
+    assert_equal(history.normalize_command("python train.py --lr=1e-3"), "python train.py --lr={NUM}")
+    assert_equal(history.normalize_command("python train.py model2 -n -3"), "python train.py model2 -n {NUM}")
+    assert_equal(history.normalize_command("echo " + "a1" * 32), "echo {UID}")
+    assert_equal(history.normalize_command("python train.py --lr 0.1"), history.normalize_command("python train.py --lr 0.01"))
+
+
+def test_compute_makespan():
+    assert_equal(history.compute_makespan([], 2), 0)
+    assert_equal(history.compute_makespan([1, 1, 1, 1], 1), 4)
+    assert_equal(history.compute_makespan([1, 1, 1, 1], 2), 2)
+    assert_equal(history.compute_makespan([3, 1, 1, 1], 2), 3)
+    assert_equal(history.compute_makespan([1, 1, 1, 3], 2), 4)
+    assert_equal(history.compute_makespan([1, 1, 1, 1], 10), 1)
+
+
+def test_suggest_pool_and_walltime():
+    durations = [3600.] * 10
+    pool, walltime, explanation = history.suggest_pool_and_walltime(durations, 2 * 3600)
+    assert_equal(pool, 5)
+    assert_equal(walltime, "0:02:24:00")  # 2h + 20%
+    assert_true(len(explanation) > 0)
+
+    # Target shorter than the longest command.
+    pool, walltime, explanation = history.suggest_pool_and_walltime(durations, 60)
+    assert_equal(pool, 10)
+    assert_equal(walltime, "0:01:12:00")
+
+    # Walltime capped by the queue.
+    pool, walltime, explanation = history.suggest_pool_and_walltime(durations, 10 * 3600, max_walltime=3 * 3600)
+    assert_equal(pool, 1)
+    assert_equal(walltime, "0:03:00:00")
+    assert_true("capped" in explanation[-1])
+
+
+def test_suggest_backfill_shape():
+    durations = [3600.] * 10
+    walltimes = [3600., 2 * 3600., 4 * 3600.]
+
+    # Without queue waits, the shortest jobs not splitting commands are chosen, with as many workers as commands.
+    pool, walltime, explanation = history.suggest_backfill_shape(durations, walltimes)
+    assert_equal((pool, walltime), (10, "0:02:00:00"))
+    assert_equal(len(explanation), 4)
+    assert_true("2 round(s)" in explanation[1])
+
+    # Longer jobs starting much sooner.
+    pool, walltime, explanation = history.suggest_backfill_shape(durations, walltimes, [7200., 9000., 0.])
+    assert_equal((pool, walltime), (4, "0:04:00:00"))
+
+
+class TestCommandHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.logs_dir = tempfile.mkdtemp()
+
+        for batch_id, durations in enumerate([[10, 20], [30, 40, 1000]]):
+            path_job_commands = os.path.join(self.logs_dir, "batch{0}".format(batch_id), "commands")
+            os.makedirs(path_job_commands)
+            command_manager = CommandManager(os.path.join(path_job_commands, "commands.txt"))
+            for i, duration in enumerate(durations):
+                command_manager.add_command_timing("python train.py --lr 0.{0}".format(i), duration)
+
+        # Failed commands are ignored.
+        command_manager.add_command_timing("python train.py --lr 0.9", 1, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.logs_dir)
+
+    def test_estimate_duration(self):
+        command_history = history.CommandHistory(self.logs_dir)
+
+        assert_equal(len(command_history), 5)
+        assert_equal(command_history.estimate_duration("python train.py --lr 0.5"), 30)
+        assert_equal(command_history.estimate_duration("python test.py --lr 0.5"), None)
+        assert_equal(command_history.estimate_duration("python test.py --lr 0.5", default=42), 42)
+
+    def test_get_batch_timings(self):
+        timings = history.get_batch_timings(os.path.join(self.logs_dir, "batch0"))
+        assert_equal([timing['duration'] for timing in timings], [10, 20])
+
+    def test_estimate_durations(self):
+        durations, explanation = history.estimate_durations(["python train.py --lr 0.5", "python test.py"], self.logs_dir)
+        assert_equal(durations, [30, 30])
+        assert_true("1 command(s) without history" in explanation[0])
+
+        assert_equal(history.estimate_durations(["python test.py"], self.logs_dir), (None, []))
+        durations, _ = history.estimate_durations(["python train.py --lr 0.5"], self.logs_dir, batch_uid="batch0")
+        assert_equal(durations, [20])
+
+    def test_get_commands_priorities(self):
+        commands = ["python train.py --lr 0.5", "python test.py  #sd: cost=1:00", "python test.py 2  #sd: priority=3"]
+        assert_equal(history.get_commands_priorities(commands[:2], self.logs_dir), None)
+        assert_equal(history.get_commands_priorities(commands, self.logs_dir), [(0, 0), (0, 0), (3, 0)])
+        assert_equal(history.get_commands_priorities(commands, self.logs_dir, order="lpt"), [(0, 30), (0, 60), (3, 30)])
+        assert_equal(history.get_commands_priorities(commands, self.logs_dir, order="lpt", costs_from="batch0"), [(0, 20), (0, 60), (3, 20)])
+
+        # Annotations without a valid value are reported.
+        assert_raises(ValueError, history.get_commands_priorities, ["python test.py  #sd: cost"], self.logs_dir, order="lpt")
+        assert_raises(ValueError, history.get_commands_priorities, ["python test.py  #sd: cost=1h"], self.logs_dir, order="lpt")
+        assert_raises(ValueError, history.get_commands_priorities, ["python test.py  #sd: priority"], self.logs_dir)
@@ -121,6 +121,20 @@ class TestJobGenerator(object):
 
         yield self._test_add_pbs_flags, self.pbs_flags
 
+    def test_add_staging(self):
+        job_generator = JobGenerator(self.queue, self.commands, prolog=self.prolog, epilog=self.epilog, base_path="/logs/batch")
+        job_generator.add_staging(["/data/dataset"], ["checkpoints/*"], "/results")
+
+        pbs = job_generator.pbs_list[0]
+        assert_equal(pbs.prolog[0], self.prolog[0])
+        assert_true(pbs.prolog[1].endswith('/smartdispatch_"batch"_$(hostname)"'))
+        assert_true('cp -r /data/dataset "$SD_SCRATCH_DIR/in/" || rm -rf "$SD_SCRATCH_DIR/in/"dataset; ' in pbs.prolog[4])
+        assert_true('export SD_STAGE_OUT_MANIFEST=/logs/batch/staged_outputs.txt' in pbs.prolog)
+        assert_true(pbs.prolog[-1].startswith('[ ! -f "$SD_STAGE_OUT_MANIFEST" ] || (cd /results && '))
+        assert_equal(pbs.epilog[0], self.epilog[0])
+        assert_true("for PATTERN in 'checkpoints/*'; do" in pbs.epilog[2])
+        assert_equal(pbs.epilog[-2], 'rm -rf "$SD_STAGE_OUT_DIR"')
+
     def test_add_pbs_flags_invalid(self):
         assert_raises(ValueError, self._test_add_pbs_flags, 'weeee')
 
@@ -0,0 +1,85 @@
+import os
+import time
+import unittest
+import tempfile
+import shutil
+
+from smartdispatch.pbs import PBS
+from smartdispatch.local_executor import LocalJob, launch_jobs_locally, get_pbs_infos
+
+from nose.tools import assert_true, assert_equal
+
+
+class TestLocalExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def _write_pbs(self, name, commands, ppn=1, walltime="1:00", epilog=[]):
+        pbs = PBS("queue", walltime)
+        pbs.add_options(o='"{0}/"$PBS_JOBID".out"'.format(self.testing_dir), e='"{0}/"$PBS_JOBID".err"'.format(self.testing_dir))
+        pbs.add_resources(nodes="1:ppn={0}".format(ppn))
+        pbs.add_commands(*commands)
+        pbs.add_to_epilog(*epilog)
+
+        pbs_filename = os.path.join(self.testing_dir, name)
+        pbs.save(pbs_filename)
+        return pbs_filename
+
+    def test_get_pbs_infos(self):
+        pbs_filename = self._write_pbs("job.sh", ["echo 1"], ppn=4)
+        options, resources = get_pbs_infos(pbs_filename)
+        assert_equal(options['q'], "queue")
+        assert_equal(resources['nodes'], "1:ppn=4")
+        assert_equal(resources['walltime'], "1:00")
+
+    def test_local_job(self):
+        job = LocalJob(self._write_pbs("job.sh", ["echo $PBS_JOBID $PBS_WALLTIME"], ppn=4), "42.local")
+        assert_equal(job.nb_cores, 4)
+        assert_equal(job.walltime, 60)
+
+        job.start()
+        while job.poll() is None:
+            time.sleep(0.1)
+
+        assert_equal(job.poll(), 0)
+        assert_equal(open(os.path.join(self.testing_dir, "42.local.out")).read().strip(), "42.local 60")
+
+    def test_local_job_walltime(self):
+        job = LocalJob(self._write_pbs("job.sh", ["sleep 10"], walltime="0:01"), "42.local")
+        start_time = time.time()
+        job.start()
+        while job.poll() is None:
+            time.sleep(0.1)
+
+        assert_true(time.time() - start_time < 5)
+        assert_true(job.poll() != 0)
+
+    def test_launch_jobs_locally(self):
+        # Two jobs of 2 cores on 2 cores: they have to run one after the other.
+        output_filename = os.path.join(self.testing_dir, "output")
+        pbs_filenames = [self._write_pbs("job{0}.sh".format(i), ["echo start >> {0}; sleep 0.5; echo end >> {0}".format(output_filename)], ppn=2)
+                         for i in range(2)]
+
+        jobs_id = launch_jobs_locally(pbs_filenames, nb_cores=2)
+
+        assert_equal(len(set(jobs_id)), 2)
+        assert_equal(open(output_filename).read().split(), ["start", "end", "start", "end"])
+
+    def test_launch_jobs_locally_with_workers(self):
+        # A job of four workers of 1 core on 2 cores: two of them have to wait for the others.
+        output_filename = os.path.join(self.testing_dir, "output")
+        workers = ["(echo start >> {0}; sleep 0.5; echo end >> {0}) &  # base_worker.py {1}".format(output_filename, i) for i in range(4)]
+        pbs_filename = self._write_pbs("job.sh", workers, ppn=4, epilog=["wait"])
+
+        job = LocalJob(pbs_filename, "42.local")
+        assert_equal((job.nb_cores_per_worker, job.nb_cores), (1, 4))
+
+        jobs_id = launch_jobs_locally([pbs_filename], nb_cores=2)
+
+        assert_equal(len(jobs_id), 2)
+        assert_equal(open(output_filename).read().split(), ["start", "start", "end", "end"] * 2)
+        assert_equal(sorted(filename for filename in os.listdir(self.testing_dir) if filename.startswith("job.sh")), ["job.sh"])
@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+import tempfile
+import shutil
+from os.path import join as pjoin
+
+from nose.tools import assert_equal
+
+from smartdispatch import preload
+
+
+def test_get_python_entry_point():
+    python = sys.executable
+    assert_equal(preload.get_python_entry_point(python + " train.py --lr 0.1 --name 'a b'"), ('script', "train.py", ["train.py", "--lr", "0.1", "--name", "a b"]))
+    assert_equal(preload.get_python_entry_point(python + " -m package.train --lr=0.1  #sd: priority=1"), ('module', "package.train", ["package.train", "--lr=0.1"]))
+
+    # Left to the shell.
+    assert_equal(preload.get_python_entry_point(python + " train.py > out.txt"), None)
+    assert_equal(preload.get_python_entry_point(python + " train.py --seed $RANDOM"), None)
+    assert_equal(preload.get_python_entry_point(python + " -u train.py"), None)
+    assert_equal(preload.get_python_entry_point("echo train.py"), None)
+    assert_equal(preload.get_python_entry_point("python_not_found train.py"), None)
+
+
+class TestForkedProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.script_filename = pjoin(self.testing_dir, "script.py")
+        with open(self.script_filename, 'w') as script_file:
+            script_file.write("import os, sys\n"
+                              "print __name__, sys.argv[1:], os.environ.get('SD_TEST')\n"
+                              "if sys.argv[1] == 'fail':\n"
+                              "    raise ValueError('failed')\n"
+                              "sys.exit(int(sys.argv[1]))\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def _run(self, argv, env=None):
+        with open(pjoin(self.testing_dir, "out"), 'w') as stdout_file:
+            with open(pjoin(self.testing_dir, "err"), 'w') as stderr_file:
+                proc = preload.ForkedProcess(('script', self.script_filename, [self.script_filename] + argv), stdout_file, stderr_file, env)
+                error_code = proc.wait()
+
+        return error_code, open(pjoin(self.testing_dir, "out")).read(), open(pjoin(self.testing_dir, "err")).read()
+
+    def test_exit_code(self):
+        error_code, stdout, _ = self._run(["0"], dict(os.environ, SD_TEST="1"))
+        assert_equal(error_code, 0)
+        assert_equal(stdout, "__main__ ['0'] 1\n")
+
+        assert_equal(self._run(["3"])[0], 3)
+
+    def test_exception(self):
+        error_code, _, stderr = self._run(["fail"])
+        assert_equal(error_code, 1)
+        assert_equal(stderr.strip().split("\n")[-1], "ValueError: failed")
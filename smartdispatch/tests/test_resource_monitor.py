@@ -0,0 +1,42 @@
+import sys
+from subprocess import Popen
+
+from nose.tools import assert_true, assert_equal
+
+from smartdispatch.resource_monitor import ResourceMonitor, recommend_resources, format_recommendations
+
+
+def test_resource_monitor():
+    # A process allocating ~50Mb then spinning for a while.
+    proc = Popen([sys.executable, "-c", "import time; a = ' ' * 50 * 1024 ** 2; t = time.time()\nwhile time.time() - t < 0.5: pass"])
+    resource_monitor = ResourceMonitor(proc.pid, interval=0.05)
+    resource_monitor.start()
+    proc.wait()
+    usage = resource_monitor.stop()
+
+    assert_true(resource_monitor.nb_samples > 0)
+    assert_true(usage['cpu_time'] > 0.3)
+    assert_true(usage['peak_rss'] > 50 * 1024 ** 2)
+    assert_true(usage['max_threads'] >= 1)
+
+
+def test_resource_monitor_process_done():
+    proc = Popen(["true"])
+    proc.wait()
+
+    resource_monitor = ResourceMonitor(proc.pid)
+    resource_monitor.sample()
+    assert_equal(resource_monitor.nb_samples, 0)
+
+
+def test_recommend_resources():
+    assert_equal(recommend_resources([{'duration': 10}]), None)
+
+    timings = [{'duration': 100, 'cpu_time': 100 * parallelism, 'peak_rss': 2 * 1024 ** 3, 'max_threads': 4, 'read_bytes': 0, 'write_bytes': 1024 ** 3}
+               for parallelism in [1.9] * 9 + [3.5]]
+    recommendations = recommend_resources(timings)
+    assert_equal(recommendations['nb_commands'], 10)
+    assert_equal(recommendations['cores_per_command'], 2)
+    assert_equal(recommendations['mem_per_command'], 2.4)
+    assert_equal(recommendations['max_threads'], 4)
+    assert_true("--coresPerCommand 2" in format_recommendations(recommendations))
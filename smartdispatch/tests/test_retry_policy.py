@@ -0,0 +1,38 @@
+from nose.tools import assert_true, assert_false, assert_equal, assert_raises
+
+from smartdispatch.retry_policy import RetryPolicy
+
+
+def test_should_retry():
+    retry_policy = RetryPolicy(max_attempts=3)
+    assert_false(retry_policy.should_retry(0, 1))
+    assert_true(retry_policy.should_retry(1, 1))
+    assert_true(retry_policy.should_retry(1, 2))
+    assert_false(retry_policy.should_retry(1, 3))
+
+
+def test_should_retry_no_retry():
+    assert_false(RetryPolicy().should_retry(1, 1))
+    assert_raises(ValueError, RetryPolicy, 0)
+
+
+def test_should_retry_exit_codes():
+    retry_policy = RetryPolicy(max_attempts=3, retry_on_exit_codes=[1, 2], never_retry_on_exit_codes=[2])
+    assert_true(retry_policy.should_retry(1, 1))
+    assert_false(retry_policy.should_retry(2, 1))
+    assert_false(retry_policy.should_retry(3, 1))
+
+    retry_policy = RetryPolicy(max_attempts=3, never_retry_on_exit_codes=[2])
+    assert_true(retry_policy.should_retry(1, 1))
+    assert_false(retry_policy.should_retry(2, 1))
+    assert_true(retry_policy.should_retry(3, 1))
+
+
+def test_get_backoff():
+    retry_policy = RetryPolicy(max_attempts=4, backoff=10, backoff_factor=3)
+    assert_equal([retry_policy.get_backoff(attempt) for attempt in [1, 2, 3]], [10, 30, 90])
+
+
+def test_to_dict():
+    retry_policy = RetryPolicy(4, [1], [2], 10, 3)
+    assert_equal(RetryPolicy.from_dict(retry_policy.to_dict()).to_dict(), retry_policy.to_dict())
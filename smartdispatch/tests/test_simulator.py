@@ -0,0 +1,109 @@
+import os
+import tempfile
+import shutil
+
+from nose.tools import assert_true, assert_equal, assert_almost_equal, assert_raises
+
+from smartdispatch import simulator
+from smartdispatch.pbs import PBS
+from smartdispatch.queue import Queue
+from smartdispatch.command_manager import CommandManager
+
+
+def make_pbs_list(nb_jobs, nb_slots, walltime="1:00:00"):
+    pbs_list = []
+    for _ in range(nb_jobs):
+        pbs = PBS("queue", walltime)
+        pbs.add_commands(*["worker"] * nb_slots)
+        pbs_list.append(pbs)
+
+    return pbs_list
+
+
+def test_simulate():
+    report = simulator.simulate(make_pbs_list(2, 2), [60.] * 8)
+    assert_equal(report['makespan'], 120)
+    assert_equal(report['nb_jobs'], 2)
+    assert_equal(report['node_time'], 240)
+    assert_equal(report['utilization'], 1)
+    assert_equal(report['tail_idle_time'], 0)
+    assert_equal(report['nb_unfinished_commands'], 0)
+
+
+def test_simulate_tail_idle_time():
+    report = simulator.simulate(make_pbs_list(1, 2), [60., 10., 10.])
+    assert_equal(report['makespan'], 60)
+    assert_equal(report['tail_idle_time'], 40)
+    assert_almost_equal(report['utilization'], 80. / 120.)
+    assert_almost_equal(report['wasted_node_time'], 20.)
+
+
+def test_simulate_max_nb_jobs():
+    report = simulator.simulate(make_pbs_list(2, 1), [60.] * 2, max_nb_jobs=1, queue_wait=5)
+    assert_equal(report['makespan'], 130)
+
+
+def test_simulate_walltime():
+    report = simulator.simulate(make_pbs_list(1, 1, walltime="1:00"), [50., 50.])
+    assert_equal(report['makespan'], 60)
+    assert_equal(report['nb_killed_commands'], 1)
+    assert_equal(report['nb_unfinished_commands'], 1)
+
+    # Killed commands are resumed in a resubmitted job.
+    report = simulator.simulate(make_pbs_list(1, 1, walltime="1:00"), [50., 50.], autoresume=True)
+    assert_equal(report['makespan'], 100)
+    assert_equal(report['nb_jobs'], 2)
+    assert_equal(report['nb_unfinished_commands'], 0)
+
+
+def test_duration_models():
+    commands = ["echo 1", "echo 2", "echo 3"]
+    assert_equal(simulator.get_duration_model("42").sample(commands), [42] * 3)
+    assert_equal(simulator.get_duration_model("1:00").sample(commands), [60] * 3)
+
+    durations = simulator.get_duration_model("uniform:10,20").sample(commands)
+    assert_true(all(10 <= duration <= 20 for duration in durations))
+    assert_equal(durations, simulator.get_duration_model("uniform:10,20").sample(commands))  # Seeded
+
+    assert_raises(ValueError, simulator.DistributionDurations, "unknown", [])
+
+
+def test_history_duration_model():
+    logs_dir = tempfile.mkdtemp()
+    try:
+        path_job_commands = os.path.join(logs_dir, "batch", "commands")
+        os.makedirs(path_job_commands)
+        command_manager = CommandManager(os.path.join(path_job_commands, "commands.txt"))
+        command_manager.add_command_timing("echo 1", 10)
+        command_manager.add_command_timing("echo 2", 20)
+
+        duration_model = simulator.get_duration_model("batch:batch", logs_dir)
+        assert_equal(duration_model.sample(["echo 1", "echo 2", "ls"]), [10, 20, 20])
+        assert_raises(ValueError, duration_model.sample, ["ls"])
+    finally:
+        shutil.rmtree(logs_dir)
+
+
+def test_simulate_commands():
+    commands = ["echo 1", "echo 2", "echo 3"]
+    queue = Queue("test", None, "1:00:00", 2, 0, 32)
+    pbs_list, report = simulator.simulate_commands(commands, queue, simulator.ConstantDurations(60.))
+    assert_equal(len(pbs_list), 2)  # One worker per command, two per node.
+    assert_equal(report['makespan'], 60)
+
+    # Commands are executed by priority.
+    class RecordedDurations(object):
+        def sample(self, commands):
+            self.commands = commands
+            return [60.] * len(commands)
+
+    durations = RecordedDurations()
+    pbs_list, report = simulator.simulate_commands(commands, queue, durations, pool=1, priorities=[(0, 10), (1, 0), (0, 20)])
+    assert_equal(durations.commands, ["echo 2", "echo 3", "echo 1"])
+    assert_equal(len(pbs_list), 1)
+    assert_equal(report['makespan'], 180)
+
+def test_format_report():
+    report = simulator.simulate(make_pbs_list(1, 1, walltime="1:00"), [50., 50.])
+    assert_true("Makespan: 0:00:01:00" in simulator.format_report(report))
+    assert_true("unfinished: 1 of 2" in simulator.format_report(report))
@@ -0,0 +1,141 @@
+import os
+import unittest
+import tempfile
+import shutil
+from subprocess import Popen
+
+from nose.tools import assert_equal, assert_true
+
+from smartdispatch import slot_allocator
+from smartdispatch.slot_allocator import SlotAllocator
+
+
+class TestSlotAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.state_filename = os.path.join(self.testing_dir, "slots.json")
+        self.slots = [[0, 1], [2, 3]]
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def test_acquire(self):
+        allocator = SlotAllocator(self.state_filename, self.slots)
+        assert_equal(allocator.acquire(), (0, [0, 1]))
+        assert_equal(allocator.acquire(), (1, [2, 3]))
+        assert_equal(allocator.acquire(), (None, None))
+
+        # Another worker shares the same state.
+        assert_equal(SlotAllocator(self.state_filename, self.slots).acquire(), (None, None))
+
+    def test_release(self):
+        allocator = SlotAllocator(self.state_filename, self.slots)
+        allocator.acquire()
+        allocator.acquire()
+
+        allocator.release(0)
+        assert_equal(allocator.acquire(), (0, [0, 1]))
+
+    def test_acquire_from_dead_owner(self):
+        proc = Popen(["true"])
+        proc.wait()
+
+        allocator = SlotAllocator(self.state_filename, self.slots[:1])
+        assert_equal(allocator.acquire(owner=proc.pid), (0, [0, 1]))
+        assert_equal(allocator.acquire(), (0, [0, 1]))
+
+
+    def test_acquire_with_other_slots(self):
+        allocator = SlotAllocator(self.state_filename, self.slots)
+        assert_equal(allocator.acquire(), (0, [0, 1]))
+
+        # A worker of another job splitting the same CPUs differently never gets CPUs already held.
+        other_allocator = SlotAllocator(self.state_filename, [[0], [1], [2], [3]])
+        assert_equal(other_allocator.acquire(), (2, [2]))
+        assert_equal(allocator.acquire(), (None, None))
+
+        allocator.release(0)
+        assert_equal(other_allocator.acquire(), (0, [0]))
+
+
+def test_get_state_filename():
+    # Jobs sharing a node share their slots.
+    assert_equal(slot_allocator.get_state_filename("cpus", "node1", "user"), slot_allocator.get_state_filename("cpus", "node1", "user"))
+    assert_true(slot_allocator.get_state_filename("cpus", "node1", "user") != slot_allocator.get_state_filename("cpus", "node2", "user"))
+    assert_true(slot_allocator.get_state_filename("cpus", "node1", "user") != slot_allocator.get_state_filename("gpus", "node1", "user"))
+
+
+def test_parse_cpu_list():
+    assert_equal(slot_allocator.parse_cpu_list("0-3,8,10-11\n"), [0, 1, 2, 3, 8, 10, 11])
+    assert_equal(slot_allocator.parse_cpu_list(""), [])
+
+
+def test_get_numa_nodes():
+    sys_path = tempfile.mkdtemp()
+    try:
+        for i, cpu_list in enumerate(["0-1,4-5", "2-3,6-7"]):
+            os.mkdir(os.path.join(sys_path, "node{0}".format(i)))
+            with open(os.path.join(sys_path, "node{0}".format(i), "cpulist"), 'w') as cpu_list_file:
+                cpu_list_file.write(cpu_list + "\n")
+
+        assert_equal(slot_allocator.get_numa_nodes(sys_path), [[0, 1, 4, 5], [2, 3, 6, 7]])
+    finally:
+        shutil.rmtree(sys_path)
+
+
+def test_get_cpu_slots():
+    cpus = range(8)
+    assert_equal(slot_allocator.get_cpu_slots(2, cpus), [[0, 1], [2, 3], [4, 5], [6, 7]])
+    assert_equal(slot_allocator.get_cpu_slots(3, cpus), [[0, 1, 2], [3, 4, 5]])
+
+    # Slots are aligned to NUMA nodes.
+    numa_nodes = [[0, 2, 4, 6], [1, 3, 5, 7]]
+    assert_equal(slot_allocator.get_cpu_slots(2, cpus, numa_nodes), [[0, 2], [4, 6], [1, 3], [5, 7]])
+    assert_equal(slot_allocator.get_cpu_slots(3, cpus, numa_nodes), [[0, 2, 4], [1, 3, 5], ])
+    assert_equal(slot_allocator.get_cpu_slots(3, range(7), numa_nodes), [[0, 2, 4], [1, 3, 5]])
+
+    # Only allowed CPUs are used, leftovers of NUMA nodes are put together.
+    assert_equal(slot_allocator.get_cpu_slots(2, [0, 1, 2, 3, 5], numa_nodes), [[0, 2], [1, 3]])
+    assert_equal(slot_allocator.get_cpu_slots(2, [0, 2, 4, 1, 3], numa_nodes), [[0, 2], [1, 3], ])
+    assert_equal(slot_allocator.get_cpu_slots(2, [0, 2, 4, 1], numa_nodes), [[0, 2], [1, 4]])
+
+
+def test_wrap_with_taskset():
+    assert_equal(slot_allocator.wrap_with_taskset("echo 'a' | cat", [0, 2]), "taskset -c 0,2 sh -c 'echo '\"'\"'a'\"'\"' | cat'")
+
+
+def test_get_gpu_devices():
+    testing_dir = tempfile.mkdtemp()
+    try:
+        # From the GPU file of the job, only the GPUs of this node.
+        gpu_filename = os.path.join(testing_dir, "gpufile")
+        with open(gpu_filename, 'w') as gpu_file:
+            gpu_file.write("node1-gpu1\nnode1-gpu3\nnode2-gpu0\n")
+
+        assert_equal(slot_allocator.get_gpu_devices(gpu_filename, "node1"), ["1", "3"])
+        assert_equal(slot_allocator.get_gpu_devices(gpu_filename, "node2.cluster"), ["0"])
+
+        # From the NVIDIA devices of the node.
+        for device in ["nvidia0", "nvidia1", "nvidia10", "nvidiactl", "nvidia-uvm"]:
+            open(os.path.join(testing_dir, device), 'w').close()
+
+        cuda_visible_devices = os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+        try:
+            assert_equal(slot_allocator.get_gpu_devices(os.path.join(testing_dir, "missing"), "node1", testing_dir), ["0", "1", "10"])
+
+            # From the GPUs already made visible by the scheduler.
+            os.environ['CUDA_VISIBLE_DEVICES'] = "2,3"
+            assert_equal(slot_allocator.get_gpu_devices(os.path.join(testing_dir, "missing"), "node1", testing_dir), ["2", "3"])
+        finally:
+            os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            if cuda_visible_devices is not None:
+                os.environ['CUDA_VISIBLE_DEVICES'] = cuda_visible_devices
+    finally:
+        shutil.rmtree(testing_dir)
+
+
+def test_get_gpu_slots():
+    assert_equal(slot_allocator.get_gpu_slots(1, ["0", "1"]), [["0"], ["1"]])
+    assert_equal(slot_allocator.get_gpu_slots(2, ["0", "1", "2", "3", "4"]), [["0", "1"], ["2", "3"]])
+    assert_equal(slot_allocator.get_gpu_slots(2, ["0"]), [])
@@ -253,3 +253,43 @@ def test_get_commands_from_sparse_file():
     # Test if there is some white in the empty line
     fileobj = StringIO("\n".join(commands_2))
     assert_array_equal(smartdispatch.get_commands_from_file(fileobj), expected_commands)
+
+
+def test_cancel_queued_jobs():
+    temp_dir = tempfile.mkdtemp()
+    path_bin = pjoin(temp_dir, "bin")
+    os.mkdir(path_bin)
+    with open(pjoin(path_bin, "qstat"), 'w') as qstat:
+        qstat.write('#!/bin/sh\necho "$@" >> "{0}/qstat.log"\ncat "{0}/states"\n'.format(path_bin))
+    with open(pjoin(path_bin, "qdel"), 'w') as qdel:
+        qdel.write('#!/bin/sh\necho "$@" >> "{0}/qdel.log"\n'.format(path_bin))
+    os.chmod(pjoin(path_bin, "qstat"), 0755)
+    os.chmod(pjoin(path_bin, "qdel"), 0755)
+
+    def set_states(states):
+        with open(pjoin(path_bin, "states"), 'w') as states_file:
+            states_file.writelines("{0} a user 0 {1} queue\n".format(job_id, state) for job_id, state in states)
+
+    path = os.environ['PATH']
+    os.environ['PATH'] = path_bin + os.pathsep + path
+    try:
+        with open(pjoin(temp_dir, "jobs_id.txt"), 'w') as jobs_id_file:
+            jobs_id_file.write("## 2016-01-01 00:00:00 ##\n1.server\n2.server\n3.server\n")
+
+        # Only queued jobs are cancelled, in one call.
+        set_states([("1.server", "R"), ("2.server", "Q"), ("3.server", "H")])
+        assert_equal(smartdispatch.cancel_queued_jobs(temp_dir), ["2.server"])
+        assert_equal(open(pjoin(path_bin, "qdel.log")).read(), "2.server\n")
+
+        # Jobs held or running are looked up again, as they can be queued later.
+        set_states([("1.server", "C"), ("3.server", "Q"), ("4.server", "Q")])
+        with open(pjoin(temp_dir, "jobs_id.txt"), 'a') as jobs_id_file:
+            jobs_id_file.write("## 2016-01-01 01:00:00 ##\n4.server\n5-0.local\n")
+        assert_equal(smartdispatch.cancel_queued_jobs(temp_dir), ["3.server", "4.server"])
+
+        # Jobs deleted or over are not.
+        assert_equal(smartdispatch.cancel_queued_jobs(temp_dir), [])
+        assert_equal(open(pjoin(path_bin, "qstat.log")).read(), "1.server 2.server 3.server\n1.server 3.server 4.server\n")
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(temp_dir)
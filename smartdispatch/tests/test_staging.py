@@ -0,0 +1,117 @@
+import os
+import time
+import unittest
+import tempfile
+import shutil
+import socket
+from subprocess import Popen, PIPE
+
+from nose.tools import assert_equal, assert_true
+
+from smartdispatch import staging
+
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.scratch_dir = os.path.join(self.testing_dir, "scratch")
+        self.destination_dir = os.path.join(self.testing_dir, "results")
+        os.mkdir(self.scratch_dir)
+        self.batch_scratch_dir = os.path.join(self.scratch_dir, "smartdispatch_batch_" + socket.gethostname())
+        self.manifest_filename = os.path.join(self.testing_dir, "staged_outputs.txt")
+
+        self.dataset_dir = os.path.join(self.testing_dir, "dataset")
+        os.mkdir(self.dataset_dir)
+        with open(os.path.join(self.dataset_dir, "data.txt"), 'w') as data_file:
+            data_file.write("data\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def _run(self, code, job_id="1.server"):
+        env = dict(os.environ, PBS_JOBID=job_id, SD_SCRATCH=self.scratch_dir)
+        proc = Popen(["bash", "-c", "\n".join(code)], stdout=PIPE, env=env)
+        stdout, _ = proc.communicate()
+        assert_equal(proc.returncode, 0)
+        return stdout
+
+    def _run_job(self, command, stage_in=[], stage_out=[], job_id="1.server"):
+        code = staging.get_stage_in_prolog(stage_in, "batch")
+        code += staging.get_stage_out_prolog(stage_out, self.destination_dir, self.manifest_filename)
+        code += command
+        code += staging.get_stage_out_epilog(stage_out, self.destination_dir) + staging.get_scratch_epilog()
+        return self._run(code, job_id)
+
+    def test_stage_in_and_out(self):
+        command = ['cat "$SD_STAGE_IN_0/data.txt"',
+                   'echo "$SD_STAGE_IN"',
+                   'mkdir -p "$SD_STAGE_OUT_DIR/checkpoints"',
+                   'echo model > "$SD_STAGE_OUT_DIR/checkpoints/model.pkl"',
+                   'echo tmp > "$SD_STAGE_OUT_DIR/tmp.txt"']
+        stdout = self._run_job(command, [self.dataset_dir, os.path.join(self.testing_dir, "missing")], ["checkpoints/*"])
+
+        assert_equal(stdout.split("\n")[0], "data")
+        # Inputs that could not be copied are read from their original path.
+        assert_equal(stdout.split("\n")[1], "{0}/in/dataset:{1}".format(self.batch_scratch_dir, os.path.join(self.testing_dir, "missing")))
+
+        with open(os.path.join(self.destination_dir, "checkpoints", "model.pkl")) as output_file:
+            assert_equal(output_file.read(), "model\n")
+        assert_equal(open(self.manifest_filename).read(), "checkpoints/model.pkl\n")
+
+        assert_true(not os.path.exists(os.path.join(self.destination_dir, "tmp.txt")))
+        assert_equal(os.listdir(self.batch_scratch_dir), ["lock"])
+
+    def test_stage_in_shared(self):
+        # Inputs are copied by the first job of the node.
+        self._run(staging.get_stage_in_prolog([self.dataset_dir], "batch"), job_id="1.server")
+        with open(os.path.join(self.dataset_dir, "data.txt"), 'w') as data_file:
+            data_file.write("modified\n")
+
+        # Other jobs use the same copy, which is kept until the last one is over.
+        assert_equal(self._run_job(['cat "$SD_STAGE_IN_0/data.txt"'], [self.dataset_dir], job_id="2.server"), "data\n")
+        assert_true(os.path.isdir(os.path.join(self.batch_scratch_dir, "in", "dataset")))
+        self._run(staging.get_stage_in_prolog([self.dataset_dir], "batch") + staging.get_scratch_epilog(), job_id="1.server")
+        assert_true(not os.path.exists(os.path.join(self.batch_scratch_dir, "in")))
+
+    def test_stage_out_when_resumed(self):
+        patterns = ["checkpoints/*", "my outputs/*.txt"]
+        os.makedirs(os.path.join(self.destination_dir, "checkpoints"))
+        with open(os.path.join(self.destination_dir, "checkpoints", "unrelated.pkl"), 'w') as unrelated_file:
+            unrelated_file.write("unrelated\n")
+
+        first_job = ['mkdir -p "$SD_STAGE_OUT_DIR/checkpoints" "$SD_STAGE_OUT_DIR/my outputs"',
+                     'echo epoch1 > "$SD_STAGE_OUT_DIR/checkpoints/model.pkl"',
+                     'echo log > "$SD_STAGE_OUT_DIR/my outputs/log.txt"']
+        self._run_job(first_job, stage_out=patterns)
+
+        # Patterns are matched as is, spaces included.
+        with open(os.path.join(self.destination_dir, "my outputs", "log.txt")) as output_file:
+            assert_equal(output_file.read(), "log\n")
+
+        # Another job, e.g. on another node, finds the outputs synced back in its own scratch, and only them.
+        second_job = ['ls "$SD_STAGE_OUT_DIR/checkpoints"',
+                      'cat "$SD_STAGE_OUT_DIR/checkpoints/model.pkl"',
+                      'echo epoch2 > "$SD_STAGE_OUT_DIR/checkpoints/model.pkl"']
+        stdout = self._run_job(second_job, stage_out=patterns, job_id="2.server")
+        assert_equal(stdout, "model.pkl\nepoch1\n")
+        with open(os.path.join(self.destination_dir, "checkpoints", "model.pkl")) as output_file:
+            assert_equal(output_file.read(), "epoch2\n")
+
+    def test_stage_out(self):
+        source_dir = os.path.join(self.scratch_dir, "out")
+        os.makedirs(os.path.join(source_dir, "checkpoints", "epoch1"))
+        for filename in [os.path.join("checkpoints", "epoch1", "model.pkl"), "log.txt", "tmp.txt"]:
+            with open(os.path.join(source_dir, filename), 'w') as output_file:
+                output_file.write(filename)
+
+        assert_equal(staging.stage_out(source_dir, ["checkpoints", "*.txt"], self.destination_dir, self.manifest_filename), 3)
+        assert_equal(sorted(open(self.manifest_filename).read().split()), [os.path.join("checkpoints", "epoch1", "model.pkl"), "log.txt", "tmp.txt"])
+        with open(os.path.join(self.destination_dir, "checkpoints", "epoch1", "model.pkl")) as output_file:
+            assert_equal(output_file.read(), os.path.join("checkpoints", "epoch1", "model.pkl"))
+
+        # Only outputs newer than their copy are synced back.
+        assert_equal(staging.stage_out(source_dir, ["checkpoints", "*.txt"], self.destination_dir), 0)
+        log_filename = os.path.join(source_dir, "log.txt")
+        os.utime(log_filename, (time.time() + 10, time.time() + 10))
+        assert_equal(staging.stage_out(source_dir, ["checkpoints", "*.txt"], self.destination_dir), 1)
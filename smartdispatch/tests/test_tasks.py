@@ -0,0 +1,96 @@
+import os
+import math
+import unittest
+import tempfile
+import shutil
+import pickle
+from os.path import join as pjoin
+
+from nose.tools import assert_true, assert_equal, assert_raises
+
+import smartdispatch
+from smartdispatch import tasks
+from smartdispatch.queue import Queue
+
+
+class TestTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.testing_dir = tempfile.mkdtemp()
+        self.path_tasks = pjoin(self.testing_dir, "tasks")
+
+    def tearDown(self):
+        shutil.rmtree(self.testing_dir)
+
+    def test_save_tasks(self):
+        commands = tasks.save_tasks(math.sqrt, [4, 9], self.path_tasks)
+        assert_equal(commands, ["python2 -m smartdispatch.tasks " + pjoin(self.path_tasks, "task_0.pkl"),
+                                "python2 -m smartdispatch.tasks " + pjoin(self.path_tasks, "task_1.pkl")])
+        assert_equal(tasks.get_task_filename(commands[1]), pjoin(self.path_tasks, "task_1.pkl"))
+        assert_equal(tasks.get_task_filename("python train.py"), None)
+
+        tasks.run_task(pjoin(self.path_tasks, "task_1.pkl"))
+        with open(pjoin(self.path_tasks, "result_1.pkl"), 'rb') as result_file:
+            assert_equal(pickle.load(result_file), 3.)
+
+    def test_run_task_in_process(self):
+        tasks.save_tasks(math.sqrt, [4, -1], self.path_tasks)
+        with open(pjoin(self.testing_dir, "task.out"), 'w') as stdout_file:
+            with open(pjoin(self.testing_dir, "task.err"), 'w') as stderr_file:
+                assert_equal(tasks.run_task_in_process(pjoin(self.path_tasks, "task_0.pkl"), stdout_file, stderr_file), 0)
+                assert_equal(tasks.run_task_in_process(pjoin(self.path_tasks, "task_1.pkl"), stdout_file, stderr_file), 1)
+
+        # The traceback of the failed task went to its stderr.
+        assert_true("ValueError" in open(pjoin(self.testing_dir, "task.err")).read())
+        assert_true(os.path.isfile(pjoin(self.path_tasks, "result_0.pkl")))
+        assert_true(not os.path.isfile(pjoin(self.path_tasks, "result_1.pkl")))
+
+    def test_iter_results_without_jobs(self):
+        batch = smartdispatch.Batch(pjoin(self.testing_dir, "batch"))
+        batch.command_manager.set_commands_to_run(tasks.save_tasks(math.sqrt, [4], pjoin(batch.path_job, "tasks")))
+
+        # No job is left to execute the pending task, e.g. its workers could not start.
+        results = tasks.iter_results(batch, poll_interval=0.1)
+        assert_raises(smartdispatch.TaskError, results.next)
+
+    def test_iter_results_paused(self):
+        batch = smartdispatch.Batch(pjoin(self.testing_dir, "batch"))
+        batch.command_manager.set_commands_to_run(tasks.save_tasks(math.sqrt, [4], pjoin(batch.path_job, "tasks")))
+        batch.command_manager.pause("too many failures")
+
+        results = tasks.iter_results(batch, poll_interval=0.1)
+        with assert_raises(smartdispatch.TaskError) as error:
+            results.next()
+        assert_true("too many failures" in str(error.exception))
+
+    def test_iter_results_polling(self):
+        batch = smartdispatch.Batch(pjoin(self.testing_dir, "batch"))
+        batch.command_manager.set_commands_to_run(tasks.save_tasks(math.sqrt, [1, 4, 9], pjoin(batch.path_job, "tasks")))
+
+        # Each wait sees a task executed, within the same poll interval.
+        class FakeTime(object):
+            def time(self):
+                return 0.
+
+            def sleep(self, seconds):
+                command = batch.command_manager.get_command_to_run()
+                tasks.run_task(tasks.get_task_filename(command))
+
+        self.addCleanup(setattr, tasks, 'time', tasks.time)
+        tasks.time = FakeTime()
+        polls = []
+        batch.has_live_jobs = lambda: polls.append(True) or True
+
+        assert_equal(list(tasks.iter_results(batch, poll_interval=60.)), [1., 2., 3.])
+        assert_equal(len(polls), 1)
+
+    def test_map(self):
+        queue = Queue("test", None, "5:00", 2, 0, 32)
+        path_logs = pjoin(self.testing_dir, "SMART_DISPATCH_LOGS")
+
+        results = smartdispatch.map(math.sqrt, [1, 4, 9], queue, name="squares", path_smartdispatch_logs=path_logs, launcher="local", poll_interval=0.1)
+        assert_equal(list(results), [1., 2., 3.])
+
+        results = smartdispatch.map(math.sqrt, [1, -1], queue, name="negatives", path_smartdispatch_logs=path_logs, launcher="local", poll_interval=0.1)
+        assert_equal(results.next(), 1.)
+        assert_raises(smartdispatch.TaskError, results.next)
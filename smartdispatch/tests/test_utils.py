@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
+import signal
 import unittest
 
 from smartdispatch import utils
 
-from nose.tools import assert_equal, assert_true
+from nose.tools import assert_equal, assert_true, assert_raises
 from numpy.testing import assert_array_equal
 
 
@@ -49,3 +50,53 @@ def test_slugify():
 
     for arg, expected in testing_arguments:
         assert_equal(utils.slugify(arg), expected)
+
+
+def test_walltime_to_seconds():
+    assert_equal(utils.walltime_to_seconds("42"), 42)
+    assert_equal(utils.walltime_to_seconds("15:00"), 15 * 60)
+    assert_equal(utils.walltime_to_seconds("12:00:00"), 12 * 3600)
+    assert_equal(utils.walltime_to_seconds("1:02:03:04"), 86400 + 2 * 3600 + 3 * 60 + 4)
+
+
+def test_seconds_to_walltime():
+    assert_equal(utils.seconds_to_walltime(42), "0:00:00:42")
+    assert_equal(utils.seconds_to_walltime(41.2), "0:00:00:42")
+    assert_equal(utils.seconds_to_walltime(86400 + 2 * 3600 + 3 * 60 + 4), "1:02:03:04")
+    assert_equal(utils.walltime_to_seconds(utils.seconds_to_walltime(123456)), 123456)
+
+
+def test_get_command_annotations():
+    assert_equal(utils.get_command_annotations("python train.py --lr 0.1"), {})
+    assert_equal(utils.get_command_annotations("python train.py #sd: priority=10 idempotent"), {'priority': '10', 'idempotent': True})
+    assert_equal(utils.get_command_annotations("python train.py  #  sd:cost=1:00:00"), {'cost': '1:00:00'})
+    assert_equal(utils.get_command_annotations("echo a#sd: priority=10"), {})
+
+
+def test_get_command_argv():
+    assert_equal(utils.get_command_argv("sleep 1"), ["sleep", "1"])
+    assert_equal(utils.get_command_argv("echo --name 'a b' \"c d\"  #sd: priority=10"), ["echo", "--name", "a b", "c d"])
+
+    # Need a shell.
+    assert_equal(utils.get_command_argv("echo 1 | cat"), None)
+    assert_equal(utils.get_command_argv("echo $HOME"), None)
+    assert_equal(utils.get_command_argv("ls *.txt"), None)
+    assert_equal(utils.get_command_argv("cd /tmp"), None)
+    assert_equal(utils.get_command_argv("A=1 echo 1"), None)
+    assert_equal(utils.get_command_argv("echo 'a"), None)
+
+
+def test_get_signal_number():
+    assert_equal(utils.get_signal_number("USR1"), signal.SIGUSR1)
+    assert_equal(utils.get_signal_number("sigterm"), signal.SIGTERM)
+    assert_equal(utils.get_signal_number("2"), 2)
+    assert_raises(ValueError, utils.get_signal_number, "UNKNOWN")
+    assert_raises(ValueError, utils.get_signal_number, "SIG_IGN")
+
+
+def test_get_env_with_thread_limits():
+    env = utils.get_env_with_thread_limits(2, env={'PATH': "/bin", 'MKL_NUM_THREADS': "4"})
+    assert_equal(env['PATH'], "/bin")
+    assert_equal(env['OMP_NUM_THREADS'], "2")
+    assert_equal(env['OPENBLAS_NUM_THREADS'], "2")
+    assert_equal(env['MKL_NUM_THREADS'], "4")  # Already set by the user.
@@ -0,0 +1,26 @@
+from nose.tools import assert_equal, assert_raises
+
+from smartdispatch.worker_options import WorkerOptions
+
+
+def test_get_flags():
+    assert_equal(WorkerOptions().get_flags(), ['-c 1'])
+    assert_raises(ValueError, WorkerOptions, group_size=0)
+
+    worker_options = WorkerOptions(cores_per_command=2, gpus_per_command=1, thread_limits=False, pin_cpus=True, preload=["numpy"],
+                                   group_size=4, stage_out=["my outputs/*"])
+    assert_equal(worker_options.get_flags(), ['-c 2', '--noThreadLimits', '--pinCpus', '--preload numpy', '--groupSize 4',
+                                              "--stageOut 'my outputs/*'"])
+
+    # Values reach the worker script through a shell.
+    assert_equal(WorkerOptions(preload=["numpy; rm -rf ~"]).get_flags(), ['-c 1', "--preload 'numpy; rm -rf ~'"])
+
+    # Commands get GPUs only on nodes having some.
+    assert_equal(worker_options.get_flags(nb_gpus_per_node=2)[:4], ['-c 2', '--noThreadLimits', '--pinCpus', '-g 1'])
+
+
+def test_get_flags_checkpoint():
+    # Commands are signaled only if given time to save their state.
+    worker_options = WorkerOptions(checkpoint_signal=10)
+    assert_equal(worker_options.get_flags(), ['-c 1'])
+    assert_equal(worker_options.get_flags(checkpoint_grace=570), ['-c 1', '--checkpointSignal 10 --checkpointGrace 570'])
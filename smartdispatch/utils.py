@@ -1,10 +1,26 @@
+import os
 import re
+import sys
+import math
 import hashlib
 import unicodedata
 import json
+import shlex
+import signal
 
 from distutils.util import strtobool
 from subprocess import Popen, PIPE
+from distutils.spawn import find_executable
+
+regex_annotations = re.compile(r"(?:^|\s)#\s*sd:(.*)$")
+regex_showstart = re.compile(r"start in\s+(-?[\d:]+)")
+
+# Commands using any of these need a shell.
+SHELL_SPECIAL_CHARACTERS = set("|&;<>()$`\\*?[]{}~#\n")
+
+# Environment variables limiting the threads used by OpenMP and common BLAS libraries.
+THREAD_LIMITS_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'GOTO_NUM_THREADS',
+                           'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
 
 def jobname_generator(jobname, job_id):
     '''Crop the jobname to a maximum of 64 characters.
@@ -36,7 +52,7 @@ def print_boxed(string):
     out = u"\u250c" + box_line + u"\u2510\n"
     out += '\n'.join([u"\u2502 {} \u2502".format(line.ljust(max_len)) for line in splitted_string])
     out += u"\n\u2514" + box_line + u"\u2518"
-    print out
+    print out.encode(getattr(sys.stdout, "encoding", None) or "utf-8", "replace")
 
 
 def yes_no_prompt(query, default=None):
@@ -65,6 +81,57 @@ def generate_uid_from_string(value):
     return hashlib.sha256(value).hexdigest()
 
 
+def get_command_annotations(command):
+    """ Parses the annotations of a command.
+
+    Annotations are put in a trailing shell comment starting with "#sd:",
+    so they are ignored when the command is executed. Each annotation is
+    either a "key=value" pair or a flag.
+
+    Example
+    -------
+    >>> get_command_annotations("python train.py --lr 0.1  #sd: priority=10 idempotent")
+    {'priority': '10', 'idempotent': True}
+    """
+    match = regex_annotations.search(command)
+    if match is None:
+        return {}
+
+    annotations = {}
+    for annotation in match.group(1).split():
+        key, _, value = annotation.partition('=')
+        annotations[key] = value if len(value) > 0 else True
+
+    return annotations
+
+
+def get_command_argv(command):
+    """ Splits a command that can be executed without a shell into its arguments, None if it needs a shell.
+
+    Annotations are ignored. Commands using shell constructs (e.g. pipes,
+    redirections, variables or globs), shell builtins or unknown programs
+    need a shell.
+
+    Example
+    -------
+    >>> get_command_argv("python train.py --name 'a b'  #sd: priority=10")
+    ['python', 'train.py', '--name', 'a b']
+    """
+    command = regex_annotations.sub("", command)
+    if any(character in SHELL_SPECIAL_CHARACTERS for character in command):
+        return None
+
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None  # E.g. unbalanced quotes, let the shell report it.
+
+    if len(argv) == 0 or find_executable(argv[0]) is None:
+        return None
+
+    return argv
+
+
 def slugify(value):
     """
     Converts to lowercase, removes non-word characters (alphanumerics and
@@ -99,6 +166,52 @@ def decode_escaped_characters(text):
     return re.sub(r"\\x..", unhexify, text)
 
 
+def walltime_to_seconds(walltime):
+    """ Converts a walltime ([[[DD:]HH:]MM:]SS) into a number of seconds. """
+    seconds = 0
+    for unit, value in zip([1, 60, 3600, 86400], reversed(str(walltime).split(':'))):
+        seconds += unit * int(value)
+
+    return seconds
+
+
+def seconds_to_walltime(seconds):
+    """ Converts a number of seconds into a walltime (DD:HH:MM:SS). """
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return "{0}:{1:02d}:{2:02d}:{3:02d}".format(days, hours, minutes, seconds)
+
+
+def get_signal_number(signal_name):
+    """ Gets the number of a signal from its name (e.g. "USR1" or "SIGUSR1") or its number. """
+    if str(signal_name).isdigit():
+        return int(signal_name)
+
+    name = str(signal_name).upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+
+    signum = getattr(signal, name, None)
+    if not isinstance(signum, int) or name.startswith("SIG_"):
+        raise ValueError("Unknown signal: {0}".format(signal_name))
+
+    return signum
+
+
+def get_env_with_thread_limits(nb_threads, env=None):
+    """ Gets a copy of the environment (default: os.environ) limiting the threads started by OpenMP and BLAS libraries.
+
+    Limits already set in the environment are kept.
+    """
+    env = dict(os.environ if env is None else env)
+    for variable in THREAD_LIMITS_VARIABLES:
+        env.setdefault(variable, str(nb_threads))
+
+    return env
+
+
 def save_dict_to_json_file(path, dictionary):
     with open(path, "w") as json_file:
         json_file.write(json.dumps(dictionary, indent=4, separators=(',', ': ')))
@@ -131,6 +244,49 @@ def detect_cluster():
     return cluster_name
 
 
+def get_jobs_state(jobs_id):
+    """ Gets the state (e.g. Q, H, R or C) of the given jobs known to qstat, None if qstat is not available. """
+    if len(jobs_id) == 0:
+        return {}
+
+    if find_executable("qstat") is None:
+        return None
+
+    output = Popen(["qstat"] + list(jobs_id), stdout=PIPE, stderr=PIPE).communicate()[0]
+
+    # Job IDs might be truncated by qstat (e.g. "1234.server-na..."), only their number is compared.
+    states = {}
+    for line in output.split("\n"):
+        fields = line.split()
+        if len(fields) >= 6:  # Job ID, Name, User, Time Use, S, Queue
+            states[fields[0].split('.')[0]] = fields[-2]
+
+    return dict((job_id, states[job_id.split('.')[0]]) for job_id in jobs_id if job_id.split('.')[0] in states)
+
+
+def get_live_jobs(jobs_id):
+    """ Gets which of the given jobs are still queued or running according to qstat, None if qstat is not available. """
+    states = get_jobs_state(jobs_id)
+    if states is None:
+        return None
+
+    return set(job_id for job_id, state in states.items() if state != 'C')
+
+
+def get_start_delay(nb_cores, walltime):
+    """ Gets in how many seconds a job of `nb_cores` cores and `walltime` would start according to showstart, None if it is not available. """
+    if find_executable("showstart") is None:
+        return None
+
+    output = Popen(["showstart", "{0}@{1}".format(nb_cores, walltime)], stdout=PIPE, stderr=PIPE).communicate()[0]
+    match = regex_showstart.search(output)
+    if match is None:
+        return None
+
+    start_delay = match.group(1)
+    return 0 if start_delay.startswith('-') else walltime_to_seconds(start_delay)
+
+
 def get_launcher(cluster_name):
     if cluster_name == "helios":
         return "msub"
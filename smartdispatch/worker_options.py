@@ -0,0 +1,106 @@
+import pipes
+
+
+class WorkerOptions(object):
+
+    """ Tells the workers of a batch how to execute its commands.
+
+    Parameters
+    ----------
+    cores_per_command : int
+        cores needed by a command
+    gpus_per_command : int
+        GPUs needed by a command
+    thread_limits : bool
+        limit the threads of OpenMP and BLAS libraries to `cores_per_command`
+    pin_cpus : bool
+        give each command running on a node its own CPUs
+    sampling_interval : float
+        seconds between two samples of the resources used by a command (Default: worker's)
+    stage_out : list of str
+        glob patterns of the outputs synced back from the node-local scratch
+    in_process : bool
+        execute the tasks of `smartdispatch.map` within the workers
+    preload : list of str
+        modules imported once by each worker, Python commands being executed in a fork of it
+    group_size : int
+        number of consecutive commands claimed and executed at once by a worker
+    command_timeout : float
+        seconds a command can run before being terminated as timed out (Default: no limit)
+    timeout_grace : float
+        seconds a timed out command has to exit before being killed (Default: worker's)
+    checkpoint_signal : int
+        with autoresume, signal sent to running commands before the walltime so they save their state (Default: SIGTERM)
+    speculate : float
+        once no command is pending, idle workers execute a copy of the idempotent commands running
+        for more than this many times the median duration (Default: no copies)
+    bad_node_failures : int
+        with autoresume, consecutive fast failures after which a worker blocklists its node, provided commands
+        succeeded elsewhere, and gives its work back to jobs avoiding the node (Default: never)
+    """
+
+    def __init__(self, cores_per_command=1, gpus_per_command=1, thread_limits=True, pin_cpus=False, sampling_interval=None,
+                 stage_out=[], in_process=False, preload=[], group_size=1, command_timeout=None, timeout_grace=None,
+                 checkpoint_signal=None, speculate=None, bad_node_failures=None):
+        if group_size < 1:
+            raise ValueError("A group must hold at least one command.")
+
+        self.cores_per_command = cores_per_command
+        self.gpus_per_command = gpus_per_command
+        self.thread_limits = thread_limits
+        self.pin_cpus = pin_cpus
+        self.sampling_interval = sampling_interval
+        self.stage_out = stage_out
+        self.in_process = in_process
+        self.preload = preload
+        self.group_size = group_size
+        self.command_timeout = command_timeout
+        self.timeout_grace = timeout_grace
+        self.checkpoint_signal = checkpoint_signal
+        self.speculate = speculate
+        self.bad_node_failures = bad_node_failures
+
+    def get_flags(self, nb_gpus_per_node=0, checkpoint_grace=None):
+        ''' Gets the flags of the worker script.
+
+        Parameters
+        ----------
+        nb_gpus_per_node : int
+            GPUs of a node, commands are given GPUs only if there are some
+        checkpoint_grace : float
+            seconds signaled commands have to save their state, only with a `checkpoint_signal` (Default: no signal)
+
+        Returns
+        -------
+        flags : list of str
+            flags, with their value, of the worker script
+        '''
+        flags = ['-c {0}'.format(self.cores_per_command)]
+        if not self.thread_limits:
+            flags.append('--noThreadLimits')
+        if self.sampling_interval is not None:
+            flags.append('-s {0}'.format(self.sampling_interval))
+        if self.pin_cpus:
+            flags.append('--pinCpus')
+        if nb_gpus_per_node > 0 and self.gpus_per_command > 0:
+            flags.append('-g {0}'.format(self.gpus_per_command))
+        if self.in_process:
+            flags.append('--inProcess')
+        for module in self.preload:
+            flags.append('--preload {0}'.format(pipes.quote(module)))
+        if self.group_size > 1:
+            flags.append('--groupSize {0}'.format(self.group_size))
+        if self.command_timeout is not None:
+            flags.append('--timeout {0}'.format(self.command_timeout))
+        if self.timeout_grace is not None:
+            flags.append('--timeoutGrace {0}'.format(self.timeout_grace))
+        if self.speculate is not None:
+            flags.append('--speculate {0}'.format(self.speculate))
+        if self.bad_node_failures is not None:
+            flags.append('--badNodeFailures {0}'.format(self.bad_node_failures))
+        if self.checkpoint_signal is not None and checkpoint_grace is not None:
+            flags.append('--checkpointSignal {0} --checkpointGrace {1}'.format(self.checkpoint_signal, checkpoint_grace))
+        for pattern in self.stage_out:
+            flags.append('--stageOut {0}'.format(pipes.quote(pattern)))
+
+        return flags
@@ -3,14 +3,27 @@
 
 import os
 import sys
+import errno
+import pipes
+import atexit
 import signal
+import tempfile
+import threading
 import argparse
 import subprocess
 import logging
 import time as t
+from functools import partial
 
+import smartdispatch
 from smartdispatch import utils
+from smartdispatch.batch import BAD_NODE_EXIT_CODE
 from smartdispatch.command_manager import CommandManager
+from smartdispatch.resource_monitor import ResourceMonitor
+from smartdispatch import slot_allocator
+from smartdispatch import staging
+from smartdispatch import tasks
+from smartdispatch import preload
 
 
 def parse_arguments():
@@ -18,6 +31,24 @@ def parse_arguments():
     parser.add_argument('commands_filename', type=str, help='File containing all commands to execute.')
     parser.add_argument('logs_dir', type=str, help="Folder where to put commands' stdout and stderr.")
     parser.add_argument('-r', '--assumeResumable', action='store_true', help="Assume that commands are resumable and put them into the pending list on worker termination.")
+    parser.add_argument('-c', '--coresPerCommand', type=int, default=1, help="How many cores a command needs. Default: 1")
+    parser.add_argument('--noThreadLimits', action='store_true', help="Do not limit the threads started by OpenMP and BLAS libraries (e.g. OMP_NUM_THREADS) to the cores a command needs.")
+    parser.add_argument('--pinCpus', action='store_true', help="Give each command running on the node its own set of CPUs, aligned to NUMA nodes when possible.")
+    parser.add_argument('-g', '--gpusPerCommand', type=int, default=0, help="Give each command running on the node its own set of GPUs through CUDA_VISIBLE_DEVICES. Default: 0 (every command sees every GPU)")
+    parser.add_argument('--gpuDevices', type=str, help="Comma separated GPUs to share between commands. Default: from $PBS_GPUFILE, $CUDA_VISIBLE_DEVICES or the GPUs of the node.")
+    parser.add_argument('--stageOut', action='append', default=[], help="Glob pattern, relative to $SD_STAGE_OUT_DIR, of outputs synced back to the current folder when a command ends. Can be repeated.")
+    parser.add_argument('--inProcess', action='store_true', help="Execute the Python tasks of smartdispatch.map within the worker, so the modules they need are imported only once.")
+    parser.add_argument('--preload', action='append', default=[], help="Module imported once by the worker. Commands executing a Python script or module (e.g. python train.py) then run in a fork of the worker instead of a new interpreter. Can be repeated.")
+    parser.add_argument('--timeout', type=float, help="Seconds a command can run before being terminated and considered as timed out. Commands annotated with \"#sd: timeout=[[[DD:]HH:]MM:]SS\" use their own limit. Not applied to the tasks executed with --inProcess. Default: no limit")
+    parser.add_argument('--timeoutGrace', type=float, default=30., help="Seconds a timed out command has to exit after SIGTERM before being killed. Default: 30")
+    parser.add_argument('--checkpointSignal', type=utils.get_signal_number, help="With --assumeResumable, signal (e.g. USR1) sent to the running command when the worker is terminated, so it can save its state before being resumed later. Default: SIGTERM is forwarded right away")
+    parser.add_argument('--checkpointGrace', type=float, default=30., help="Seconds the command has to exit after --checkpointSignal before getting SIGTERM. Default: 30")
+    parser.add_argument('--groupSize', type=int, default=1, help="Claim and execute this many commands at once, one after the other in a single shell (or within the worker with --inProcess). Each command keeps its own exit code, outputs are logged in the files of the first command of the group. Default: 1")
+    parser.add_argument('--speculate', type=float, metavar='FACTOR', help="Once no command is pending, execute a copy of the idempotent command (annotated with \"#sd: idempotent\") running for the longest time, if it runs for more than FACTOR times the median duration of the commands done so far. The first copy to succeed is kept and the other one is terminated. Default: no copies")
+    parser.add_argument('--speculationInterval', type=float, default=10., help="With --speculate, seconds between two checks for a lagging command, or for another copy of the running command being done. Default: 10")
+    parser.add_argument('--badNodeFailures', type=int, metavar='N', help="After N commands in a row failed within --fastFailure seconds, while commands succeeded on other nodes, blocklist this node: these commands go back to the pending ones, workers stop claiming commands on this node and jobs resubmitted afterward avoid it. Default: never")
+    parser.add_argument('--fastFailure', type=float, default=30., help="With --badNodeFailures, seconds within which a failed command counts as a fast failure. Default: 30")
+    parser.add_argument('-s', '--samplingInterval', type=float, default=30., help="Seconds between two samples of the resources used by a command, 0 to disable. Default: 30")
     args = parser.parse_args()
 
     # Check for invalid arguments
@@ -27,9 +58,280 @@ def parse_arguments():
     if not os.path.isdir(args.logs_dir):
         parser.error("You need to specify the folder path where to put command' stdout and stderr.")
 
+    if args.groupSize < 1:
+        parser.error("The size of a group of commands must be at least 1.")
+
+    if args.badNodeFailures is not None and not args.assumeResumable:
+        parser.error("--badNodeFailures requires --assumeResumable, the commands given back by a bad node being resumed by the next jobs.")
+
     return args
 
 
+def spawn_command(command, stdout, stderr, env=None, preexec_fn=None, new_process_group=False):
+    """ Starts a command, without a shell when it does not need one.
+
+    The command stays in the worker's process group, so it gets the signals sent to the whole job (e.g. by
+    `timeout` or at the walltime), unless `new_process_group` is set for the worker to signal it on its own.
+    """
+    def setpgid_preexec_fn():
+        os.setpgid(0, 0)
+        if preexec_fn is not None:
+            preexec_fn()
+
+    argv = utils.get_command_argv(command)
+    if argv is None:
+        return subprocess.Popen(command, stdout=stdout, stderr=stderr, shell=True, env=env,
+                                preexec_fn=setpgid_preexec_fn if new_process_group else preexec_fn)
+
+    return subprocess.Popen(argv, stdout=stdout, stderr=stderr, env=env,
+                            preexec_fn=setpgid_preexec_fn if new_process_group else preexec_fn)
+
+
+def send_signal(proc, signum):
+    """ Sends a signal to a command, to its whole process group if it has its own. """
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signum)
+        else:
+            os.kill(proc.pid, signum)
+    except OSError:
+        pass  # Command is done.
+
+
+def wait_for_process_group(proc, timeout, interval=0.1):
+    """ Waits up to `timeout` seconds for every process of a command's own process group to be done, returns whether they are. """
+    end_time = t.time() + timeout
+    while True:
+        proc.poll()  # Reaps the command once done.
+        try:
+            os.killpg(proc.pid, 0)
+        except OSError:
+            return True
+
+        if t.time() >= end_time:
+            return False
+
+        t.sleep(interval)
+
+
+def forward_signal(proc, signum):
+    """ Sends a signal to the process group of a command, if it has its own, since it does not get the ones sent to the worker's. """
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signum)
+    except OSError:
+        pass  # Command is done.
+
+
+def get_command_timeout(command, default=None):
+    """ Gets the seconds `command` can run, from its "timeout" annotation ([[[DD:]HH:]MM:]SS) or `default`. """
+    timeout = utils.get_command_annotations(command).get('timeout')
+    if timeout is None or timeout is True:
+        return default
+
+    return utils.walltime_to_seconds(timeout)
+
+
+class Deadline(object):
+
+    """ Terminates a command exceeding its time limit.
+
+    Once `timeout` seconds are elapsed, SIGTERM is sent to the command (its
+    whole process group if it has its own), then SIGKILL if it is still
+    running after `grace_period` seconds.
+
+    Parameters
+    ----------
+    proc : `subprocess.Popen` instance
+        running command
+    timeout : float
+        seconds the command can run
+    grace_period : float
+        seconds the command has to exit once terminated
+    """
+
+    def __init__(self, proc, timeout, grace_period):
+        self.proc = proc
+        self.timeout = timeout
+        self.grace_period = grace_period
+        self.timed_out = False
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        if self._done.wait(self.timeout):
+            return
+
+        self.timed_out = True
+        self._terminate()
+
+    def _terminate(self):
+        send_signal(self.proc, signal.SIGTERM)
+        if not self._done.wait(self.grace_period):
+            send_signal(self.proc, signal.SIGKILL)
+
+    def cancel(self):
+        """ Stops watching the command, e.g. once it is done. """
+        self._done.set()
+        self._thread.join()
+
+
+class CopyWatcher(Deadline):
+
+    """ Terminates a copy of a speculative command once another copy of it is done.
+
+    Parameters
+    ----------
+    proc : `subprocess.Popen` instance
+        running copy of the command
+    command_manager : `CommandManager` instance
+        manager of the commands of the batch
+    command : str
+        command being executed
+    grace_period : float
+        seconds the copy has to exit once terminated
+    interval : float
+        seconds between two checks of the other copies
+    """
+
+    def __init__(self, proc, command_manager, command, grace_period, interval=10.):
+        self.command_manager = command_manager
+        self.command = command
+        self.interval = interval
+        self.lost = False
+        super(CopyWatcher, self).__init__(proc, None, grace_period)
+
+    def _watch(self):
+        while not self._done.wait(self.interval):
+            if self.command_manager.is_speculative_command_done(self.command):
+                self.lost = True
+                self._terminate()
+                return
+
+
+def get_median_duration(command_manager):
+    """ Gets the median duration of the commands of a batch that succeeded so far, None if none did. """
+    durations = sorted(timing['duration'] for timing in command_manager.get_commands_timings()
+                       if timing['error_code'] == 0 and not timing.get('timed_out', False))
+    return durations[len(durations) // 2] if len(durations) > 0 else None
+
+
+def has_succeeded_elsewhere(command_manager, node_name):
+    """ Tells whether a command of a batch succeeded on a node other than `node_name`. """
+    return any(timing['error_code'] == 0 and timing.get('node_name') != node_name for timing in command_manager.get_commands_timings())
+
+
+def get_log_command(command):
+    return "## SMART-DISPATCH - Command: " + command + '\n'
+
+
+class CommandGroup(object):
+
+    """ Commands executed one after the other by a single shell.
+
+    Each command runs in its own subshell and its exit code is sent back to
+    the worker through a pipe, so commands of a group still succeed or fail
+    individually. Behaves like a `subprocess.Popen` instance.
+
+    Parameters
+    ----------
+    commands : list of str
+        commands to execute
+    stdout : file
+        file where the output of the commands is written
+    stderr : file
+        file where the errors of the commands are written
+    env : dict
+        environment of the commands (Default: the one of this process)
+    preexec_fn : callable
+        called in the shell process before executing the commands
+    wrap_command : callable
+        applied to the command starting the shell (e.g. to restrict its CPUs)
+    new_process_group : bool
+        start the shell in its own process group
+
+    Attributes
+    ----------
+    error_codes : list of int
+        exit code of each command done so far
+    durations : list of float
+        seconds taken by each command done so far
+    """
+
+    def __init__(self, commands, stdout, stderr, env=None, preexec_fn=None, wrap_command=None, new_process_group=False):
+        self.commands = commands
+        self.error_codes = []
+        self.durations = []
+        self._buffer = ""
+
+        status_fd, status_write_fd = os.pipe()
+        script_fd, self._script_filename = tempfile.mkstemp(prefix="smartdispatch_group_", suffix=".sh")
+        with os.fdopen(script_fd, 'w') as script_file:
+            script_file.write(self.get_script(commands, status_write_fd))
+
+        shell_command = "/bin/sh " + self._script_filename
+        if wrap_command is not None:
+            shell_command = wrap_command(shell_command)
+
+        self._last_time = t.time()
+        try:
+            self.proc = spawn_command(shell_command, stdout, stderr, env, preexec_fn, new_process_group)
+        finally:
+            os.close(status_write_fd)
+
+        self._status_fd = status_fd
+        self.pid = self.proc.pid
+
+    @staticmethod
+    def get_script(commands, status_fd):
+        """ Gets the shell script executing `commands`, writing their exit code to the file descriptor `status_fd`. """
+        lines = []
+        for command in commands:
+            log_command = pipes.quote(get_log_command(command))
+            lines.append("printf '%s' {0}; printf '%s' {0} >&2".format(log_command))
+            # Newlines around the command so a trailing comment (e.g. #sd: annotations) does not swallow the parenthesis.
+            lines.append("(\n{0}\n)".format(command))
+            lines.append("echo $? >&{0}".format(status_fd))
+
+        return "\n".join(lines) + "\n"
+
+    def _read_status(self):
+        """ Reads the exit codes sent by the shell until it is done. """
+        while self._status_fd is not None:
+            try:
+                data = os.read(self._status_fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:  # Interrupted by a signal, e.g. SIGTERM.
+                    continue
+                raise
+
+            if data == "":
+                os.close(self._status_fd)
+                self._status_fd = None
+                break
+
+            lines = (self._buffer + data).split("\n")
+            self._buffer = lines.pop()
+            for line in lines:
+                now = t.time()
+                self.error_codes.append(int(line))
+                self.durations.append(now - self._last_time)
+                self._last_time = now
+
+    def poll(self):
+        return self.proc.poll()
+
+    def wait(self):
+        self._read_status()
+        returncode = self.proc.wait()
+        if os.path.isfile(self._script_filename):
+            os.remove(self._script_filename)
+
+        return returncode
+
+
 def main():
     # Necessary if we want 'logging.info' to appear in stderr.
     logging.root.setLevel(logging.INFO)
@@ -37,6 +339,67 @@ def main():
     args = parse_arguments()
 
     command_manager = CommandManager(args.commands_filename)
+    retry_policy = command_manager.get_retry_policy()
+
+    env = None
+    if not args.noThreadLimits:
+        env = utils.get_env_with_thread_limits(args.coresPerCommand)
+
+    cpu_allocator = None
+    if args.pinCpus:
+        cpu_slots = slot_allocator.get_cpu_slots(args.coresPerCommand, slot_allocator.get_allowed_cpus(), slot_allocator.get_numa_nodes())
+        cpu_allocator = slot_allocator.SlotAllocator(slot_allocator.get_state_filename("cpus"), cpu_slots)
+
+    gpu_allocator = None
+    if args.gpusPerCommand > 0:
+        gpu_devices = args.gpuDevices.split(',') if args.gpuDevices is not None else slot_allocator.get_gpu_devices()
+        gpu_slots = slot_allocator.get_gpu_slots(args.gpusPerCommand, gpu_devices)
+        if len(gpu_slots) == 0:
+            logging.warn("Not enough GPUs found on this node ({0}), commands see every GPU.".format(len(gpu_devices)))
+        else:
+            gpu_allocator = slot_allocator.SlotAllocator(slot_allocator.get_state_filename("gpus"), gpu_slots)
+
+    if args.inProcess or len(args.preload) > 0:
+        # Modules imported by the worker must see the environment of the commands (e.g. OMP_NUM_THREADS).
+        if env is not None:
+            os.environ.update(env)
+
+    if args.inProcess:
+        # Tasks are executed as with "python -m", i.e. modules of the current folder can be imported.
+        sys.path.insert(0, os.getcwd())
+
+    preload.preload_modules(args.preload)
+
+    def pin_worker():
+        # Tasks executed in the worker's process use the CPUs and GPUs of the worker, which keeps them until it
+        # exits since the libraries loaded by a task (e.g. CUDA) cannot move to other devices afterward.
+        if pin_worker.done:
+            return
+        pin_worker.done = True
+
+        if cpu_allocator is not None:
+            cpu_slot, cpus = cpu_allocator.acquire()
+            if cpus is None:
+                logging.warn("No free set of CPUs left on this node, tasks are not pinned.")
+            elif not slot_allocator.can_set_cpu_affinity():
+                logging.warn("Cannot set the CPU affinity of the worker, tasks are not pinned.")
+                cpu_allocator.release(cpu_slot)
+            else:
+                slot_allocator.set_cpu_affinity(cpus)
+                atexit.register(cpu_allocator.release, cpu_slot)
+
+        if gpu_allocator is not None:
+            gpu_slot, gpus = gpu_allocator.acquire()
+            if gpus is None:
+                logging.warn("No free set of GPUs left on this node, tasks see every GPU.")
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = ",".join(gpus)
+                atexit.register(gpu_allocator.release, gpu_slot)
+    pin_worker.done = False
+
+    def sync_outputs():
+        if len(args.stageOut) > 0 and 'SD_STAGE_OUT_DIR' in os.environ:
+            staging.stage_out(os.environ['SD_STAGE_OUT_DIR'], args.stageOut, os.getcwd(), os.environ.get('SD_STAGE_OUT_MANIFEST'))
 
     if args.assumeResumable:
         # Handle TERM signal gracefully by sending running commands back to
@@ -45,32 +408,108 @@ def main():
         #       up-to-date information on running the command and/or process,
         #       but chances of that happening are VERY slim and the
         #       consequences are not fatal.
-        def sigterm_handler(signal, frame):
+        def sigterm_handler(signum, frame):
             if sigterm_handler.triggered:
                 return
             else:
                 sigterm_handler.triggered = True
 
+            commands = sigterm_handler.commands
             if sigterm_handler.proc is not None:
+                if args.checkpointSignal is not None:
+                    # Give the command a chance to save its state before terminating it. The whole process
+                    # group is waited for, since a shell running the command might not survive the signal.
+                    send_signal(sigterm_handler.proc, args.checkpointSignal)
+                    if not wait_for_process_group(sigterm_handler.proc, args.checkpointGrace):
+                        try:
+                            os.killpg(sigterm_handler.proc.pid, signum)
+                        except OSError:
+                            pass  # Command is done.
+                else:
+                    forward_signal(sigterm_handler.proc, signum)
                 sigterm_handler.proc.wait()
-            if sigterm_handler.command is not None:
-                command_manager.set_running_command_as_pending(sigterm_handler.command)
+                sync_outputs()
+                if isinstance(sigterm_handler.proc, CommandGroup):
+                    # Commands of the group that succeeded are done, the others (including the interrupted one) are resumed.
+                    error_codes = sigterm_handler.proc.error_codes
+                    done = [command for command, error_code in zip(commands, error_codes) if error_code == 0]
+                    command_manager.set_running_commands_as_finished(done, [0] * len(done))
+                    commands = [command for i, command in enumerate(commands) if i >= len(error_codes) or error_codes[i] != 0]
+
+            if args.speculate is not None:
+                # Commands still executed by another copy are left to it.
+                commands = [cmd for cmd in commands if command_manager.release_speculative_copy(cmd)]
+
+            command_manager.set_running_commands_as_pending(commands)
             sys.exit(0)
         sigterm_handler.triggered = False
-        sigterm_handler.command = None
+        sigterm_handler.commands = []
         sigterm_handler.proc = None
         signal.signal(signal.SIGTERM, sigterm_handler)
 
+    path_job = os.path.dirname(os.path.dirname(os.path.abspath(args.commands_filename)))
+    fast_failures = []  # Commands that failed fast in a row on this node.
+    is_bad_node = False
     while True:
-        command = command_manager.get_command_to_run()
-        if args.assumeResumable:
-            sigterm_handler.proc = None
-            sigterm_handler.command = command
+        if args.badNodeFailures is not None and os.environ.get('HOSTNAME', 'undefined') in command_manager.get_bad_nodes():
+            logging.warn("This node is blocklisted, its work is left to other nodes.")
+            is_bad_node = True
+            break
 
-        if command is None:
+        commands = command_manager.get_commands_to_run(args.groupSize)
+        is_copy = False
+        if len(commands) == 0 and command_manager.is_paused():
+            logging.warn("Batch paused ({0}), no more commands are executed until it is resumed.".format(command_manager.get_pause_reason()))
+            circuit_breaker = command_manager.get_circuit_breaker()
+            if circuit_breaker is not None and circuit_breaker.cancel_jobs:
+                cancelled_jobs_id = smartdispatch.cancel_queued_jobs(path_job)
+                if len(cancelled_jobs_id) > 0:
+                    logging.info("Batch paused, cancelled the queued jobs: {0}".format(" ".join(cancelled_jobs_id)))
             break
 
+        if len(commands) == 0:
+            # Only commands retried later are left, wait for the first one.
+            next_start_time = command_manager.get_next_start_time()
+            if next_start_time is not None:
+                t.sleep(max(next_start_time - t.time(), 0))
+                continue
+
+            # Once the last command is done, jobs of the batch still queued would start only to find nothing to do. Before
+            # that, running commands can still come back to the pending ones (e.g. at the walltime) for these jobs to resume.
+            if len(command_manager.get_running_commands()) == 0:
+                cancelled_jobs_id = smartdispatch.cancel_queued_jobs(path_job)
+                if len(cancelled_jobs_id) > 0:
+                    logging.info("No command left, cancelled the queued jobs: {0}".format(" ".join(cancelled_jobs_id)))
+
+            if args.speculate is None:
+                break
+
+            # Instead of idling, execute a copy of a command lagging behind (e.g. on a slow node).
+            median_duration = get_median_duration(command_manager)
+            min_duration = args.speculate * median_duration if median_duration is not None else float('inf')
+            straggler, wait_time = command_manager.get_straggler_to_duplicate(min_duration)
+            if straggler is None:
+                if wait_time is None:
+                    break
+
+                t.sleep(min(wait_time, args.speculationInterval))
+                continue
+
+            logging.info("Executing a copy of a command running for more than {0:.1f} sec: {1}".format(min_duration, straggler))
+            commands, is_copy = [straggler], True
+
+        if args.assumeResumable:
+            sigterm_handler.proc = None
+            sigterm_handler.commands = commands
+
+        # Outputs of a group of commands are logged in the files of its first command.
+        command = commands[0]
+        group_size = len(commands)
+        timed_out_commands = []
+        copy_watcher = None
         uid = utils.generate_uid_from_string(command)
+        if is_copy:
+            uid += ".copy"  # Outputs of a copy are kept apart from the ones of the command.
         stdout_filename = os.path.join(args.logs_dir, uid + ".out")
         stderr_filename = os.path.join(args.logs_dir, uid + ".err")
 
@@ -83,20 +522,187 @@ def main():
                 log_datetime = t.strftime("## SMART-DISPATCH - Started on: %Y-%m-%d %H:%M:%S - In job: {job_id} - On nodes: {node_name} ##\n".format(job_id=job_id, node_name=node_name))
                 if stdout_file.tell() > 0:  # Not the first line in the log file.
                     log_datetime = t.strftime("\n## SMART-DISPATCH - Resumed on: %Y-%m-%d %H:%M:%S - In job: {job_id} - On nodes: {node_name} ##\n".format(job_id=job_id, node_name=node_name))
+                    nb_failed_attempts = command_manager.get_command_attempts(command) if retry_policy is not None else 0
+                    if nb_failed_attempts > 0:
+                        log_datetime = t.strftime("\n## SMART-DISPATCH - Retried (attempt {attempt}) on: %Y-%m-%d %H:%M:%S - In job: {job_id} - On nodes: {node_name} ##\n".format(
+                            attempt=nb_failed_attempts + 1, job_id=job_id, node_name=node_name))
 
-                log_command = "## SMART-DISPATCH - Command: " + command + '\n'
+                # Commands of a group are announced one by one as they start.
+                log_command = get_log_command(command) if len(commands) == 1 else ""
 
                 stdout_file.write(log_datetime + log_command)
                 stdout_file.flush()
                 stderr_file.write(log_datetime + log_command)
                 stderr_file.flush()
 
-                proc = subprocess.Popen(command, stdout=stdout_file, stderr=stderr_file, shell=True)
-                if args.assumeResumable:
-                    sigterm_handler.proc = proc
-                error_code = proc.wait()
+                task_filenames = map(tasks.get_task_filename, commands) if args.inProcess else [None]
+                is_in_process = None not in task_filenames
+                if is_in_process:
+                    pin_worker()
+
+                command_to_run = command
+                preexec_fn = None
+                wrap_command = None
+                cpus = gpus = None
+                if cpu_allocator is not None and not is_in_process:
+                    cpu_slot, cpus = cpu_allocator.acquire()
+                    if cpus is None:
+                        logging.warn("No free set of CPUs left on this node, command is not pinned: {0}".format(command))
+                    elif slot_allocator.can_set_cpu_affinity():
+                        preexec_fn = partial(slot_allocator.set_cpu_affinity, cpus)
+                    else:
+                        wrap_command = partial(slot_allocator.wrap_with_taskset, cpus=cpus)
+                        command_to_run = wrap_command(command)
+
+                command_env = env
+                if gpu_allocator is not None and not is_in_process:
+                    gpu_slot, gpus = gpu_allocator.acquire()
+                    if gpus is None:
+                        logging.warn("No free set of GPUs left on this node, command sees every GPU: {0}".format(command))
+                    else:
+                        command_env = dict(os.environ if env is None else env, CUDA_VISIBLE_DEVICES=",".join(gpus))
+
+                resource_usage = {}
+                if is_in_process:
+                    error_codes, durations = [], []
+                    for i, task_filename in enumerate(task_filenames):
+                        if len(commands) > 1:
+                            stdout_file.write(get_log_command(commands[i]))
+                            stdout_file.flush()
+                            stderr_file.write(get_log_command(commands[i]))
+                            stderr_file.flush()
+
+                        start_time = t.time()
+                        error_codes.append(tasks.run_task_in_process(task_filename, stdout_file, stderr_file))
+                        durations.append(t.time() - start_time)
+                        if args.assumeResumable:
+                            if sigterm_handler.triggered:
+                                # Interrupted, the tasks left have already been put back in the pending commands.
+                                command_manager.set_running_commands_as_finished(commands[:i], error_codes[:i])
+                                sys.exit(0)
+
+                            sigterm_handler.commands = commands[i + 1:]
+                else:
+                    # The time limit of a group is the sum of its commands' ones.
+                    timeouts = [get_command_timeout(cmd, args.timeout) for cmd in commands]
+                    timeout = sum(timeouts) if None not in timeouts else None
+
+                    is_speculative = args.speculate is not None and len(commands) == 1 and utils.get_command_annotations(command).get('idempotent', False)
+
+                    # Commands to signal on their own are kept apart from the worker's process group.
+                    new_process_group = timeout is not None or is_speculative or (args.assumeResumable and args.checkpointSignal is not None)
+
+                    start_time = t.time()
+                    if is_speculative and not is_copy:
+                        command_manager.set_running_command_as_speculative(command, start_time)
+
+                    entry_point = preload.get_python_entry_point(command_to_run) if len(args.preload) > 0 and len(commands) == 1 else None
+                    if len(commands) > 1:
+                        proc = CommandGroup(commands, stdout_file, stderr_file, command_env, preexec_fn, wrap_command, new_process_group)
+                    elif entry_point is not None:
+                        proc = preload.ForkedProcess(entry_point, stdout_file, stderr_file, env=command_env, preexec_fn=preexec_fn, new_process_group=new_process_group)
+                    else:
+                        proc = spawn_command(command_to_run, stdout_file, stderr_file, command_env, preexec_fn, new_process_group)
+
+                    if args.assumeResumable:
+                        sigterm_handler.proc = proc
+
+                    if args.samplingInterval > 0:
+                        resource_monitor = ResourceMonitor(proc.pid, args.samplingInterval)
+                        resource_monitor.start()
+
+                    deadline = Deadline(proc, timeout, args.timeoutGrace) if timeout is not None else None
+                    if is_speculative:
+                        copy_watcher = CopyWatcher(proc, command_manager, command, args.timeoutGrace, args.speculationInterval)
+
+                    error_code = proc.wait()
+                    duration = t.time() - start_time
+                    if deadline is not None:
+                        deadline.cancel()
+                    if copy_watcher is not None:
+                        copy_watcher.cancel()
+
+                    if args.samplingInterval > 0:
+                        resource_usage = resource_monitor.stop()
+
+                    if len(commands) > 1:
+                        # Commands the shell did not get to, e.g. because it was killed, fail along with it.
+                        nb_missing = len(commands) - len(proc.error_codes)
+                        error_codes = proc.error_codes + [error_code or 1] * nb_missing
+                        durations = proc.durations + [0.] * nb_missing
+                        if nb_missing > 0:
+                            durations[len(proc.durations)] = duration - sum(proc.durations)  # Time spent in the interrupted command.
+                    else:
+                        error_codes, durations = [error_code], [duration]
+
+                    if deadline is not None and deadline.timed_out:
+                        # The command running when the time limit was hit timed out, the ones after it are executed later.
+                        nb_done = len(proc.error_codes) if len(commands) > 1 else 0
+                        logging.warn("Command timed out after {0} sec: {1}".format(durations[nb_done], commands[nb_done]))
+                        command_manager.set_running_commands_as_pending(commands[nb_done + 1:])
+                        timed_out_commands = commands[nb_done:nb_done + 1]
+                        commands, error_codes, durations = commands[:nb_done + 1], error_codes[:nb_done + 1], durations[:nb_done + 1]
+                        if args.assumeResumable:
+                            sigterm_handler.commands = commands
+
+                if cpus is not None:
+                    cpu_allocator.release(cpu_slot)
+                if gpus is not None:
+                    gpu_allocator.release(gpu_slot)
+
+        sync_outputs()
+        if copy_watcher is not None:
+            # Only the first copy of a speculative command to succeed (or the last to fail) is reported.
+            if not command_manager.set_speculative_copy_as_done(command, 1 if len(timed_out_commands) > 0 else error_codes[0]):
+                if copy_watcher.lost:
+                    logging.info("Another copy of the command succeeded first, this one was terminated: {0}".format(command))
+                continue
+
+        timing_infos = dict(resource_usage, job_id=job_id, node_name=node_name)
+        if group_size > 1:
+            timing_infos['group_size'] = group_size  # Resources were sampled for the whole group.
+        nb_executed = len(commands) - len(timed_out_commands)
+        command_manager.add_commands_timings(commands[:nb_executed], durations[:nb_executed], error_codes[:nb_executed], **timing_infos)
+        if len(timed_out_commands) > 0:
+            command_manager.add_commands_timings(timed_out_commands, durations[nb_executed:], error_codes[nb_executed:], timed_out=True, **timing_infos)
+
+        finished_commands, finished_error_codes, retried_commands = [], [], []
+        backoff = 0
+        for command, error_code in zip(commands[:nb_executed], error_codes):
+            if error_code != 0 and retry_policy is not None:
+                attempt = command_manager.increment_command_attempts(command)
+                if retry_policy.should_retry(error_code, attempt):
+                    backoff = max(backoff, retry_policy.get_backoff(attempt))
+                    logging.info("Command failed with exit code {0} (attempt {1}/{2}), retrying in {3} sec: {4}".format(
+                        error_code, attempt, retry_policy.max_attempts, retry_policy.get_backoff(attempt), command))
+                    retried_commands.append(command)
+                    continue
+
+            finished_commands.append(command)
+            finished_error_codes.append(error_code)
+
+        command_manager.set_running_commands_as_finished(finished_commands, finished_error_codes)
+        command_manager.set_running_commands_as_timed_out(timed_out_commands)
+        # Retried commands wait for their backoff among the pending ones, meanwhile the worker moves on.
+        command_manager.set_running_commands_as_pending(retried_commands, not_before=t.time() + backoff if backoff > 0 else None)
+        if args.assumeResumable:
+            sigterm_handler.commands = []
+
+        if args.badNodeFailures is not None:
+            for command, error_code, duration in zip(commands[:nb_executed], error_codes, durations):
+                fast_failures = fast_failures + [command] if error_code != 0 and duration < args.fastFailure else []
+
+            # Failures are blamed on the node only if other nodes can execute commands, otherwise the commands are at fault.
+            if len(fast_failures) >= args.badNodeFailures and has_succeeded_elsewhere(command_manager, node_name):
+                logging.warn("{0} commands failed within {1} sec in a row, blocklisting node {2}.".format(len(fast_failures), args.fastFailure, node_name))
+                command_manager.add_bad_node(node_name)
+                command_manager.discard_failed_attempts(fast_failures)
+                is_bad_node = True
+                break
+
+    if is_bad_node:
+        sys.exit(BAD_NODE_EXIT_CODE)
 
-        command_manager.set_running_command_as_finished(command, error_code)
 
 if __name__ == '__main__':
     main()
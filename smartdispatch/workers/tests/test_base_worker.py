@@ -3,11 +3,17 @@ import unittest
 import tempfile
 import time
 import shutil
+import signal
+import pickle
 
 import smartdispatch
 from smartdispatch import utils
 from smartdispatch.filelock import open_with_lock
 from smartdispatch.command_manager import CommandManager
+from smartdispatch.retry_policy import RetryPolicy
+from smartdispatch.circuit_breaker import CircuitBreaker
+from smartdispatch import slot_allocator
+from smartdispatch import tasks
 
 from subprocess import Popen, call, PIPE
 
@@ -17,7 +23,7 @@ from nose.tools import assert_true, assert_equal
 class TestSmartWorker(unittest.TestCase):
 
     def setUp(self):
-        self.base_worker_script = os.path.join(os.path.dirname(smartdispatch.__file__), 'workers', 'base_worker.py')
+        self.base_worker_script = os.path.abspath(os.path.join(os.path.dirname(smartdispatch.__file__), 'workers', 'base_worker.py'))
         self.commands = ["echo 1", "echo 2", "echo 3", "echo 4"]
         self._commands_dir = tempfile.mkdtemp()
         self.logs_dir = tempfile.mkdtemp()
@@ -117,3 +123,376 @@ class TestSmartWorker(unittest.TestCase):
         assert_equal(stdout, "")
         assert_true("write-lock" in stderr, msg="Forcing a race condition, try increasing sleeping time above.")
         assert_true("Traceback" not in stderr)  # Check that there are no errors.
+
+    def test_main_with_retries(self):
+        flag_filename = os.path.join(self._commands_dir, "flag")
+        flaky_command = "test -e {0} || (touch {0}; exit 2)".format(flag_filename)
+        failing_command = "exit 3"
+
+        command_manager = CommandManager(os.path.join(self._commands_dir, "retry_commands.txt"))
+        command_manager.set_commands_to_run([flaky_command, failing_command])
+        command_manager.set_retry_policy(RetryPolicy(max_attempts=2, never_retry_on_exit_codes=[3], backoff=1))
+
+        command = ['python2', self.base_worker_script, command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command), 0)
+
+        # The worker moved on to the other command while the flaky one waited for its backoff.
+        assert_equal([timing['command'] for timing in command_manager.get_commands_timings()], [flaky_command, failing_command, flaky_command])
+
+        # The flaky command succeeded on its second attempt, the other one is never retried.
+        assert_equal(command_manager.get_command_attempts(flaky_command), 1)
+        assert_equal(command_manager.get_failed_commands(), [failing_command + "\n"])
+        with open(command_manager._finished_commands_filename) as finished_commands_file:
+            assert_equal(finished_commands_file.read(), flaky_command + "\n")
+
+        with open(os.path.join(self.logs_dir, utils.generate_uid_from_string(flaky_command) + ".out")) as logfile:
+            assert_true("Retried (attempt 2)" in logfile.read())
+
+    def test_main_with_resource_sampling(self):
+        command = ['python2', self.base_worker_script, '-s', '0.05', self.command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command), 0)
+
+        timings = self.command_manager.get_commands_timings()
+        assert_equal(sorted(timing['command'] for timing in timings), self.commands)
+        for timing in timings:
+            assert_equal(timing['error_code'], 0)
+            for resource in ['cpu_time', 'peak_rss', 'max_threads', 'read_bytes', 'write_bytes']:
+                assert_true(resource in timing)
+
+    def test_main_without_resource_sampling(self):
+        command = ['python2', self.base_worker_script, '-s', '0', self.command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command), 0)
+
+        for timing in self.command_manager.get_commands_timings():
+            assert_true('cpu_time' not in timing)
+
+    def test_main_with_cpu_pinning(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "pinned_commands.txt"))
+        command_manager.set_commands_to_run(["grep Cpus_allowed_list /proc/self/status"])
+
+        command = ['python2', self.base_worker_script, '-c', '1', '--pinCpus', command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command), 0)
+
+        uid = utils.generate_uid_from_string("grep Cpus_allowed_list /proc/self/status")
+        with open(os.path.join(self.logs_dir, uid + ".out")) as logfile:
+            output = logfile.read().split("\n")[2]
+
+        first_cpu = slot_allocator.get_cpu_slots(1, slot_allocator.get_allowed_cpus(), slot_allocator.get_numa_nodes())[0][0]
+        assert_equal(output.split()[-1], str(first_cpu))
+
+    def test_main_with_gpu_slots(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "gpu_commands.txt"))
+        barrier_dir = tempfile.mkdtemp()
+        # Both commands wait for each other, so they hold their GPUs at the same time.
+        commands = ['touch {0}/{1}; for i in $(seq 100); do [ $(ls {0} | wc -l) -ge 2 ] && break; sleep 0.1; done; echo gpus:$CUDA_VISIBLE_DEVICES'.format(barrier_dir, i)
+                    for i in range(2)]
+        command_manager.set_commands_to_run(commands)
+
+        # Two workers sharing four fake GPUs, two per command.
+        command = ['python2', self.base_worker_script, '-g', '2', '--gpuDevices', '0,1,2,3', command_manager._commands_filename, self.logs_dir]
+        env = dict(os.environ, HOSTNAME="{0}.gpu_test".format(os.getpid()))
+        try:
+            workers = [Popen(command, env=env) for _ in range(2)]
+            assert_equal([worker.wait() for worker in workers], [0, 0])
+        finally:
+            shutil.rmtree(barrier_dir)
+
+        outputs = []
+        for cmd in commands:
+            with open(os.path.join(self.logs_dir, utils.generate_uid_from_string(cmd) + ".out")) as logfile:
+                outputs.append(logfile.read().strip().split("\n")[-1])
+
+        assert_equal(sorted(outputs), ["gpus:0,1", "gpus:2,3"])
+
+    def test_main_in_process_with_gpu_slots(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "task_commands.txt"))
+        path_tasks = os.path.join(self._commands_dir, "tasks")
+        command_manager.set_commands_to_run(tasks.save_tasks(os.getenv, ["CUDA_VISIBLE_DEVICES"] * 2, path_tasks))
+
+        # Tasks executed within the worker see the GPUs it keeps for them.
+        command = ['python2', self.base_worker_script, '--inProcess', '-g', '2', '--gpuDevices', '0,1,2,3', command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command, env=dict(os.environ, HOSTNAME="{0}.task_test".format(os.getpid()))), 0)
+
+        results = []
+        for i in range(2):
+            with open(os.path.join(path_tasks, "result_{0}.pkl".format(i)), 'rb') as result_file:
+                results.append(pickle.load(result_file))
+
+        assert_equal(results, ["0,1", "0,1"])
+
+    def test_main_with_stage_out(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "staged_commands.txt"))
+        command_manager.set_commands_to_run(['echo result > "$SD_STAGE_OUT_DIR/result.txt"'])
+
+        stage_out_dir = tempfile.mkdtemp()
+        results_dir = tempfile.mkdtemp()
+        try:
+            command = ['python2', self.base_worker_script, '--stageOut', '*.txt', command_manager._commands_filename, self.logs_dir]
+            assert_equal(call(command, cwd=results_dir, env=dict(os.environ, SD_STAGE_OUT_DIR=stage_out_dir)), 0)
+
+            with open(os.path.join(results_dir, "result.txt")) as result_file:
+                assert_equal(result_file.read(), "result\n")
+        finally:
+            shutil.rmtree(stage_out_dir)
+            shutil.rmtree(results_dir)
+
+    def test_main_with_preload(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "preload_commands.txt"))
+        script_filename = os.path.join(self._commands_dir, "script.py")
+        with open(script_filename, 'w') as script_file:
+            script_file.write("import sys\nprint 'preloaded:', 'colorsys' in sys.modules\nsys.exit(int(sys.argv[1]))\n")
+
+        commands = ["python2 {0} 0".format(script_filename), "python2 {0} 2".format(script_filename), "python2 {0} 0 | cat".format(script_filename)]
+        command_manager.set_commands_to_run(commands)
+
+        command = ['python2', self.base_worker_script, '--preload', 'colorsys', command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(command), 0)
+
+        outputs = []
+        for cmd in commands:
+            with open(os.path.join(self.logs_dir, utils.generate_uid_from_string(cmd) + ".out")) as logfile:
+                outputs.append(logfile.read().strip().split("\n")[-1])
+
+        # Commands piped to another one are executed by the shell, without the preloaded modules.
+        assert_equal(outputs, ["preloaded: True", "preloaded: True", "preloaded: False"])
+        assert_equal([timing['error_code'] for timing in command_manager.get_commands_timings()], [0, 2, 0])
+
+    def test_main_without_shell(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "spawn_commands.txt"))
+        script_filename = os.path.join(self._commands_dir, "script.py")
+        with open(script_filename, 'w') as script_file:
+            script_file.write("import os\nprint 'own group:', os.getpgid(0) == os.getpid()\n")
+
+        # Commands stay in the worker's process group, unless the worker signals them on their own (e.g. with a time limit).
+        commands = ["python2 {0}".format(script_filename), "python2 {0} #sd: timeout=60".format(script_filename), "python2 {0} | cat".format(script_filename)]
+        command_manager.set_commands_to_run(commands)
+        assert_equal(call(['python2', self.base_worker_script, command_manager._commands_filename, self.logs_dir]), 0)
+
+        outputs = []
+        for cmd in commands:
+            with open(os.path.join(self.logs_dir, utils.generate_uid_from_string(cmd) + ".out")) as logfile:
+                outputs.append(logfile.read().strip().split("\n")[-1])
+
+        assert_equal(outputs, ["own group: False", "own group: True", "own group: False"])
+
+    def test_main_resumable_forwards_sigterm(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "sleep_commands.txt"))
+        command_manager.set_commands_to_run(["sleep 30"])
+
+        # The worker has its own process group, like a job.
+        worker = Popen(['python2', self.base_worker_script, '-r', '-s', '0', command_manager._commands_filename, self.logs_dir], preexec_fn=os.setpgrp)
+        while len(command_manager.get_running_commands()) == 0:
+            time.sleep(0.1)
+        time.sleep(0.5)
+
+        # The command, in the worker's process group, is terminated along with it (e.g. by timeout).
+        start_time = time.time()
+        os.killpg(worker.pid, signal.SIGTERM)
+        assert_equal(worker.wait(), 0)
+        assert_true(time.time() - start_time < 10)
+        assert_equal(command_manager.get_pending_commands(), ["sleep 30"])
+
+    def test_main_with_groups(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "group_commands.txt"))
+        commands = ["echo 1", "exit 2", "echo 3 #sd: priority=1", "echo 4; exit 0", "echo 5"]
+        command_manager.set_commands_to_run(commands)
+        assert_equal(call(['python2', self.base_worker_script, '--groupSize', '2', '-s', '0', command_manager._commands_filename, self.logs_dir]), 0)
+
+        # Each command of a group keeps its own exit code.
+        assert_equal(command_manager.get_failed_commands(), ["exit 2\n"])
+        assert_equal(command_manager.get_finished_commands(), ["echo 1", "echo 3 #sd: priority=1", "echo 4; exit 0", "echo 5"])
+        timings = command_manager.get_commands_timings()
+        assert_equal([timing['command'] for timing in timings], commands)
+        assert_equal([timing['error_code'] for timing in timings], [0, 2, 0, 0, 0])
+        assert_equal([timing.get('group_size') for timing in timings], [2, 2, 2, 2, None])
+
+        # Outputs of a group are logged in the files of its first command.
+        with open(os.path.join(self.logs_dir, utils.generate_uid_from_string("echo 3 #sd: priority=1") + ".out")) as logfile:
+            lines = logfile.read().strip().split("\n")
+        assert_true("Started" in lines[0])
+        assert_equal(lines[1:], ["## SMART-DISPATCH - Command: echo 3 #sd: priority=1", "3",
+                                 "## SMART-DISPATCH - Command: echo 4; exit 0", "4"])
+        assert_true(not os.path.isfile(os.path.join(self.logs_dir, utils.generate_uid_from_string("echo 4; exit 0") + ".out")))
+
+    def test_main_resumable_group(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "sleep_commands.txt"))
+        command_manager.set_commands_to_run(["true", "sleep 30", "true"])
+
+        worker = Popen(['python2', self.base_worker_script, '-r', '-s', '0', '--groupSize', '3', command_manager._commands_filename, self.logs_dir], preexec_fn=os.setpgrp)
+        while len(command_manager.get_running_commands()) == 0:
+            time.sleep(0.1)
+        time.sleep(0.5)
+
+        # Commands of the group already done are not resumed.
+        os.killpg(worker.pid, signal.SIGTERM)
+        assert_equal(worker.wait(), 0)
+        assert_equal(command_manager.get_finished_commands(), ["true"])
+        assert_equal(command_manager.get_pending_commands(), ["sleep 30", "true"])
+
+    def test_main_with_timeouts(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "timeout_commands.txt"))
+        ignoring_command = "trap '' TERM; sleep 30 #sd: timeout=1"
+        commands = ["sleep 30", ignoring_command, "sleep 0.1 #sd: timeout=5", "echo 4"]
+        command_manager.set_commands_to_run(commands)
+
+        start_time = time.time()
+        worker = ['python2', self.base_worker_script, '--timeout', '0.5', '--timeoutGrace', '0.5', '-s', '0', command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(worker), 0)
+
+        # Commands exceeding their limit are terminated, or killed if they ignore SIGTERM, and the worker moves on.
+        assert_true(time.time() - start_time < 10)
+        assert_equal(command_manager.get_timed_out_commands(), ["sleep 30", ignoring_command])
+        assert_equal(command_manager.get_failed_commands(), [])
+        assert_equal(command_manager.get_finished_commands(), commands[2:])
+        timings = command_manager.get_commands_timings()
+        assert_equal([timing.get('timed_out', False) for timing in timings], [True, True, False, False])
+        assert_equal([timing['error_code'] for timing in timings[:2]], [-15, -9])
+
+    def test_main_group_with_timeout(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "timeout_commands.txt"))
+        command_manager.set_commands_to_run(["true", "sleep 30", "true"])
+        worker = ['python2', self.base_worker_script, '--groupSize', '3', '--timeout', '0.5', '-s', '0', command_manager._commands_filename, self.logs_dir]
+        assert_equal(call(worker), 0)
+
+        # Only the command running when the group hit its limit timed out, the next one was executed afterward.
+        assert_equal(command_manager.get_timed_out_commands(), ["sleep 30"])
+        assert_equal(command_manager.get_finished_commands(), ["true", "true"])
+
+    def test_main_with_speculative_copies(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "speculative_commands.txt"))
+        # Slow the first time only, e.g. on a bad node.
+        straggler = "mkdir {0} 2> /dev/null && sleep 30; echo done #sd: idempotent".format(os.path.join(self._commands_dir, "first"))
+        command_manager.set_commands_to_run([straggler, "sleep 0.1", "sleep 0.1"])
+
+        worker = ['python2', self.base_worker_script, '--speculate', '2', '--speculationInterval', '0.1', '-s', '0', command_manager._commands_filename, self.logs_dir]
+        start_time = time.time()
+        slow_worker = Popen(worker)
+        while len(command_manager.get_running_commands()) == 0 and slow_worker.poll() is None:
+            time.sleep(0.1)
+
+        # Once done with the other commands, the second worker executes a copy of the straggler, which terminates the original.
+        assert_equal(call(worker), 0)
+        assert_equal(slow_worker.wait(), 0)
+        assert_true(time.time() - start_time < 10)
+        assert_equal(command_manager.get_finished_commands(), ["sleep 0.1", "sleep 0.1", straggler])
+        assert_equal(command_manager.get_running_commands(), [])
+        assert_equal(command_manager.get_failed_commands(), [])
+
+        uid = utils.generate_uid_from_string(straggler)
+        assert_true("\ndone\n" in open(os.path.join(self.logs_dir, uid + ".copy.out")).read())
+        assert_true("\ndone\n" not in open(os.path.join(self.logs_dir, uid + ".out")).read())
+
+    def test_main_cancels_queued_jobs(self):
+        path_job = os.path.join(self._commands_dir, "batch")
+        os.makedirs(os.path.join(path_job, "commands"))
+        with open(os.path.join(path_job, "jobs_id.txt"), 'w') as jobs_id_file:
+            jobs_id_file.write("1.server\n")
+
+        path_bin = os.path.join(self._commands_dir, "bin")
+        os.mkdir(path_bin)
+        scripts = {'qstat': 'echo "1.server name user 0 Q queue"', 'qdel': 'echo "$@" >> "{0}/qdel.log"'.format(path_bin)}
+        for name, script in scripts.items():
+            with open(os.path.join(path_bin, name), 'w') as script_file:
+                script_file.write("#!/bin/sh\n" + script + "\n")
+            os.chmod(os.path.join(path_bin, name), 0755)
+
+        command_manager = CommandManager(os.path.join(path_job, "commands", "commands.txt"))
+        command_manager.set_commands_to_run(["true"])
+        command_manager.get_commands_to_run(1)
+        worker = ['python2', self.base_worker_script, '-s', '0', command_manager._commands_filename, self.logs_dir]
+        env = dict(os.environ, PATH=path_bin + os.pathsep + os.environ['PATH'])
+
+        # Queued jobs are kept while a command is running, since it might come back to the pending ones.
+        assert_equal(call(worker, env=env), 0)
+        assert_true(not os.path.isfile(os.path.join(path_bin, "qdel.log")))
+
+        # The last worker cancels them.
+        command_manager.set_running_commands_as_finished(["true"], [0])
+        assert_equal(call(worker, env=env), 0)
+        assert_equal(open(os.path.join(path_bin, "qdel.log")).read(), "1.server\n")
+
+    def test_main_with_circuit_breaker(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "circuit_breaker_commands.txt"))
+        command_manager.set_commands_to_run(["false {0}".format(i) for i in range(10)] + ["true"])
+        command_manager.set_circuit_breaker(CircuitBreaker(0.8, window=100, min_completions=3))
+
+        # The batch is paused after its first three failures, the commands left wait for it to be resumed.
+        assert_equal(call(['python2', self.base_worker_script, '-s', '0', command_manager._commands_filename, self.logs_dir]), 0)
+        assert_true(command_manager.is_paused())
+        assert_equal(len(command_manager.get_failed_commands()), 3)
+        assert_equal(command_manager.get_nb_commands_to_run(), 8)
+
+    def test_main_with_bad_node(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "bad_node_commands.txt"))
+        commands = ["false {0}".format(i) for i in range(6)]
+        failed_lines = [command + "\n" for command in commands]
+        worker = ['python2', self.base_worker_script, '-r', '--badNodeFailures', '3', '-s', '0', command_manager._commands_filename, self.logs_dir]
+        env = dict(os.environ, HOSTNAME="node1")
+
+        # Commands failing everywhere are at fault, not the node.
+        command_manager.set_commands_to_run(commands[:3])
+        assert_equal(call(worker, env=env), 0)
+        assert_equal(command_manager.get_failed_commands(), failed_lines[:3])
+        assert_equal(command_manager.get_bad_nodes(), [])
+
+        # Once commands succeeded elsewhere, the node is blocklisted and its fast failures are left to other nodes.
+        command_manager.set_commands_to_run(commands[3:] + ["true"])
+        command_manager.add_command_timing("true", 1., 0, node_name="node2")
+        assert_equal(call(worker, env=env), smartdispatch.batch.BAD_NODE_EXIT_CODE)
+        assert_equal(command_manager.get_bad_nodes(), ["node1"])
+        assert_equal(command_manager.get_failed_commands(), failed_lines[:3])
+        assert_equal(command_manager.get_pending_commands(), ["true"] + commands[3:])
+
+        # Workers on a blocklisted node do not claim commands.
+        assert_equal(call(worker, env=env), smartdispatch.batch.BAD_NODE_EXIT_CODE)
+        assert_equal(len(command_manager.get_pending_commands()), 4)
+        assert_equal(call(worker, env=dict(env, HOSTNAME="node2")), 0)
+        assert_equal(command_manager.get_failed_commands(), failed_lines)
+        assert_equal(command_manager.get_finished_commands(), ["true"])
+
+    def test_main_resumable_sends_checkpoint_signal(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "checkpoint_commands.txt"))
+        script_filename = os.path.join(self._commands_dir, "script.py")
+        with open(script_filename, 'w') as script_file:
+            script_file.write("import sys, time, signal\n"
+                              "def checkpoint(signum, frame):\n"
+                              "    time.sleep(0.5)\n"
+                              "    open(sys.argv[1], 'w').write('checkpointed')\n"
+                              "    sys.exit(0)\n"
+                              "signal.signal(signal.SIGUSR1, checkpoint)\n"
+                              "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                              "time.sleep(30)\n")
+
+        # The second command is executed by a shell that does not survive the signal.
+        checkpoint_filenames = [os.path.join(self._commands_dir, "checkpoint" + str(i)) for i in range(2)]
+        commands = ["python2 {0} {1}".format(script_filename, checkpoint_filenames[0]),
+                    "python2 {0} {1}; echo done".format(script_filename, checkpoint_filenames[1])]
+
+        for command, checkpoint_filename in zip(commands, checkpoint_filenames):
+            command_manager.set_commands_to_run([command])
+            worker = Popen(['python2', self.base_worker_script, '-r', '-s', '0', '--checkpointSignal', 'USR1', '--checkpointGrace', '10',
+                            command_manager._commands_filename, self.logs_dir])
+            while len(command_manager.get_running_commands()) == 0:
+                time.sleep(0.1)
+            time.sleep(1)
+
+            # The command saved its state before the worker requeued it.
+            worker.terminate()
+            assert_equal(worker.wait(), 0)
+            assert_equal(open(checkpoint_filename).read(), "checkpointed")
+            assert_equal(command_manager.get_pending_commands(), [command])
+            command_manager.get_commands_to_run(1)
+            command_manager.set_running_commands_as_finished([command], [0])
+
+    def test_main_with_thread_limits(self):
+        command_manager = CommandManager(os.path.join(self._commands_dir, "threads_commands.txt"))
+        env = dict((k, v) for k, v in os.environ.items() if k not in utils.THREAD_LIMITS_VARIABLES)
+        uid = utils.generate_uid_from_string("echo threads:$OMP_NUM_THREADS")
+
+        for flags, expected in [(['-c', '3'], "threads:3"), (['-c', '3', '--noThreadLimits'], "threads:")]:
+            command_manager.set_commands_to_run(["echo threads:$OMP_NUM_THREADS"])
+            command = ['python2', self.base_worker_script] + flags + [command_manager._commands_filename, self.logs_dir]
+            assert_equal(call(command, env=env), 0)
+
+            with open(os.path.join(self.logs_dir, uid + ".out")) as logfile:
+                assert_equal(logfile.read().strip().split("\n")[-1], expected)
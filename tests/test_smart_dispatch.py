@@ -4,7 +4,9 @@ import tempfile
 import shutil
 from os.path import join as pjoin, abspath
 
-from subprocess import call
+from subprocess import call, Popen, PIPE
+
+from smartdispatch.command_manager import CommandManager
 
 from nose.tools import assert_true, assert_equal
 
@@ -54,6 +56,24 @@ class TestSmartdispatcher(unittest.TestCase):
         path_job_commands = os.path.join(self.logs_dir, batch_uid, "commands")
         assert_equal(len(os.listdir(path_job_commands)), self.nb_commands + 1)
 
+    def test_main_launch_skip_completed(self):
+        exit_status = call(self.smart_dispatch_command.replace('-x', '-x -n first') + " launch " + self.folded_commands, shell=True)
+        assert_equal(exit_status, 0)
+
+        batch_uid = os.listdir(self.logs_dir)[0]
+        command_manager = CommandManager(os.path.join(self.logs_dir, batch_uid, "commands", "commands.txt"))
+        for _ in range(4):
+            command_manager.set_running_command_as_finished(command_manager.get_command_to_run())
+
+        # Actual test
+        exit_status = call(self.smart_dispatch_command.replace('-x', '-x -n second --skipCompleted') + " launch " + self.folded_commands, shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = [uid for uid in os.listdir(self.logs_dir) if uid.endswith("second")][0]
+        command_manager = CommandManager(os.path.join(self.logs_dir, batch_uid, "commands", "commands.txt"))
+        assert_equal(command_manager.get_pending_commands(), self.commands[4:])
+
     def test_launch_using_commands_file(self):
         # Actual test
         commands_filename = "commands_to_run.txt"
@@ -212,3 +232,126 @@ class TestSmartdispatcher(unittest.TestCase):
 
         nb_job_commands_files = len(os.listdir(path_job_commands))
         assert_equal(nb_job_commands_files-nb_commands_files, nb_workers_to_add)
+
+    def test_main_launch_with_target_makespan(self):
+        # Setup: fake a previous batch where each command took 1 minute.
+        path_previous_commands = pjoin(self.logs_dir, "previous_batch", "commands")
+        os.makedirs(path_previous_commands)
+        command_manager = CommandManager(pjoin(path_previous_commands, "commands.txt"))
+        for command in self.commands:
+            command_manager.add_command_timing(command, 60)
+
+        # Actual test: 24 commands of 1 minute in ~4 minutes needs 6 workers.
+        launch_command = self.smart_dispatch_command.replace('-t 5:00 ', '') + " --targetMakespan 4:00 launch " + self.folded_commands
+        exit_status = call(launch_command, shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = [name for name in os.listdir(self.logs_dir) if name != "previous_batch"][0]
+        path_job_commands = os.path.join(self.logs_dir, batch_uid, "commands")
+        assert_equal(len(os.listdir(path_job_commands)), 6 + 1)
+        assert_true(os.path.isfile(os.path.join(self.logs_dir, batch_uid, "sizing.log")))
+
+        pbs = open(pjoin(path_job_commands, "job_commands_0.sh")).read()
+        assert_true("walltime=0:00:05:00" in pbs)
+
+    def test_main_launch_with_costs_from_previous_batch(self):
+        # Setup: fake a previous batch where the last command took the longest.
+        path_previous_commands = pjoin(self.logs_dir, "previous_batch", "commands")
+        os.makedirs(path_previous_commands)
+        command_manager = CommandManager(pjoin(path_previous_commands, "commands.txt"))
+        for i, command in enumerate(self.commands):
+            command_manager.add_command_timing(command, i)
+
+        # Actual test
+        launch_command = self.smart_dispatch_command + " --costsFrom {0} launch {1}".format(pjoin(self.logs_dir, "previous_batch"), self.folded_commands)
+        exit_status = call(launch_command, shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = [name for name in os.listdir(self.logs_dir) if name != "previous_batch"][0]
+        pending_commands = open(pjoin(self.logs_dir, batch_uid, "commands", "commands.txt")).read()
+        assert_equal(pending_commands, "\n".join(self.commands[::-1]) + "\n")
+
+    def test_main_launch_with_invalid_cost_annotation(self):
+        # Actual test
+        commands_filename = "commands_to_run.txt"
+        open(commands_filename, 'w').write("echo 1  #sd: cost\n")
+
+        launch_command = self.smart_dispatch_command + " --order lpt -f {0} launch".format(commands_filename)
+        process = Popen(launch_command, shell=True, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+
+        # Test validation
+        assert_equal(process.returncode, 2)
+        assert_true("Invalid cost annotation" in stderr)
+        assert_true(not os.path.isdir(self.logs_dir))
+
+    def test_main_simulate(self):
+        # Actual test
+        command_line = self.smart_dispatch_command.replace(' -x', '').replace('5:00', '10:00') + " --pool 4 simulate --durations 1:00 " + self.folded_commands
+        process = Popen(command_line, shell=True, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+
+        # Test validation
+        assert_equal(process.returncode, 0)
+        assert_true("Makespan: 0:00:06:00" in stdout)
+        assert_true(not os.path.isdir(self.logs_dir))  # Nothing has been created.
+
+    def test_main_launch_locally(self):
+        # Actual test
+        launch_command = self.smart_dispatch_command.replace(' -x', '') + " -c 1 --pool 3 --launcher local launch " + self.folded_commands
+        exit_status = call(launch_command, shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = os.listdir(self.logs_dir)[0]
+        path_job = pjoin(self.logs_dir, batch_uid)
+        assert_equal(open(pjoin(path_job, "commands", "commands.txt")).read(), "")
+        assert_equal(sorted(open(pjoin(path_job, "commands", "finished_commands.txt")).read().split("\n")[:-1]), sorted(self.commands))
+
+        # Same log layout as a PBS job.
+        jobs_id = open(pjoin(path_job, "jobs_id.txt")).read().split("\n")[1:-1]
+        assert_equal(len(jobs_id), 3)
+        for i, job_id in enumerate(jobs_id):
+            assert_true(os.path.isfile(pjoin(path_job, "logs", "job", job_id + ".out")))
+            assert_true(os.path.isfile(pjoin(path_job, "logs", "worker", job_id + "_worker_{0}.o".format(i))))
+
+        assert_equal(len([f for f in os.listdir(pjoin(path_job, "logs")) if f.endswith(".out")]), self.nb_commands)
+
+    def test_main_report(self):
+        # Setup
+        call(self.launch_command, shell=True)
+        batch_uid = os.listdir(self.logs_dir)[0]
+        command_manager = CommandManager(pjoin(self.logs_dir, batch_uid, "commands", "commands.txt"))
+        for command in self.commands:
+            command_manager.add_command_timing(command, 10, cpu_time=30, peak_rss=1024 ** 3, max_threads=3, read_bytes=0, write_bytes=0)
+
+        # Actual test
+        process = Popen("{0} report {1}".format(self.smart_dispatch_command, batch_uid), shell=True, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+
+        # Test validation
+        assert_equal(process.returncode, 0)
+        assert_true("--coresPerCommand 3" in stdout)
+        assert_true("Memory per command: 1.2Gb" in stdout)
+
+    def test_main_launch_passes_cores_to_workers(self):
+        # Actual test
+        exit_status = call(self.launch_command_with_cores.format(cores=2).replace('-C 1', '-C 4'), shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = os.listdir(self.logs_dir)[0]
+        pbs = open(pjoin(self.logs_dir, batch_uid, "commands", "job_commands_0.sh")).read()
+        assert_true("base_worker.py -c 2 " in pbs)
+
+    def test_main_launch_passes_gpus_to_workers(self):
+        # Actual test
+        exit_status = call(self.launch_command_with_cores.format(cores=1).replace('-C 1', '-C 4 -G 2'), shell=True)
+
+        # Test validation
+        assert_equal(exit_status, 0)
+        batch_uid = os.listdir(self.logs_dir)[0]
+        pbs = open(pjoin(self.logs_dir, batch_uid, "commands", "job_commands_0.sh")).read()
+        assert_true(" -g 1 " in pbs)